@@ -1,9 +1,11 @@
 from threading import Lock
 from datetime import datetime, timedelta
 import threading
-from typing import Optional, Dict
+import time
+from typing import Optional, Dict, Callable, Iterator
 from contextlib import contextmanager
 import weakref
+from itertools import chain
 from tenacity import (
     retry,
     wait_exponential,
@@ -12,6 +14,8 @@ from tenacity import (
 )
 import logging
 
+from tracing import tracer
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -125,27 +129,82 @@ class AzureOpenAIEmbeddings(EmbeddingFunction, AzureOpenAIClient):
             texts = [texts]
         return self.get_embeddings(texts)
 
+class StreamMetrics:
+    """Timing for a single streamed completion."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.tokens = 0
+        self.cancelled = False
+
+    def record_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens += 1
+
+    def finish(self):
+        if self.finished_at is None:
+            self.finished_at = time.perf_counter()
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        # Measured over the generation phase only, so a slow first token doesn't skew the rate
+        if self.first_token_at is None or self.finished_at is None or self.tokens < 2:
+            return None
+        elapsed = self.finished_at - self.first_token_at
+        return (self.tokens - 1) / elapsed if elapsed > 0 else None
+
+    def as_dict(self) -> dict:
+        return {
+            "time_to_first_token": self.time_to_first_token,
+            "tokens": self.tokens,
+            "tokens_per_second": self.tokens_per_second,
+            "cancelled": self.cancelled,
+        }
+
+
 class AzureOpenAIChat(AzureOpenAIClient):
     SYS_PROMPT = '"""""Help the user find the answer they are looking for.""""'
+    MAX_TOKENS = 4096
+    TEMPERATURE = 0.1
+
+    def __init__(self, response_cache=None):
+        # Optional response_cache.ResponseCache consulted before each completion
+        self.response_cache = response_cache
+
+    def _messages(self, user_query):
+        return [
+            {"role": "system", "content": self.SYS_PROMPT},
+            {"role": "user", "content": user_query}
+        ]
 
     @retry(
         wait=wait_exponential(multiplier=1, min=4, max=10),
         stop=stop_after_attempt(3),
         retry=retry_if_exception_type((openai.error.APIError, openai.error.Timeout))
     )
-    def generate_response(self, user_query):
+    def _complete(self, user_query):
         session_id = threading.get_ident()
         try:
             logger.info(f"Generating response for session {session_id}")
-            response = self.CLIENT.chat.completions.create(
-                model=config.model_chat,
-                max_tokens=4096,
-                temperature=0.1,
-                messages=[
-                    {"role": "system", "content": self.SYS_PROMPT},
-                    {"role": "user", "content": user_query}
-                ]
-            )
+            with tracer.span("llm.generate_response", prompt_bytes=len(user_query)) as span:
+                response = self.CLIENT.chat.completions.create(
+                    model=config.model_chat,
+                    max_tokens=self.MAX_TOKENS,
+                    temperature=self.TEMPERATURE,
+                    messages=self._messages(user_query)
+                )
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
             return response.choices[0].message.content
         except openai.error.InvalidRequestError as e:
             logger.error(f"Invalid request error in session {session_id}: {e}")
@@ -154,9 +213,123 @@ class AzureOpenAIChat(AzureOpenAIClient):
             logger.error(f"Error in generate_response for session {session_id}: {e}")
             raise
 
+    def generate_response(self, user_query, question: Optional[str] = None, context_fingerprint: str = "",
+                          use_cache: bool = True):
+        """Return the completion for ``user_query``, served from the response cache when possible.
+
+        ``question`` is the bare user question used for cache matching (defaults
+        to the full prompt) and ``context_fingerprint`` scopes the entry to the
+        retrieved rows, see ``response_cache.context_fingerprint``. With
+        ``use_cache=False`` the response cache is neither read nor written.
+        """
+        if self.response_cache is None or not use_cache:
+            return self._complete(user_query)
+
+        cache_prompt = question if question is not None else user_query
+        cached, embedding = self.response_cache.lookup(cache_prompt, context_fingerprint)
+        if cached is not None:
+            logger.info(f"Response cache hit for session {threading.get_ident()}")
+            return cached
+
+        response = self._complete(user_query)
+        self.response_cache.put(cache_prompt, response, context_fingerprint, embedding=embedding)
+        return response
+
+    @staticmethod
+    def _chunk_text(chunk):
+        # Azure sends content-filter chunks with no choices; skip them
+        if not chunk.choices:
+            return None
+        return chunk.choices[0].delta.content
+
+    @staticmethod
+    def _close_stream(stream):
+        close = getattr(stream, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            logger.error(f"Error closing response stream: {e}")
+
+    @retry(
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+        stop=stop_after_attempt(3),
+        retry=retry_if_exception_type((openai.error.APIError, openai.error.Timeout))
+    )
+    def _open_stream(self, user_query):
+        # Pull up to the first token inside the retried call so connection
+        # errors before any output is shown are retried like generate_response
+        stream = self.CLIENT.chat.completions.create(
+            model=config.model_chat,
+            max_tokens=self.MAX_TOKENS,
+            temperature=self.TEMPERATURE,
+            messages=self._messages(user_query),
+            stream=True
+        )
+        chunks = iter(stream)
+        try:
+            for chunk in chunks:
+                token = self._chunk_text(chunk)
+                if token:
+                    return stream, chunks, token
+        except Exception:
+            self._close_stream(stream)
+            raise
+        return stream, chunks, None
+
+    def generate_response_stream(self,
+                                 user_query,
+                                 cancel_event: Optional[threading.Event] = None,
+                                 on_metrics: Optional[Callable[[StreamMetrics], None]] = None) -> Iterator[str]:
+        """Yield response tokens as they arrive.
+
+        Set ``cancel_event`` (or close the generator) to stop generation early,
+        e.g. when the user navigates away. Once the stream ends ``on_metrics``
+        is called with the :class:`StreamMetrics` for the call.
+        """
+        session_id = threading.get_ident()
+        metrics = StreamMetrics()
+        stream = None
+        try:
+            logger.info(f"Streaming response for session {session_id}")
+            stream, chunks, first = self._open_stream(user_query)
+            tokens = chain([first], filter(None, map(self._chunk_text, chunks))) if first else ()
+            for token in tokens:
+                if cancel_event is not None and cancel_event.is_set():
+                    metrics.cancelled = True
+                    logger.info(f"Response stream cancelled for session {session_id}")
+                    break
+                metrics.record_token()
+                yield token
+        except GeneratorExit:
+            metrics.cancelled = True
+            logger.info(f"Response stream closed by consumer for session {session_id}")
+            raise
+        except openai.error.InvalidRequestError as e:
+            logger.error(f"Invalid request error in session {session_id}: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Error in generate_response_stream for session {session_id}: {e}")
+            raise
+        finally:
+            metrics.finish()
+            if stream is not None:
+                self._close_stream(stream)
+            logger.info(f"Stream metrics for session {session_id}: {metrics.as_dict()}")
+            if tracer.enabled:
+                with tracer.span("llm.generate_response_stream", **metrics.as_dict()) as span:
+                    span.start = metrics.started
+            if on_metrics is not None:
+                on_metrics(metrics)
+
 if __name__ == "__main__":
     # Example usage
     llm = AzureOpenAIChat()
     print(llm.generate_response("Give me summary of all the issues in August this year. Give 1 point."))
 
+    for token in llm.generate_response_stream("Give me summary of all the issues in August this year.",
+                                              on_metrics=lambda m: print(m.as_dict())):
+        print(token, end="", flush=True)
+
     encoder = AzureOpenAIEmbeddings()
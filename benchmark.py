@@ -0,0 +1,306 @@
+"""Reproducible performance benchmarks over a synthetic ticket corpus.
+
+    python benchmark.py --docs 20000 --seed 7 --out bench_results.json
+    python benchmark.py --compare old.json new.json
+
+Azure endpoints and the sentence-transformer models are replaced by local,
+deterministic stand-ins so runs are comparable between commits and machines.
+``--skip-index`` runs only the stages that don't need Whoosh/Chroma.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from table_new import generate_summary_with_date_range, render_table
+from sample_new import parse_ticket
+
+CATEGORIES = ["Access issue", "Payment issue", "Data issue", "Performance", "Deployment", "Integration",
+              "Reporting", "Security"]
+GROUP_IDS = ["Access-Team", "Payment-Team", "Data-Team", "Platform-Team", "Integration-Team", "Support-L2"]
+TAGS = ["Critical", "High-priority", "User impact", "Financial", "Security", "API", "Bug fix", "Config",
+        "Data correction", "JSON", "Timeout", "Regression"]
+PROJECTS = ["online", "stores", "supply", "finance"]
+SUBJECTS = ["login page", "payment gateway", "nightly batch", "order API", "report export", "user profile",
+            "inventory sync", "search service", "checkout", "admin console"]
+PROBLEMS = ["returns 500 errors", "times out under load", "shows stale data", "rejects valid input",
+            "crashes on startup", "is missing records", "double charges customers", "logs users out"]
+FIXES = ["restarted the service", "rolled back the release", "increased the connection pool",
+         "corrected the config", "patched the validation", "reindexed the table", "cleared the cache"]
+SNIPPETS = ['```json\n{"retry": 3, "timeout_ms": 500}\n```', "```python\nclient.close()\n```", ""]
+
+QUERIES = ["payment gateway errors", "login timeout", "stale data in report export", "order API 500",
+           "inventory sync missing records", "checkout crashes", "security config", "nightly batch"]
+
+
+def generate_tickets(n, seed=42, start=datetime(2024, 1, 1), days=365):
+    """Yield (doc_id, content, timestamp, metadata) tuples in the ticket record format."""
+    rng = random.Random(seed)
+    for serial in range(1, n + 1):
+        date = start + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))
+        subject, problem = rng.choice(SUBJECTS), rng.choice(PROBLEMS)
+        content = (f"Serial: {serial} Date: {date.strftime('%d/%m/%Y')} "
+                   f"Category: {rng.choice(CATEGORIES)} "
+                   f"Issue: The {subject} {problem}. {rng.choice(SNIPPETS)} "
+                   f"Resolution: {rng.choice(FIXES).capitalize()} for the {subject}. "
+                   f"Context: Reported by {rng.randint(1, 500)} users. "
+                   f"GroupID: {', '.join(rng.sample(GROUP_IDS, rng.randint(1, 2)))} "
+                   f"Tag: {', '.join(rng.sample(TAGS, rng.randint(1, 3)))}")
+        record = parse_ticket(content)
+        metadata = {
+            "category": record.Category,
+            "groupID": record.GroupID,
+            "project": rng.choice(PROJECTS),
+            "escalated": rng.random() < 0.1,
+            "resolved": rng.random() < 0.8,
+        }
+        yield str(serial), content, date.timestamp(), metadata
+
+
+class HashingEmbedding:
+    """Deterministic bag-of-words embedding standing in for the sentence-transformer / Azure embeddings."""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def __call__(self, input):
+        vectors = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            for token in text.lower().split():
+                vectors[row, zlib.crc32(token.encode()) % self.dim] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        return vectors.tolist()
+
+    def embed_query(self, input):
+        # Chroma embeds query texts through embed_query when the function has one
+        return self(input)
+
+    def name(self):
+        return "hashing"
+
+
+class OverlapCrossEncoder:
+    """Stand-in for the CrossEncoder used by enhance_results: token overlap as the relevance score."""
+
+    def __init__(self):
+        self.model = self
+
+    def predict(self, pairs):
+        scores = []
+        for query, doc in pairs:
+            query_tokens = set(query.lower().split())
+            scores.append(len(query_tokens & set(doc.lower().split())) / (len(query_tokens) or 1))
+        return np.array(scores)
+
+
+def _percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {"p50_ms": float(np.percentile(samples, 50)), "p99_ms": float(np.percentile(samples, 99)),
+            "mean_ms": float(samples.mean()), "n": int(len(samples))}
+
+
+def _timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return _percentiles(samples)
+
+
+def _peak_bytes(func):
+    # Peak Python allocations while func runs, keeping its result alive like a caller would
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def bench_render(rows, repeat):
+    results = {}
+    for fmt in ("markdown", "tsv", "records"):
+        results[fmt] = _timed(lambda: render_table(rows, fmt=fmt, code_columns=["Issue", "Resolution", "Context"]),
+                              repeat)
+        results[fmt]["bytes"] = len(render_table(rows, fmt=fmt, code_columns=["Issue", "Resolution", "Context"]))
+    return results
+
+
+def bench_summary(rows, repeat):
+    start, end = "15/02/2024", "20/11/2024"
+    return {backend: _timed(lambda: generate_summary_with_date_range(rows, start, end, backend=backend), repeat)
+            for backend in ("python", "columnar")}
+
+
+def bench_index(tickets, queries, batch_size, repeat, workdir):
+    from rag import RAGApplication
+
+    app = RAGApplication(index_dir=os.path.join(workdir, "whoosh"),
+                         chroma_persist_directory=os.path.join(workdir, "chroma"),
+                         embeddings_model=HashingEmbedding(),
+                         rollup_path=os.path.join(workdir, "rollup.db"))
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(0, len(tickets), batch_size):
+        batch = tickets[i:i + batch_size]
+        app.add_document([t[0] for t in batch], [t[1] for t in batch], [t[2] for t in batch],
+                         category=[t[3]["category"] for t in batch],
+                         escalated=[t[3]["escalated"] for t in batch],
+                         resolved=[t[3]["resolved"] for t in batch],
+                         project=[t[3]["project"] for t in batch],
+                         groupID=[t[3]["groupID"] for t in batch])
+    elapsed = time.perf_counter() - start
+    results["ingest"] = {"docs": len(tickets), "seconds": elapsed, "docs_per_sec": len(tickets) / elapsed}
+
+    low = datetime(2024, 3, 1).timestamp()
+    high = datetime(2024, 5, 31).timestamp()
+    for label, kwargs in (("search", {}), ("search_date_range", {"start_date": low, "end_date": high})):
+        samples = []
+        for _ in range(repeat):
+            for query in queries:
+                t0 = time.perf_counter()
+                app.search(query, top_k=20, **kwargs)
+                samples.append(time.perf_counter() - t0)
+        results[label] = _percentiles(samples)
+
+    # Every ticket in the date range, the largest result set a request can produce
+    eager_peak, _ = _peak_bytes(lambda: app.search(start_date=low, end_date=high))
+    lazy_peak, lazy = _peak_bytes(lambda: app.search(start_date=low, end_date=high, lazy=True))
+    results["search_memory"] = {"results": len(lazy), "eager_peak_bytes": eager_peak, "lazy_peak_bytes": lazy_peak}
+
+    encoder = OverlapCrossEncoder()
+    docs = app.search(queries[0], top_k=50)[2]
+    results["rerank"] = _timed(lambda: app.enhance_results(encoder, queries[0], docs, alpha=0.7), repeat)
+    results["rerank"]["candidates"] = len(docs)
+
+    results["summary_rollup"] = _timed(lambda: app.summarize("15/02/2024", "20/11/2024"), repeat)
+    return results
+
+
+def bench_lexical(tickets, queries, repeat, workdir):
+    """Whoosh ``searcher.search(limit=None)`` against SparseBM25Index on the same corpus and queries.
+
+    Both return the same hits, but not the same scores or top order (see
+    ``SparseBM25Index``), so this compares latency only.
+    """
+    from whoosh import index
+    from whoosh.fields import Schema, TEXT, ID, DATETIME, STORED
+    from whoosh.qparser import QueryParser
+    from whoosh.query import DateRange
+    from sparse_bm25 import SparseBM25Index, plain_terms
+
+    os.makedirs(workdir)
+    schema = Schema(id=ID(stored=True), content=TEXT(stored=True), timestamp=DATETIME(stored=True), record=STORED)
+    whoosh_index = index.create_in(workdir, schema)
+    writer = whoosh_index.writer()
+    for doc_id, content, ts, _ in tickets:
+        writer.add_document(id=doc_id, content=content, timestamp=datetime.fromtimestamp(ts))
+    writer.commit()
+
+    start = time.perf_counter()
+    sparse_index = SparseBM25Index.from_whoosh(whoosh_index)
+    sparse_index.search(None)
+    results = {"sparse_build_s": time.perf_counter() - start}
+
+    parser = QueryParser("content", schema)
+    low, high = datetime(2024, 3, 1), datetime(2024, 5, 31)
+    for label, date_range in (("", None), ("_date_range", (low, high))):
+        whoosh_samples, sparse_samples = [], []
+        with whoosh_index.searcher() as searcher:
+            for _ in range(repeat):
+                for query in queries:
+                    t0 = time.perf_counter()
+                    parsed = parser.parse(query)
+                    final = parsed & DateRange("timestamp", *date_range) if date_range else parsed
+                    [hit.score for hit in searcher.search(final, limit=None)]
+                    t1 = time.perf_counter()
+                    bounds = (low.timestamp(), high.timestamp()) if date_range else (None, None)
+                    [hit.score for hit in sparse_index.search(plain_terms(parser.parse(query)), *bounds)]
+                    sparse_samples.append(time.perf_counter() - t1)
+                    whoosh_samples.append(t1 - t0)
+        results[f"whoosh{label}"] = _percentiles(whoosh_samples)
+        results[f"sparse{label}"] = _percentiles(sparse_samples)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(docs, seed, repeat, batch_size, skip_index):
+    tickets = list(generate_tickets(docs, seed))
+    rows = [parse_ticket(content).as_row() for _, content, _, _ in tickets]
+
+    results = {
+        "render": bench_render(rows[:min(len(rows), 2000)], repeat),
+        "summary": bench_summary(rows, repeat),
+    }
+    if not skip_index:
+        workdir = tempfile.mkdtemp(prefix="rag-bench-")
+        try:
+            results["lexical"] = bench_lexical(tickets, QUERIES, repeat, os.path.join(workdir, "lexical"))
+            results.update(bench_index(tickets, QUERIES, batch_size, repeat, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {"commit": git_commit(), "docs": docs, "seed": seed, "repeat": repeat,
+                 "python": platform.python_version(), "machine": platform.machine(),
+                 "created": datetime.now().isoformat(timespec="seconds")},
+        "results": results,
+    }
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(old, new):
+    """Print every metric present in both runs with the new/old ratio."""
+    old_metrics = dict(_flatten(old["results"]))
+    print(f"{'metric':<40} {'old':>12} {'new':>12} {'ratio':>7}")
+    for name, value in _flatten(new["results"]):
+        if name in old_metrics and old_metrics[name]:
+            print(f"{name:<40} {old_metrics[name]:>12.3f} {value:>12.3f} {value / old_metrics[name]:>7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--skip-index", action="store_true")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+    else:
+        report = run(args.docs, args.seed, args.repeat, args.batch_size, args.skip_index)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(json.dumps(report["results"], indent=2))
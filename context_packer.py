@@ -0,0 +1,149 @@
+import logging
+from typing import Callable, Dict, List, Optional, Sequence
+
+from table_new import create_markdown_table, rendered_headers
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _ENCODING = None
+
+logger = logging.getLogger(__name__)
+
+TRUNCATION_MARKER = " [truncated]"
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens locally with tiktoken, or estimate ~4 chars/token without it."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _ENCODING is not None:
+        return _ENCODING.decode(_ENCODING.encode(text, disallowed_special=())[:max_tokens]) + TRUNCATION_MARKER
+    return text[:max_tokens * 4] + TRUNCATION_MARKER
+
+
+def estimate_row_tokens(row: dict, columns: Optional[List[str]] = None) -> int:
+    # Each rendered cell costs its text plus the "| " delimiters and padding; other keys aren't in the table
+    cells = [str(row.get(column, "")) for column in rendered_headers(columns)]
+    return sum(count_tokens(cell) for cell in cells) + 2 * len(cells)
+
+
+class PackReport:
+    """What the packer kept, truncated and dropped for one prompt."""
+
+    def __init__(self, budget_tokens: int):
+        self.budget_tokens = budget_tokens
+        self.total_rows = 0
+        self.included: List[str] = []
+        self.truncated: Dict[str, List[str]] = {}
+        self.dropped: List[str] = []
+        self.tokens = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "budget_tokens": self.budget_tokens,
+            "tokens": self.tokens,
+            "total_rows": self.total_rows,
+            "included": len(self.included),
+            "truncated": self.truncated,
+            "dropped": self.dropped,
+        }
+
+    def __str__(self):
+        return (f"{len(self.included)}/{self.total_rows} rows in {self.tokens}/{self.budget_tokens} tokens, "
+                f"{len(self.truncated)} truncated, {len(self.dropped)} dropped")
+
+
+def pack_context(rows: Sequence[dict],
+                 budget_tokens: int,
+                 columns: Optional[List[str]] = None,
+                 truncate_columns: Sequence[str] = ("Issue", "Resolution"),
+                 max_cell_tokens: int = 256,
+                 min_cell_tokens: int = 32,
+                 render: Callable[..., str] = create_markdown_table,
+                 **render_kwargs):
+    """Render the highest-ranked rows that fit in ``budget_tokens``.
+
+    ``rows`` must already be ordered best first (as returned by search/rerank).
+    Long cells in ``truncate_columns`` are first capped at ``max_cell_tokens``;
+    a row that still doesn't fit has those cells cut down to
+    ``min_cell_tokens`` before it is dropped. Returns ``(table, PackReport)``.
+    """
+    report = PackReport(budget_tokens)
+    report.total_rows = len(rows)
+    # Overhead of the header and separator rows, measured on a single empty row
+    overhead = count_tokens(render([{}], columns=columns, **render_kwargs)) if rows else 0
+    used = overhead
+    packed = []
+
+    def row_id(row, position):
+        return str(row.get("Serial", position))
+
+    def shrink(row, limit, key):
+        row = dict(row)
+        for column in truncate_columns:
+            value = str(row.get(column, ""))
+            cut = truncate_to_tokens(value, limit)
+            if cut != value:
+                row[column] = cut
+                report.truncated.setdefault(key, [])
+                if column not in report.truncated[key]:
+                    report.truncated[key].append(column)
+        return row
+
+    for position, row in enumerate(rows):
+        key = row_id(row, position)
+        candidate = shrink(row, max_cell_tokens, key)
+        cost = estimate_row_tokens(candidate, columns)
+        if used + cost > budget_tokens:
+            candidate = shrink(candidate, min_cell_tokens, key)
+            cost = estimate_row_tokens(candidate, columns)
+        if used + cost > budget_tokens:
+            report.dropped.append(key)
+            report.truncated.pop(key, None)
+            continue
+        packed.append((key, candidate))
+        used += cost
+
+    def render_packed(n):
+        return render([row for _, row in packed[:n]], columns=columns, **render_kwargs) if n else ""
+
+    # The per-row estimate ignores column padding, so the real render can still be over budget.
+    # Its size only grows with each row kept: drop 1, 2, 4, ... rows from the bottom until it
+    # fits, then bisect between the last two cuts, so only O(log dropped) tables are rendered.
+    table = render_packed(len(packed))
+    report.tokens = count_tokens(table)
+    if report.tokens > budget_tokens:
+        high, step = len(packed) - 1, 1
+        while True:
+            low = max(len(packed) - step, 0)
+            table = render_packed(low)
+            report.tokens = count_tokens(table)
+            if report.tokens <= budget_tokens:
+                break
+            high, step = low - 1, step * 2
+        # The largest fitting row count is in [low, high]
+        while low < high:
+            mid = (low + high + 1) // 2
+            candidate = render_packed(mid)
+            tokens = count_tokens(candidate)
+            if tokens <= budget_tokens:
+                low, table, report.tokens = mid, candidate, tokens
+            else:
+                high = mid - 1
+        for key, _ in packed[low:]:
+            report.dropped.append(key)
+            report.truncated.pop(key, None)
+        del packed[low:]
+
+    report.included = [key for key, _ in packed]
+    if report.dropped or report.truncated:
+        logger.info(f"Context packed: {report}")
+    return table, report
@@ -1,12 +1,178 @@
-
 from configs import config
+import atexit
+import logging
+import queue
 import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class _Flush:
+    """Queue marker for ``flush``: set once the rows before it are written or have failed."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+_CLOSE = object()
+
+
+class FeedbackWriter:
+    """Background writer that batches feedback inserts into a single transaction.
+
+    One writer (and one long-lived connection) is shared per database file so
+    saving feedback only enqueues a row and never blocks the chat path on disk.
+    When a batch insert fails its rows are written one at a time: rows SQLite
+    can't bind are dropped, the rest are kept (up to ``max_failed``) and
+    retried every ``retry_interval`` seconds and with the next batch.
+    ``flush`` raises while rows are unwritten or after rows were dropped.
+    ``close``, also run at interpreter exit, drains the queue.
+    """
+    _writers = {}
+    _writers_lock = threading.Lock()
+
+    INSERT = ("INSERT INTO UserFeedback(username, email, vertical, query, response, feedback, comment, ts) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+    def __init__(self, db_path, batch_size=500, flush_interval=0.05, retry_interval=1.0, max_failed=10000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_failed = max_failed
+        self._queue = queue.Queue()
+        self._failed = []
+        self._closed = False
+        # Held while checking _closed and enqueueing, so nothing lands behind the close marker
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def for_path(cls, db_path):
+        with cls._writers_lock:
+            if db_path not in cls._writers:
+                cls._writers[db_path] = cls(db_path)
+            return cls._writers[db_path]
+
+    def _put(self, item):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"Feedback writer for {self.db_path} is closed")
+            self._queue.put(item)
+
+    def submit(self, row):
+        self._put(row)
+
+    def flush(self):
+        """Block until every row submitted so far is committed; raises if some could not be written."""
+        marker = _Flush()
+        self._put(marker)
+        marker.done.wait()
+        if marker.error is not None:
+            unwritten, dropped, error = marker.error
+            raise RuntimeError(f"{unwritten} feedback rows are not written yet and will be retried, "
+                               f"{dropped} were dropped: {error}") from error
+
+    def close(self):
+        """Write everything queued, stop the writer thread and close the connection."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_CLOSE)
+        with self._writers_lock:
+            if self._writers.get(self.db_path) is self:
+                del self._writers[self.db_path]
+        self._thread.join()
+        if self._failed:
+            logger.error(f"Dropping {len(self._failed)} feedback rows for {self.db_path} that could not be written")
+        self._conn.close()
+        atexit.unregister(self.close)
+
+    def _write(self, batch):
+        """Insert the rows kept from earlier failures and ``batch``.
+
+        Returns None when every row is written, else (rows kept for a retry, rows dropped, last error).
+        """
+        rows = self._failed + batch
+        if not rows:
+            return None
+        try:
+            with self._conn:
+                self._conn.executemany(self.INSERT, rows)
+            self._failed = []
+            return None
+        except Exception as e:
+            logger.warning(f"Error writing {len(rows)} feedback rows, writing them one at a time: {e}")
+
+        # One transaction per row, so a row that can never be written doesn't hold back the others
+        failed, dropped, error = [], 0, None
+        for row in rows:
+            try:
+                with self._conn:
+                    self._conn.execute(self.INSERT, row)
+            except (sqlite3.InterfaceError, sqlite3.ProgrammingError) as e:
+                logger.error(f"Dropping feedback row from {row[0]!r} that can't be written: {e}")
+                dropped, error = dropped + 1, e
+            except Exception as e:
+                failed.append(row)
+                error = e
+        if len(failed) > self.max_failed:
+            logger.error(f"Dropping the {len(failed) - self.max_failed} oldest unwritten feedback rows "
+                         f"for {self.db_path} to keep at most {self.max_failed} for a retry")
+            dropped += len(failed) - self.max_failed
+            failed = failed[-self.max_failed:]
+        if failed:
+            logger.error(f"Keeping {len(failed)} feedback rows for a retry: {error}")
+        self._failed = failed
+        return (len(failed), dropped, error) if failed or dropped else None
+
+    def _run(self):
+        while True:
+            batch, markers, closing = [], [], False
+            try:
+                item = self._queue.get(timeout=self.retry_interval if self._failed else None)
+            except queue.Empty:
+                self._write([])
+                continue
+            while True:
+                if item is _CLOSE:
+                    closing = True
+                    break
+                if isinstance(item, _Flush):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+            error = self._write(batch)
+            for marker in markers:
+                marker.error = error
+                marker.done.set()
+            if closing:
+                return
 
 
 class UserData():
 
     def __init__(self):
-        self.conn = sqlite3.connect(config.feedback_db)
+        self.conn = _connect(config.feedback_db)
         self.cursor = self.conn.cursor()
 
 
@@ -19,23 +185,60 @@ class UserData():
         self.cursor.execute(
             """CREATE TABLE IF NOT EXISTS UserFeedback(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username text, 
-            email text, 
-            vertical text, 
-            query text, 
-            response text, 
-            feedback text, 
-            comment text, 
+            username text,
+            email text,
+            vertical text,
+            query text,
+            response text,
+            feedback text,
+            comment text,
             ts datetime)""")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_ts ON UserFeedback(ts)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_username ON UserFeedback(username)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_vertical ON UserFeedback(vertical, ts)")
+        self.conn.commit()
 
 
     def _update(self, username, email, vertical, query, response, feedback, comment, ts):
-        self.cursor.execute("update UserFeedback set username=?, email=?, vertical=?, query=?, response=?, feedback=?, comment=?, ts=?",
-                            (username, email, vertical, query, response, feedback, comment, ts))
-        self.conn.commit()
-        self.conn.close()
+        FeedbackWriter.for_path(config.feedback_db).submit(
+            (username, email, vertical, query, response, feedback, comment, ts))
 
 
     def save_feedback(self, username, email, vertical, query, response, feedback, comment, ts):
         self._update(username, email, vertical, query, response, feedback, comment, ts)
 
+
+    def flush_feedback(self):
+        FeedbackWriter.for_path(config.feedback_db).flush()
+
+
+    def feedback_per_day(self, start=None, end=None, vertical=None):
+        """Return (day, feedback, count) rows, served from the ts/vertical indexes."""
+        query = "SELECT date(ts) AS day, feedback, COUNT(*) FROM UserFeedback WHERE 1=1"
+        params = []
+        if start is not None:
+            query += " AND ts >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND ts <= ?"
+            params.append(end)
+        if vertical is not None:
+            query += " AND vertical = ?"
+            params.append(vertical)
+        query += " GROUP BY day, feedback ORDER BY day"
+        return self.cursor.execute(query, params).fetchall()
+
+
+    def feedback_rate_per_day(self, start=None, end=None, vertical=None):
+        """Return {day: {feedback: share of that day's feedback}}."""
+        totals, rates = {}, {}
+        rows = self.feedback_per_day(start, end, vertical)
+        for day, _, count in rows:
+            totals[day] = totals.get(day, 0) + count
+        for day, feedback, count in rows:
+            rates.setdefault(day, {})[feedback] = count / totals[day]
+        return rates
+
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,30 @@
+from datetime import datetime
+from typing import List, Optional
+
+from sample_new import parse_date, parse_record
+
+
+class DataProcessing:
+    """Timestamp and record helpers shared by RAGApplication's result handling and keyword counts."""
+
+    @staticmethod
+    def parse_record(text: str) -> dict:
+        return parse_record(text)
+
+    @staticmethod
+    def date_to_timestamp(date: str) -> Optional[float]:
+        return parse_date(date)
+
+    @staticmethod
+    def get_ts(data: dict) -> List[float]:
+        """Timestamps of a Chroma ``get`` result, in its order."""
+        return [(meta or {}).get("timestamp") for meta in data["metadatas"]]
+
+    @staticmethod
+    def sort_ts(timestamps: List[float]) -> List[float]:
+        return sorted(ts for ts in timestamps if ts is not None)
+
+    @staticmethod
+    def get_record_by_month(timestamp: float) -> str:
+        # "June-2024", as found in the "01-June-2024 to 30-June-2024" keys of create_monthly_date_ranges
+        return datetime.fromtimestamp(timestamp).strftime("%B-%Y")
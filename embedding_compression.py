@@ -0,0 +1,216 @@
+"""Smaller embeddings for the vector index: a learned projection plus a storage precision.
+
+    python embedding_compression.py --chroma-dir chroma_db --dims 64,128,192 --storage float32,float16,int8
+    python embedding_compression.py --docs 20000 --dims 128 --storage int8 --save projection.npz
+
+The projection is fitted on vectors from our own corpus (PCA, or truncation
+for models trained to be truncated), and each setting is scored by exact
+recall@k against the full-precision vectors, so the table shows what every
+dimension/precision point costs in recall for the bytes it saves.
+"""
+import argparse
+import hashlib
+import json
+import logging
+from typing import Optional
+
+import numpy as np
+import chromadb
+
+from hnsw_index import brute_force_topk, recall_at_k
+from snapshot import embedding_model_id
+
+logger = logging.getLogger(__name__)
+
+METHODS = ("pca", "truncate")
+STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+class EmbeddingProjection:
+    """Maps model embeddings to ``dim`` dimensions and rounds them to the ``storage`` precision.
+
+    ``compress`` is what gets indexed: projected vectors whose values are
+    exactly representable in the storage dtype (int8 with one scale per
+    dimension, learned at fit time), so they can be stored as such without
+    further loss.
+    """
+
+    def __init__(self, method: str, dim: int, components: Optional[np.ndarray] = None,
+                 mean: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None, storage: str = "float32",
+                 explained_variance: Optional[float] = None):
+        if method not in METHODS:
+            raise ValueError(f"Unknown projection method {method!r}")
+        if storage not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype {storage!r}")
+        if storage == "int8" and scales is None:
+            raise ValueError("int8 storage needs per-dimension scales; build it with EmbeddingProjection.fit")
+        self.method = method
+        self.dim = dim
+        self.components = components
+        self.mean = mean
+        self.scales = scales
+        self.storage = storage
+        self.explained_variance = explained_variance
+
+    @classmethod
+    def fit(cls, vectors, dim: int, method: str = "pca", storage: str = "float32") -> "EmbeddingProjection":
+        """Learn the projection (and int8 scales) from a sample of embeddings, rows being vectors."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if dim > vectors.shape[1]:
+            raise ValueError(f"Can't project {vectors.shape[1]}-dim vectors to {dim} dimensions")
+        components = mean = explained = None
+        if method == "pca":
+            mean = vectors.mean(axis=0)
+            centered = vectors - mean
+            # Eigenvectors of the covariance matrix: D x D, cheaper than an SVD of the whole sample
+            eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+            order = np.argsort(eigenvalues)[::-1][:dim]
+            components = np.ascontiguousarray(eigenvectors[:, order].T, dtype=np.float32)
+            explained = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+        projection = cls(method, dim, components, mean, None, "float32", explained)
+        if storage == "int8":
+            projected = projection.transform(vectors)
+            projection.scales = (np.maximum(np.abs(projected).max(axis=0), 1e-12) / 127).astype(np.float32)
+        projection.storage = storage
+        return projection
+
+    def transform(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == "truncate":
+            return np.ascontiguousarray(vectors[:, :self.dim])
+        return (vectors - self.mean) @ self.components.T
+
+    def quantize(self, projected) -> np.ndarray:
+        projected = np.asarray(projected, dtype=np.float32)
+        if self.storage == "int8":
+            # Values beyond the fitted range are clipped
+            return np.clip(np.rint(projected / self.scales), -127, 127).astype(np.int8)
+        return projected.astype(STORAGE_DTYPES[self.storage])
+
+    def dequantize(self, stored) -> np.ndarray:
+        if self.storage == "int8":
+            return np.asarray(stored, dtype=np.float32) * self.scales
+        return np.asarray(stored, dtype=np.float32)
+
+    def compress(self, vectors) -> np.ndarray:
+        return self.dequantize(self.quantize(self.transform(vectors)))
+
+    def bytes_per_vector(self) -> int:
+        return self.dim * np.dtype(STORAGE_DTYPES[self.storage]).itemsize
+
+    def identifier(self) -> str:
+        """Short id that changes whenever the learned transform does."""
+        digest = hashlib.sha256()
+        for array in (self.components, self.mean, self.scales):
+            if array is not None:
+                digest.update(np.ascontiguousarray(array).tobytes())
+        return f"{self.method}{self.dim}-{self.storage}-{digest.hexdigest()[:8]}"
+
+    def save(self, path: str):
+        arrays = {name: array for name, array in (("components", self.components), ("mean", self.mean),
+                                                  ("scales", self.scales)) if array is not None}
+        settings = {"method": self.method, "dim": self.dim, "storage": self.storage,
+                    "explained_variance": self.explained_variance}
+        with open(path, "wb") as f:
+            np.savez(f, settings=np.array(json.dumps(settings)), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "EmbeddingProjection":
+        with np.load(path) as data:
+            settings = json.loads(str(data["settings"]))
+            arrays = {name: data[name] for name in ("components", "mean", "scales") if name in data}
+        return cls(settings["method"], settings["dim"], storage=settings["storage"],
+                   explained_variance=settings["explained_variance"], **arrays)
+
+
+class CompressedEmbeddingFunction(chromadb.EmbeddingFunction):
+    """Wraps an embedding function so documents and queries both come out projected and quantized."""
+
+    def __init__(self, base, projection: EmbeddingProjection):
+        self.base = base
+        self.projection = projection
+
+    def __call__(self, input: chromadb.Documents) -> chromadb.Embeddings:
+        return self.projection.compress(self.base(input)).tolist()
+
+    def embed_query(self, input):
+        return self(input)
+
+    def name(self):
+        # Part of the snapshot's model id, so vectors only go back next to the same transform
+        return f"{embedding_model_id(self.base)}+{self.projection.identifier()}"
+
+
+def recall_loss(doc_vectors, query_vectors, projection: EmbeddingProjection, k: int = 10,
+                space: str = "cosine") -> dict:
+    """Exact recall@k of neighbours found with compressed vectors against those found with the originals.
+
+    Both sides are brute force, so the loss is the compression's alone, not HNSW's.
+    """
+    doc_vectors = np.asarray(doc_vectors, dtype=np.float32)
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    exact = brute_force_topk(doc_vectors, query_vectors, k, space)
+    approx = brute_force_topk(projection.compress(doc_vectors), projection.compress(query_vectors), k, space)
+    return {
+        "method": projection.method,
+        "dim": projection.dim,
+        "storage": projection.storage,
+        "recall": recall_at_k(approx.tolist(), exact.tolist()),
+        "explained_variance": projection.explained_variance,
+        "bytes_per_vector": projection.bytes_per_vector(),
+        "original_bytes_per_vector": doc_vectors.shape[1] * 4,
+    }
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":
+    from hnsw_tuning import load_collection_vectors, split_queries
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chroma-dir", help="read embeddings from an existing (uncompressed) Chroma store")
+    parser.add_argument("--docs", type=int, default=10000, help="synthetic corpus size without --chroma-dir")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--space", default="cosine", choices=["cosine", "l2", "ip"])
+    parser.add_argument("--method", default="pca", choices=METHODS)
+    parser.add_argument("--dims", type=_int_list, default=[64, 128, 192])
+    parser.add_argument("--storage", type=lambda value: value.split(","), default=list(STORAGE_DTYPES))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", help="write the fitted projection (one --dims and --storage value) here")
+    parser.add_argument("--out")
+    args = parser.parse_args()
+
+    if args.chroma_dir:
+        ids, vectors = load_collection_vectors(args.chroma_dir)
+    else:
+        from benchmark import HashingEmbedding, generate_tickets
+
+        tickets = list(generate_tickets(args.docs, args.seed))
+        ids = [ticket[0] for ticket in tickets]
+        vectors = np.asarray(HashingEmbedding()([ticket[1] for ticket in tickets]), dtype=np.float32)
+
+    # Queries are held out of the fit as well as the corpus
+    _, corpus_vectors, query_vectors = split_queries(ids, vectors, args.queries, args.seed)
+    results, projection = [], None
+    for dim in args.dims:
+        for storage in args.storage:
+            projection = EmbeddingProjection.fit(corpus_vectors, dim, args.method, storage)
+            result = recall_loss(corpus_vectors, query_vectors, projection, args.k, args.space)
+            logger.info(f"Projection point {result}")
+            results.append(result)
+
+    print(f"{'dim':>5} {'storage':>8} {f'recall@{args.k}':>10} {'bytes':>7} {'of':>6}")
+    for r in results:
+        print(f"{r['dim']:>5} {r['storage']:>8} {r['recall']:>10.3f} {r['bytes_per_vector']:>7} "
+              f"{r['original_bytes_per_vector']:>6}")
+    if args.save:
+        if len(results) != 1:
+            parser.error("--save needs exactly one --dims and one --storage value")
+        projection.save(args.save)
+        print(f"Saved {projection.identifier()} to {args.save}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"k": args.k, "space": args.space, "docs": len(corpus_vectors), "results": results}, f, indent=2)
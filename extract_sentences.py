@@ -1,4 +1,8 @@
+import mmap
+import os
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 def extract_dates_and_messages(processed_list):
     date_message_pairs = []
@@ -62,3 +66,67 @@ def process_text(text):
             processed_parts.append(processed_line)
 
     return processed_parts
+
+
+# Either date format, leftmost match wins
+DATE_PATTERN = re.compile(r'(?P<date>\d{2}/\d{2}/\d{4}|\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}(?:\.\d+)?)')
+WHITESPACE_PATTERN = re.compile(r'\s*\n\s*')
+
+
+def normalize_part(part):
+    """Return (date, message) for one '|' separated part, or None if it has no date."""
+    part = WHITESPACE_PATTERN.sub(' ', part).strip()
+    if not part:
+        return None
+    match = DATE_PATTERN.search(part)
+    if not match:
+        return None
+    # Cut the matched span out instead of replacing every occurrence of the date
+    message = (part[:match.start()] + part[match.end():]).strip().lstrip(':').strip()
+    return match.group('date'), message
+
+
+def _normalize_range(path, start, end):
+    # Ranges end on '|', which is ASCII, so decoding a range never splits a character
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode('utf-8', errors='replace')
+    return [record for record in map(normalize_part, text.split('|')) if record]
+
+
+def _split_ranges(path, range_bytes):
+    """Byte ranges of roughly ``range_bytes`` that end on a '|' record boundary."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            sep = mm.find(b'|', min(start + range_bytes, size))
+            end = size if sep == -1 else sep
+            yield start, end
+            start = end + 1
+
+
+def iter_transcript_records(path, workers=None, range_bytes=8 * 1024 * 1024):
+    """Stream (date, message) records from a large '|' separated export.
+
+    The file is memory mapped and cut into ranges on record boundaries. With
+    ``workers`` > 1 ranges are normalized in separate processes, at most two
+    per worker in flight, and yielded in file order, so memory stays bounded
+    by the range size rather than the file size.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for start, end in _split_ranges(path, range_bytes):
+            yield from _normalize_range(path, start, end)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in _split_ranges(path, range_bytes):
+            pending.append(executor.submit(_normalize_range, path, start, end))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
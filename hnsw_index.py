@@ -0,0 +1,41 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def hnsw_metadata_for(space="cosine", m=16, construction_ef=100, search_ef=10, num_threads=None):
+    """Chroma collection metadata for the HNSW index settings."""
+    metadata = {
+        "hnsw:space": space,
+        "hnsw:M": m,
+        "hnsw:construction_ef": construction_ef,
+        "hnsw:search_ef": search_ef,
+    }
+    if num_threads:
+        metadata["hnsw:num_threads"] = num_threads
+    return metadata
+
+
+def brute_force_topk(doc_vectors, query_vectors, k, space="cosine"):
+    """Exact top-k document indices per query, using Chroma's distance for ``space``."""
+    if space == "cosine":
+        docs = doc_vectors / np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12)
+        queries = query_vectors / np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), 1e-12)
+        distances = 1 - queries @ docs.T
+    elif space == "ip":
+        distances = 1 - query_vectors @ doc_vectors.T
+    else:
+        distances = (np.square(query_vectors).sum(axis=1)[:, None] - 2 * query_vectors @ doc_vectors.T
+                     + np.square(doc_vectors).sum(axis=1)[None, :])
+    k = min(k, doc_vectors.shape[0])
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall_at_k(approx_ids, exact_ids):
+    """Mean share of the exact neighbours found by the approximate search."""
+    hits = [len(set(approx) & set(exact)) / len(exact) for approx, exact in zip(approx_ids, exact_ids) if len(exact)]
+    return float(np.mean(hits)) if hits else 0.0
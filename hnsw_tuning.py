@@ -0,0 +1,164 @@
+"""Recall@k and latency of Chroma's HNSW index across parameter settings.
+
+    python hnsw_tuning.py --chroma-dir chroma_db --queries 200 --k 10
+    python hnsw_tuning.py --docs 20000            # synthetic corpus from benchmark.py
+
+Every (M, construction_ef) index is built once from the same embeddings and
+queried at each search_ef, scored against exact brute-force neighbours, so the
+output shows what each point costs in build time and query latency for the
+recall it buys.
+"""
+import argparse
+import itertools
+import json
+import logging
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import chromadb
+
+from hnsw_index import brute_force_topk, hnsw_metadata_for, recall_at_k
+
+logger = logging.getLogger(__name__)
+
+
+def build(client, doc_ids, doc_vectors, space, m, construction_ef, search_ef, num_threads=None, batch_size=5000):
+    """Create a collection with the given HNSW settings and add the corpus; returns it with the build time."""
+    name = f"hnsw-tuning-{m}-{construction_ef}"
+    try:
+        client.delete_collection(name)
+    except Exception:
+        pass
+    collection = client.create_collection(
+        name, metadata=hnsw_metadata_for(space, m, construction_ef, search_ef, num_threads))
+
+    start = time.perf_counter()
+    for i in range(0, len(doc_ids), batch_size):
+        collection.add(ids=doc_ids[i:i + batch_size], embeddings=doc_vectors[i:i + batch_size].tolist())
+    return collection, time.perf_counter() - start
+
+
+def set_search_ef(client, collection, search_ef):
+    """Change search_ef of a built collection and return it reopened with the new value.
+
+    chromadb >= 1.0 takes it from the configuration (see rag.py). A loaded index
+    keeps the ef it was loaded with, so the client is reopened to reload it.
+    """
+    configuration = getattr(collection, "configuration", None)
+    if isinstance(configuration, dict) and configuration.get("hnsw"):
+        collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+    else:
+        collection.modify(metadata={**(collection.metadata or {}), "hnsw:search_ef": search_ef})
+    client.clear_system_cache()
+    client = chromadb.PersistentClient(path=client.get_settings().persist_directory)
+    return client, client.get_collection(collection.name)
+
+
+def evaluate(collection, doc_ids, query_vectors, exact_ids, k):
+    """Recall@k and latency percentiles of ``collection`` at its current search_ef."""
+    latencies, approx_ids = [], []
+    for vector in query_vectors:
+        t0 = time.perf_counter()
+        result = collection.query(query_embeddings=[vector.tolist()], n_results=k, include=[])
+        latencies.append(time.perf_counter() - t0)
+        approx_ids.append(result["ids"][0])
+
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "recall": recall_at_k(approx_ids, [[doc_ids[i] for i in row] for row in exact_ids]),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def tune(doc_ids, doc_vectors, query_vectors, k=10, space="cosine", ms=(8, 16, 32), construction_efs=(100, 200),
+         search_efs=(10, 50, 100, 200), num_threads=None):
+    """Evaluate every combination of the given HNSW parameters and return one result dict per point.
+
+    Each (M, construction_ef) index is built once and queried at every search_ef,
+    so ``build_s`` repeats across the search_ef points of one build.
+    """
+    doc_vectors = np.asarray(doc_vectors, dtype=np.float32)
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    exact_ids = brute_force_topk(doc_vectors, query_vectors, k, space)
+
+    # Persistent, so a collection can be reopened after each search_ef change
+    directory = tempfile.mkdtemp(prefix="hnsw-tuning-")
+    client = chromadb.PersistentClient(path=directory)
+    results = []
+    try:
+        for m, construction_ef in itertools.product(ms, construction_efs):
+            collection, build_seconds = build(client, doc_ids, doc_vectors, space, m, construction_ef,
+                                              search_efs[0], num_threads)
+            try:
+                for i, search_ef in enumerate(search_efs):
+                    if i:
+                        client, collection = set_search_ef(client, collection, search_ef)
+                    result = {"M": m, "construction_ef": construction_ef, "search_ef": search_ef,
+                              **evaluate(collection, doc_ids, query_vectors, exact_ids, k), "build_s": build_seconds}
+                    logger.info(f"HNSW point {result}")
+                    results.append(result)
+            finally:
+                client.delete_collection(collection.name)
+    finally:
+        client.clear_system_cache()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def load_collection_vectors(chroma_dir, collection_name="coles"):
+    client = chromadb.PersistentClient(path=chroma_dir)
+    data = client.get_collection(collection_name).get(include=["embeddings"])
+    return data["ids"], np.asarray(data["embeddings"], dtype=np.float32)
+
+
+def split_queries(ids, vectors, n_queries, seed):
+    """Hold out ``n_queries`` stored vectors as queries so they aren't their own nearest neighbour."""
+    rng = np.random.default_rng(seed)
+    held_out = np.zeros(len(ids), dtype=bool)
+    held_out[rng.choice(len(ids), size=min(n_queries, len(ids) // 2), replace=False)] = True
+    corpus_ids = [doc_id for doc_id, flag in zip(ids, held_out) if not flag]
+    return corpus_ids, vectors[~held_out], vectors[held_out]
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chroma-dir", help="read embeddings from an existing Chroma store")
+    parser.add_argument("--docs", type=int, default=10000, help="synthetic corpus size without --chroma-dir")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--space", default="cosine", choices=["cosine", "l2", "ip"])
+    parser.add_argument("--m", type=_int_list, default=[8, 16, 32])
+    parser.add_argument("--construction-ef", type=_int_list, default=[100, 200])
+    parser.add_argument("--search-ef", type=_int_list, default=[10, 50, 100, 200])
+    parser.add_argument("--num-threads", type=int)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out")
+    args = parser.parse_args()
+
+    if args.chroma_dir:
+        ids, vectors = load_collection_vectors(args.chroma_dir)
+    else:
+        from benchmark import HashingEmbedding, generate_tickets
+
+        tickets = list(generate_tickets(args.docs, args.seed))
+        ids = [ticket[0] for ticket in tickets]
+        vectors = np.asarray(HashingEmbedding()([ticket[1] for ticket in tickets]), dtype=np.float32)
+
+    corpus_ids, corpus_vectors, query_vectors = split_queries(ids, vectors, args.queries, args.seed)
+    results = tune(corpus_ids, corpus_vectors, query_vectors, args.k, args.space, args.m, args.construction_ef,
+                   args.search_ef, args.num_threads)
+
+    print(f"{'M':>4} {'c_ef':>5} {'s_ef':>5} {f'recall@{args.k}':>10} {'p50 ms':>8} {'p99 ms':>8} {'build s':>8}")
+    for r in results:
+        print(f"{r['M']:>4} {r['construction_ef']:>5} {r['search_ef']:>5} {r['recall']:>10.3f} "
+              f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['build_s']:>8.2f}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"k": args.k, "space": args.space, "docs": len(corpus_ids), "results": results}, f, indent=2)
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+STORES = ("clusters", "whoosh", "chroma", "rollup")
+
+
+class IngestLog:
+    """Append-only JSON-lines journal of ingestion batches.
+
+    ``begin`` writes the whole batch and fsyncs it before any store is
+    touched; ``checkpoint`` records each store that has committed the batch.
+    A batch is finished once every store in ``stores`` has checkpointed it,
+    so after a crash ``pending`` lists exactly the batches (and, per batch,
+    the stores) that still need to be replayed. Each failed attempt at a
+    batch is recorded with ``fail``; after ``max_attempts`` of them, or one
+    permanent failure, the batch is moved to the dead-letter file
+    (``<path>.dead``) and is no longer pending. Once nothing is in flight and
+    the file has grown past ``max_bytes`` it is truncated.
+    """
+
+    def __init__(self, path: str, stores: Iterable[str] = STORES, max_bytes: int = 64 * 1024 * 1024,
+                 max_attempts: int = 3):
+        self.path = path
+        self.dead_letter_path = f"{path}.dead"
+        self.stores = tuple(stores)
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._batches, self._done, self._attempts = self._read()
+        self._next_id = max(self._batches, default=0) + 1
+        # Finished and dead-lettered batches don't need their payload in memory
+        for batch_id in [b for b, done in self._done.items()
+                         if self._finished(done) or (b in self._attempts and self._attempts[b] is None)]:
+            del self._batches[batch_id], self._done[batch_id]
+            self._attempts.pop(batch_id, None)
+        self._drop_torn_tail()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _drop_torn_tail(self):
+        # Cut a partial last line so the next entry starts on a line of its own
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                start = max(pos - 65536, 0)
+                f.seek(start)
+                chunk = f.read(pos - start)
+                if pos == end and chunk.endswith(b"\n"):
+                    return
+                cut = chunk.rfind(b"\n")
+                if cut >= 0:
+                    f.truncate(start + cut + 1)
+                    return
+                pos = start
+            f.truncate(0)
+
+    def _read(self) -> Tuple[Dict[int, dict], Dict[int, set], Dict[int, int]]:
+        batches, done, attempts = {}, {}, {}
+        if not os.path.exists(self.path):
+            return batches, done, attempts
+        with open(self.path, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-write; its batch was never started
+                    logger.warning(f"Skipping unreadable line {line_no} of ingest log {self.path}")
+                    continue
+                if entry["op"] == "begin":
+                    batches[entry["batch"]] = entry["docs"]
+                    done[entry["batch"]] = set()
+                elif entry["op"] == "checkpoint" and entry["batch"] in done:
+                    done[entry["batch"]].add(entry["store"])
+                elif entry["op"] == "fail" and entry["batch"] in done:
+                    attempts[entry["batch"]] = attempts.get(entry["batch"], 0) + 1
+                elif entry["op"] == "dead" and entry["batch"] in done:
+                    attempts[entry["batch"]] = None
+        return batches, done, attempts
+
+    def _finished(self, done):
+        return all(store in done for store in self.stores)
+
+    def _append(self, entry, sync=False):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def begin(self, docs: dict) -> int:
+        with self._lock:
+            batch_id = self._next_id
+            self._next_id += 1
+            self._append({"op": "begin", "batch": batch_id, "docs": docs}, sync=True)
+            self._batches[batch_id] = docs
+            self._done[batch_id] = set()
+            return batch_id
+
+    def checkpoint(self, batch_id: int, store: str):
+        with self._lock:
+            # Checkpoints aren't fsynced: losing one only means replaying an idempotent write
+            self._append({"op": "checkpoint", "batch": batch_id, "store": store})
+            done = self._done.get(batch_id)
+            if done is None:
+                return
+            done.add(store)
+            if self._finished(done):
+                self._forget(batch_id)
+
+    def _forget(self, batch_id):
+        del self._done[batch_id]
+        self._batches.pop(batch_id, None)
+        self._attempts.pop(batch_id, None)
+        self._truncate_if_idle()
+
+    def pending(self) -> List[Tuple[int, dict, set]]:
+        """(batch id, batch, stores already done) for every unfinished batch, including those in flight."""
+        with self._lock:
+            return [(batch_id, docs, set(self._done[batch_id])) for batch_id, docs in sorted(self._batches.items())]
+
+    def batch(self, batch_id: int) -> dict:
+        """The docs of an unfinished batch."""
+        with self._lock:
+            return self._batches[batch_id]
+
+    def done(self, batch_id: int) -> set:
+        """The stores that have checkpointed an unfinished batch."""
+        with self._lock:
+            return set(self._done.get(batch_id, ()))
+
+    def fail(self, batch_id: int, error: BaseException, permanent: bool = False) -> bool:
+        """Record a failed attempt at a begun batch; returns True if it was dead-lettered.
+
+        A permanent failure, or the ``max_attempts``-th one, moves the batch
+        with its error and finished stores to the dead-letter file.
+        """
+        with self._lock:
+            if batch_id not in self._done:
+                return False
+            self._append({"op": "fail", "batch": batch_id, "error": repr(error)})
+            self._attempts[batch_id] = self._attempts.get(batch_id, 0) + 1
+            if not permanent and self._attempts[batch_id] < self.max_attempts:
+                return False
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"batch": batch_id, "error": repr(error), "attempts": self._attempts[batch_id],
+                                    "done": sorted(self._done[batch_id]), "docs": self._batches[batch_id]},
+                                   separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._append({"op": "dead", "batch": batch_id}, sync=True)
+            logger.error(f"Ingest batch {batch_id} ({len(self._batches[batch_id]['doc_ids'])} docs) moved to "
+                         f"{self.dead_letter_path} on failed attempt {self._attempts[batch_id]}: {error!r}")
+            self._forget(batch_id)
+            return True
+
+    def dead_letters(self) -> List[dict]:
+        """Every dead-lettered batch: its id, error, attempts, the stores it reached and its docs."""
+        if not os.path.exists(self.dead_letter_path):
+            return []
+        with open(self.dead_letter_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _truncate_if_idle(self):
+        if self._done or self._file.tell() < self.max_bytes:
+            return
+        self._file.truncate(0)
+        self._file.seek(0)
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,100 @@
+import logging
+from datetime import datetime
+
+from whoosh.query import And, DateRange, Not, Or, Term
+
+logger = logging.getLogger(__name__)
+
+# Chroma metadata keys that RAGApplication also indexes in Whoosh. "id" isn't one: Whoosh's id is
+# always the document id, while custom metadata may carry an "id" of its own.
+TERM_FIELDS = {"category", "project", "escalated", "resolved"}
+KEYWORD_FIELDS = {"groupID", "tag"}
+
+
+class UnsupportedFilter(Exception):
+    pass
+
+
+def term_text(value):
+    """How a metadata value is indexed in Whoosh; booleans become "true"/"false"."""
+    return str(value).lower() if isinstance(value, bool) else str(value)
+
+
+def _equals(field, value):
+    if field in TERM_FIELDS | KEYWORD_FIELDS and not isinstance(value, (str, bool)):
+        # Chroma compares numbers numerically (1 == 1.0); indexed text can't
+        raise UnsupportedFilter(f"non-string value {value!r} for {field}")
+    if field in TERM_FIELDS:
+        return Term(field, term_text(value))
+    if field in KEYWORD_FIELDS:
+        # The Chroma value is the whole "A-Team, B" string; Whoosh has one term per group
+        items = [item.strip() for item in str(value).split(",") if item.strip()]
+        return And([Term(field, item) for item in items]) if len(items) > 1 else Term(field, items[0] if items else "")
+    if field == "timestamp":
+        moment = datetime.fromtimestamp(value)
+        return DateRange("timestamp", moment, moment)
+    raise UnsupportedFilter(f"{field} is not indexed in Whoosh")
+
+
+def _field_condition(field, condition):
+    if not isinstance(condition, dict):
+        return _equals(field, condition)
+    parts = []
+    for op, value in condition.items():
+        if op in ("$ne", "$nin") and field in KEYWORD_FIELDS:
+            # Keyword equality only over-approximates Chroma's, so its negation would drop matches
+            raise UnsupportedFilter(f"{op} on {field} can't be expressed in Whoosh")
+        if op == "$eq":
+            parts.append(_equals(field, value))
+        elif op == "$ne":
+            parts.append(Not(_equals(field, value)))
+        elif op == "$in":
+            parts.append(Or([_equals(field, item) for item in value]))
+        elif op == "$nin":
+            parts.append(Not(Or([_equals(field, item) for item in value])))
+        elif op in ("$gt", "$gte", "$lt", "$lte") and field == "timestamp":
+            moment = datetime.fromtimestamp(value)
+            if op in ("$gt", "$gte"):
+                parts.append(DateRange("timestamp", moment, None, startexcl=op == "$gt"))
+            else:
+                parts.append(DateRange("timestamp", None, moment, endexcl=op == "$lt"))
+        else:
+            raise UnsupportedFilter(f"{op} on {field} can't be expressed in Whoosh")
+    return parts[0] if len(parts) == 1 else And(parts)
+
+
+def _translate(clause):
+    parts = []
+    for key, value in clause.items():
+        if key == "$and":
+            # Conditions Whoosh can't express are left to Chroma; the rest still narrow the lexical side
+            translated = []
+            for sub in value:
+                try:
+                    translated.append(_translate(sub))
+                except UnsupportedFilter as e:
+                    logger.debug(f"Not pushed down to Whoosh: {sub} ({e})")
+            if not translated:
+                raise UnsupportedFilter(f"no part of {clause} can be expressed in Whoosh")
+            parts.append(And(translated) if len(translated) > 1 else translated[0])
+        elif key == "$or":
+            parts.append(Or([_translate(sub) for sub in value]))
+        else:
+            parts.append(_field_condition(key, value))
+    return parts[0] if len(parts) == 1 else And(parts)
+
+
+def where_to_whoosh(clause):
+    """Translate a Chroma ``where`` clause into a Whoosh filter query, or None if it can't be.
+
+    The result matches at least every document the clause matches; for
+    ``groupID`` equality it matches documents holding all the listed groups,
+    where Chroma compares the whole string.
+    """
+    if not clause:
+        return None
+    try:
+        return _translate(clause)
+    except UnsupportedFilter as e:
+        logger.debug(f"Filter {clause} not pushed down to Whoosh: {e}")
+        return None
@@ -0,0 +1,286 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+DIGITS_PATTERN = re.compile(r"\d+")
+
+# Mersenne prime for the universal hash family of the MinHash permutations
+_PRIME = np.uint64((1 << 61) - 1)
+
+
+class NearDuplicateIndex:
+    """MinHash signatures in an LSH index, grouping near-identical tickets into clusters.
+
+    Each cluster has one representative, the first ticket seen (its oldest
+    member once that is deleted), which is the only one embedded and indexed. Later tickets whose estimated
+    Jaccard similarity to it (over word shingles, with digits masked so
+    templated alerts line up) reaches ``threshold`` become members.
+    Tickets only cluster within their scope (the project, in
+    ``RAGApplication``). Members' ids, contents, timestamps and metadata,
+    and the representatives' signatures and scopes, are kept in SQLite; the
+    LSH buckets are rebuilt from the signatures on start.
+
+    ``assign`` only computes an assignment; ``record`` adds it to the LSH
+    and persists it, so it can run as a checkpointed ingest step and an
+    assignment whose batch is never written leaves no trace.
+    """
+
+    def __init__(self, db_path: str = "near_duplicates.db", threshold: float = 0.8, num_perm: int = 64,
+                 bands: int = 16, shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.db_path = db_path
+        self.seed = seed
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS Representatives(
+            id text PRIMARY KEY,
+            signature blob,
+            scope text DEFAULT '')""")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS Members(
+            id text PRIMARY KEY,
+            rep_id text,
+            content text,
+            ts real,
+            metadata text)""")
+        # Databases from before scopes and member metadata
+        for table, column in (("Representatives", "scope text DEFAULT ''"), ("Members", "metadata text")):
+            if column.split()[0] not in {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_members_rep ON Members(rep_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_members_ts ON Members(ts)")
+        self._conn.commit()
+
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._scopes: Dict[str, str] = {}
+        self._buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(bands)]
+        self._member_of: Dict[str, str] = {}
+        for rep_id, blob, scope in self._conn.execute("SELECT id, signature, scope FROM Representatives"):
+            self._insert(rep_id, np.frombuffer(blob, dtype=np.uint32), scope)
+        self._member_of = dict(self._conn.execute("SELECT id, rep_id FROM Members"))
+
+    def shingles(self, text: str) -> List[str]:
+        tokens = TOKEN_PATTERN.findall(DIGITS_PATTERN.sub("0", text.lower()))
+        if len(tokens) <= self.shingle_size:
+            return [" ".join(tokens)]
+        return [" ".join(tokens[i:i + self.shingle_size]) for i in range(len(tokens) - self.shingle_size + 1)]
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in set(self.shingles(text))), dtype=np.uint64)
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME
+        return (permuted.min(axis=1) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+    def _band_keys(self, signature, scope=""):
+        # Keys are prefixed with the scope, so tickets of different scopes never share a bucket
+        prefix = scope.encode() + b"\0"
+        return [prefix + signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    @staticmethod
+    def _add_to_buckets(buckets, rep_id, keys):
+        for bucket, key in zip(buckets, keys):
+            bucket.setdefault(key, []).append(rep_id)
+
+    def _insert(self, rep_id, signature, scope=""):
+        self._signatures[rep_id] = signature
+        self._scopes[rep_id] = scope
+        self._add_to_buckets(self._buckets, rep_id, self._band_keys(signature, scope))
+
+    def _best_match(self, keys, signature, pending=None):
+        """Closest representative in the LSH, or among ``pending`` (buckets, signatures) not inserted yet."""
+        sources = [(self._buckets, self._signatures)] + ([pending] if pending else [])
+        best, best_score = None, self.threshold
+        for buckets, signatures in sources:
+            for rep_id in {rep_id for bucket, key in zip(buckets, keys) for rep_id in bucket.get(key, ())}:
+                score = float(np.mean(signatures[rep_id] == signature))
+                if score >= best_score:
+                    best, best_score = rep_id, score
+        return best
+
+    def assign(self, doc_ids: List[str], contents: List[str], scopes: Optional[List[str]] = None) -> List[str]:
+        """Representative id for each document; a document that starts a new cluster is its own.
+
+        Nothing is changed until ``record``; documents of the batch can still join clusters started earlier in it.
+        """
+        scopes = scopes or [""] * len(doc_ids)
+        representatives = []
+        pending = ([{} for _ in range(self.bands)], {})
+        with self._lock:
+            for doc_id, content, scope in zip(doc_ids, contents, scopes):
+                if doc_id in self._signatures or doc_id in pending[1]:
+                    representatives.append(doc_id)
+                    continue
+                if doc_id in self._member_of:
+                    representatives.append(self._member_of[doc_id])
+                    continue
+                signature = self.signature(content)
+                keys = self._band_keys(signature, scope)
+                rep_id = self._best_match(keys, signature, pending)
+                if rep_id is None:
+                    self._add_to_buckets(pending[0], doc_id, keys)
+                    pending[1][doc_id] = signature
+                    rep_id = doc_id
+                representatives.append(rep_id)
+        return representatives
+
+    def record(self, doc_ids: List[str], representatives: List[str], contents: List[str], timestamps: List[float],
+               scopes: Optional[List[str]] = None, metadatas: Optional[List[dict]] = None):
+        """Add an ``assign`` result to the LSH and persist it, with each member's metadata; safe to repeat."""
+        scopes = scopes or [""] * len(doc_ids)
+        metadatas = metadatas or [None] * len(doc_ids)
+        with self._lock:
+            for doc_id, rep_id, content, ts, scope, metadata in zip(doc_ids, representatives, contents, timestamps,
+                                                                    scopes, metadatas):
+                if doc_id == rep_id:
+                    signature = self._signatures.get(doc_id)
+                    if signature is None:
+                        signature = self.signature(content)
+                        self._insert(doc_id, signature, scope)
+                    self._conn.execute("INSERT OR REPLACE INTO Representatives VALUES (?, ?, ?)",
+                                       (doc_id, signature.tobytes(), self._scopes[doc_id]))
+                else:
+                    self._member_of[doc_id] = rep_id
+                    self._conn.execute("INSERT OR REPLACE INTO Members VALUES (?, ?, ?, ?, ?)",
+                                       (doc_id, rep_id, content, ts,
+                                        json.dumps(metadata) if metadata is not None else None))
+            self._conn.commit()
+
+    def members(self, rep_ids: Iterable[str]) -> Dict[str, List[tuple]]:
+        """{representative: [(member id, content, timestamp), ...]} in ingestion order."""
+        rep_ids = list(rep_ids)
+        result = {rep_id: [] for rep_id in rep_ids}
+        with self._lock:
+            for i in range(0, len(rep_ids), 500):
+                chunk = rep_ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT rep_id, id, content, ts FROM Members WHERE rep_id IN ({','.join('?' * len(chunk))}) "
+                    f"ORDER BY rowid", chunk)
+                for rep_id, member_id, content, ts in rows:
+                    result[rep_id].append((member_id, content, ts))
+        return result
+
+    def contents(self, doc_ids: Iterable[str]) -> Dict[str, str]:
+        """{member id: content} for the ids that are cluster members."""
+        doc_ids = list(doc_ids)
+        contents = {}
+        with self._lock:
+            for i in range(0, len(doc_ids), 500):
+                chunk = doc_ids[i:i + 500]
+                contents.update(self._conn.execute(
+                    f"SELECT id, content FROM Members WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+        return contents
+
+    def cluster_metadata(self, rep_ids: Iterable[str]) -> Dict[str, dict]:
+        """Chroma metadata for representatives: cluster size (members + 1) and member ids as JSON."""
+        return {rep_id: {"cluster_size": len(members) + 1,
+                         "cluster_members": json.dumps([member[0] for member in members])}
+                for rep_id, members in self.members(rep_ids).items()}
+
+    def is_representative(self, doc_id: str) -> bool:
+        return doc_id in self._signatures
+
+    def contains(self, doc_id: str) -> bool:
+        return doc_id in self._signatures or doc_id in self._member_of
+
+    def discard(self, doc_ids: Iterable[str]):
+        """Undo ``record`` for documents whose batch was never fully written; no member is promoted."""
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in self._signatures:
+                    self._drop_signature(doc_id)
+                    self._conn.execute("DELETE FROM Representatives WHERE id=?", (doc_id,))
+                elif self._member_of.pop(doc_id, None) is not None:
+                    self._conn.execute("DELETE FROM Members WHERE id=?", (doc_id,))
+            self._conn.commit()
+
+    def member_ids(self) -> set:
+        with self._lock:
+            return set(self._member_of)
+
+    def members_before(self, timestamp: float) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM Members WHERE ts < ?", (timestamp,))]
+
+    def _drop_signature(self, rep_id):
+        signature = self._signatures.pop(rep_id)
+        for bucket, key in zip(self._buckets, self._band_keys(signature, self._scopes.pop(rep_id))):
+            ids = bucket.get(key, [])
+            if rep_id in ids:
+                ids.remove(rep_id)
+
+    def remove(self, doc_ids: Iterable[str]) -> Tuple[Dict[str, str], Dict[str, tuple]]:
+        """Forget documents; a removed representative hands its cluster to its oldest member.
+
+        Returns ({removed member id: representative}, {promoted member id:
+        (removed representative, content, timestamp, metadata)}), where
+        metadata is what ``record`` stored for the member, or None. Promoted
+        members are representatives from then on and need indexing in their
+        predecessor's place; the rest of the cluster moves to them as is.
+        """
+        removed_members, promoted = {}, {}
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in self._signatures:
+                    scope = self._scopes[doc_id]
+                    self._drop_signature(doc_id)
+                    self._conn.execute("DELETE FROM Representatives WHERE id=?", (doc_id,))
+                    oldest = self._conn.execute("SELECT id, content, ts, metadata FROM Members WHERE rep_id=? "
+                                                "ORDER BY ts, rowid LIMIT 1", (doc_id,)).fetchone()
+                    # A member promoted earlier in this call points back at the indexed representative
+                    predecessor = promoted.pop(doc_id, (doc_id,))[0]
+                    if oldest is None:
+                        continue
+                    new_rep, content, ts, metadata = oldest
+                    signature = self.signature(content)
+                    self._insert(new_rep, signature, scope)
+                    self._conn.execute("INSERT OR REPLACE INTO Representatives VALUES (?, ?, ?)",
+                                       (new_rep, signature.tobytes(), scope))
+                    self._conn.execute("DELETE FROM Members WHERE id=?", (new_rep,))
+                    self._member_of.pop(new_rep, None)
+                    for (member_id,) in self._conn.execute("SELECT id FROM Members WHERE rep_id=?", (doc_id,)):
+                        self._member_of[member_id] = new_rep
+                    self._conn.execute("UPDATE Members SET rep_id=? WHERE rep_id=?", (new_rep, doc_id))
+                    promoted[new_rep] = (predecessor, content, ts, json.loads(metadata) if metadata else None)
+                elif doc_id in self._member_of:
+                    removed_members[doc_id] = self._member_of.pop(doc_id)
+                    self._conn.execute("DELETE FROM Members WHERE id=?", (doc_id,))
+            self._conn.commit()
+        return removed_members, promoted
+
+    def settings(self) -> dict:
+        """Constructor arguments besides the path; signatures only compare under the same ones."""
+        return {"threshold": self.threshold, "num_perm": self.num_perm, "bands": self.bands,
+                "shingle_size": self.shingle_size, "seed": self.seed}
+
+    def backup(self, path: str):
+        """Consistent copy of the near-duplicate database at ``path``."""
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self._conn.backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, zip_longest
+from typing import Dict, List, Optional
+
+from near_duplicates import NearDuplicateIndex
+from rag import RAGApplication
+from rollup import RollupStore
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = re.compile(r"[^a-zA-Z0-9._-]")
+
+
+def _as_list(value, n):
+    return value if isinstance(value, list) else [value] * n
+
+
+class PartitionedRAGApplication:
+    """Routes each project, or group of projects, to its own Whoosh index and Chroma collection.
+
+    ``partitions`` maps project -> partition name; projects that aren't listed
+    get a partition of their own. On disk every partition has an index under
+    ``base_dir/whoosh/<partition>`` and a collection ``coles-<partition>`` in
+    the shared Chroma store, while the summary rollups stay in one store so
+    ``summarize`` still covers every project.
+
+    Searches scoped with ``projects`` only open the partitions those projects
+    live in; unscoped searches fan out to every partition and merge.
+
+    Partition names are sanitized for the file system; the name each
+    sanitized one was first written under is kept in
+    ``base_dir/partitions.json``, and ingesting under another name that
+    sanitizes the same way raises ValueError instead of mixing the two.
+
+    With ``journal`` each partition keeps an ingest log under
+    ``base_dir/ingest``; partitions with unfinished batches are opened, and
+    so replayed, on start.
+
+    ``near_duplicates`` (``NearDuplicateIndex`` arguments, e.g.
+    ``{"threshold": 0.8}``) gives each partition its own near-duplicate
+    index under ``base_dir/near_duplicates``, so a cluster and the
+    members promoted from it stay in the partition they were ingested in.
+    """
+
+    def __init__(self, base_dir: str = "rag_partitions",
+                 embeddings_model=None,
+                 partitions: Optional[Dict[str, str]] = None,
+                 max_workers: Optional[int] = None,
+                 journal: bool = False,
+                 near_duplicates: Optional[dict] = None,
+                 **app_kwargs):
+        if "near_duplicates" in app_kwargs or isinstance(near_duplicates, NearDuplicateIndex):
+            raise ValueError("Partitions can't share a NearDuplicateIndex; pass its arguments as near_duplicates=")
+        self.base_dir = base_dir
+        self.embeddings_model = embeddings_model
+        self.partitions = dict(partitions or {})
+        self.near_duplicates = near_duplicates
+        self.app_kwargs = app_kwargs
+        if near_duplicates is not None:
+            os.makedirs(os.path.join(base_dir, "near_duplicates"), exist_ok=True)
+        os.makedirs(os.path.join(base_dir, "whoosh"), exist_ok=True)
+        self.rollup = RollupStore(os.path.join(base_dir, "rollup.db"))
+        self._names_path = os.path.join(base_dir, "partitions.json")
+        self._names = {}
+        if os.path.exists(self._names_path):
+            with open(self._names_path) as f:
+                self._names = json.load(f)
+        self._apps = {}
+        self._apps_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-partition")
+
+        self.journal = journal
+        if journal:
+            os.makedirs(os.path.join(base_dir, "ingest"), exist_ok=True)
+            for name in self.partition_names():
+                path = self._journal_path(name)
+                if os.path.exists(path) and os.path.getsize(path):
+                    self.partition(name)
+
+    def _journal_path(self, name):
+        return os.path.join(self.base_dir, "ingest", f"{name}.log")
+
+    def partition_for(self, project: str) -> str:
+        return PARTITION_NAME.sub("_", self.partitions.get(project, project or "NA"))
+
+    def _claim_partition(self, project: str) -> str:
+        """``partition_for``, refusing a name that another partition sanitizes to."""
+        label = self.partitions.get(project, project or "NA")
+        name = PARTITION_NAME.sub("_", label)
+        with self._apps_lock:
+            owner = self._names.get(name)
+            if owner is None:
+                self._names[name] = label
+                tmp = self._names_path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self._names, f, indent=2, sort_keys=True)
+                os.replace(tmp, self._names_path)
+            elif owner != label:
+                raise ValueError(f"Partition {label!r} (project {project!r}) and {owner!r} both map to "
+                                 f"{name!r}; give one of them another name in partitions=")
+        return name
+
+    def partition_names(self) -> List[str]:
+        """Every partition that exists on disk or is open."""
+        on_disk = os.listdir(os.path.join(self.base_dir, "whoosh"))
+        return sorted(set(on_disk) | set(self._apps))
+
+    def partition(self, name: str) -> RAGApplication:
+        with self._apps_lock:
+            if name not in self._apps:
+                self._apps[name] = RAGApplication(
+                    index_dir=os.path.join(self.base_dir, "whoosh", name),
+                    chroma_persist_directory=os.path.join(self.base_dir, "chroma"),
+                    embeddings_model=self.embeddings_model,
+                    collection_name=f"coles-{name}",
+                    rollup=self.rollup,
+                    ingest_log=self._journal_path(name) if self.journal else None,
+                    near_duplicates=(NearDuplicateIndex(os.path.join(self.base_dir, "near_duplicates", f"{name}.db"),
+                                                        **self.near_duplicates)
+                                     if self.near_duplicates is not None else None),
+                    **self.app_kwargs)
+            return self._apps[name]
+
+    def add_document(self, doc_id, content, timestamp, category="NA", escalated=False, resolved=False,
+                     project="NA", groupID="NA", custom_metadata=None):
+        """Same arguments as ``RAGApplication.add_document``; each document goes to its project's partition.
+
+        A document re-ingested under another project is not removed from its
+        previous partition.
+        """
+        is_batch = isinstance(doc_id, list)
+        doc_ids = doc_id if is_batch else [doc_id]
+        n = len(doc_ids)
+        columns = {
+            "doc_id": doc_ids,
+            "content": content if is_batch else [content],
+            "timestamp": timestamp if is_batch else [timestamp],
+            "category": _as_list(category, n),
+            "escalated": _as_list(escalated, n),
+            "resolved": _as_list(resolved, n),
+            "project": _as_list(project, n),
+            "groupID": _as_list(groupID, n),
+            "custom_metadata": _as_list(custom_metadata, n),
+        }
+
+        positions = {}
+        names = {proj: self._claim_partition(proj) for proj in dict.fromkeys(columns["project"])}
+        for i, proj in enumerate(columns["project"]):
+            positions.setdefault(names[proj], []).append(i)
+
+        for name, idx in positions.items():
+            batch = {key: [values[i] for i in idx] for key, values in columns.items()}
+            if not any(batch["custom_metadata"]):
+                batch["custom_metadata"] = None
+            with tracer.span("partition_ingest", partition=name, docs=len(idx)):
+                self.partition(name).add_document(**batch)
+
+    def delete_documents(self, doc_ids: List[str]) -> int:
+        # Ids don't record their partition, so every partition is asked; unknown ids are ignored
+        return sum(self.partition(name).delete_documents(doc_ids) for name in self.partition_names())
+
+    def purge_before(self, timestamp: float) -> int:
+        return sum(self.partition(name).purge_before(timestamp) for name in self.partition_names())
+
+    def compact(self, queries: Optional[List[str]] = None, rebuild_vectors: bool = True) -> dict:
+        """``RAGApplication.compact`` on every partition, reported per partition."""
+        return {name: self.partition(name).compact(queries, rebuild_vectors) for name in self.partition_names()}
+
+    def check_consistency(self, sample: int = 10) -> dict:
+        """Whoosh vs Chroma ids per partition, and every indexed id vs the shared rollups."""
+        report, indexed = {"partitions": {}}, set()
+        for name in self.partition_names():
+            app = self.partition(name)
+            whoosh_ids, chroma_ids = app._whoosh_ids(), app._chroma_ids()
+            indexed |= whoosh_ids | chroma_ids
+            report["partitions"][name] = {
+                "whoosh": len(whoosh_ids),
+                "chroma": len(chroma_ids),
+                "only_whoosh": sorted(whoosh_ids - chroma_ids)[:sample],
+                "only_chroma": sorted(chroma_ids - whoosh_ids)[:sample],
+            }
+        rollup_ids = self.rollup.doc_ids()
+        for app in self._apps.values():
+            if app.near_duplicates is not None:
+                # Cluster members are only in the rollups by design
+                rollup_ids -= app.near_duplicates.member_ids()
+        report["rollup_missing"] = sorted(indexed - rollup_ids)[:sample]
+        report["rollup_extra"] = sorted(rollup_ids - indexed)[:sample]
+        report["consistent"] = not (report["rollup_missing"] or report["rollup_extra"] or any(
+            part["only_whoosh"] or part["only_chroma"] for part in report["partitions"].values()))
+        return report
+
+    def summarize(self, start_date=None, end_date=None, categories=None, group_ids=None, tags=None):
+        with tracer.span("summary_rollup"):
+            return self.rollup.summary(start_date, end_date, categories, group_ids, tags)
+
+    def _targets(self, projects):
+        """Partitions to search, with the projects to keep from each (None keeps all)."""
+        if not projects:
+            return {name: None for name in self.partition_names()}
+        existing = set(self.partition_names())
+        targets = {}
+        for project in projects:
+            targets.setdefault(self.partition_for(project), set()).add(project)
+        return {name: wanted for name, wanted in targets.items() if name in existing}
+
+    def _needs_project_filter(self, name, wanted):
+        # A partition shared by a group of projects also holds projects the query didn't ask for
+        if wanted is None:
+            return False
+        grouped = {project for project, partition in self.partitions.items()
+                   if PARTITION_NAME.sub("_", partition) == name}
+        return bool(grouped - wanted)
+
+    @staticmethod
+    def _project_clause(wanted, start_date, end_date, clause):
+        # An explicit clause replaces the date filter in RAGApplication.search, so the dates are restated here
+        conditions = [{"project": {"$in": sorted(wanted)}}]
+        if clause:
+            conditions.append(clause)
+        elif start_date and end_date:
+            conditions += [{"timestamp": {"$gte": start_date}}, {"timestamp": {"$lte": end_date}}]
+        # Chroma rejects an $and of a single condition
+        return {"$and": conditions} if len(conditions) > 1 else conditions[0]
+
+    def search(self, query=None, start_date=None, end_date=None, bm_percentile=.9, vector_match_threshold=.2,
+               clause=None, top_k=None, return_records=False, facets=None, projects: Optional[List[str]] = None):
+        """``RAGApplication.search`` over the partitions holding ``projects`` (every partition when None).
+
+        In a partition shared by a group of projects both engines are
+        filtered to the requested projects. The first two elements become
+        ``{partition: results}`` dicts. Vector matches from all partitions
+        are merged by distance and cut to ``top_k``; lexical-only matches
+        follow, interleaved partition by partition. Facet counts are summed.
+        """
+        targets = self._targets(projects)
+
+        def run(name, wanted):
+            partition_clause = clause
+            if self._needs_project_filter(name, wanted):
+                partition_clause = self._project_clause(wanted, start_date, end_date, clause)
+            with tracer.span("partition_search", partition=name):
+                return self.partition(name).search(query, start_date, end_date, bm_percentile,
+                                                   vector_match_threshold, partition_clause, top_k,
+                                                   return_records, facets)
+
+        with tracer.span("search_fanout", partitions=len(targets)):
+            futures = {name: self._executor.submit(run, name, wanted) for name, wanted in targets.items()}
+            outputs = {name: future.result() for name, future in futures.items()}
+            return self._merge(outputs, query, vector_match_threshold, top_k, facets)
+
+    @staticmethod
+    def _merge(outputs, query, vector_match_threshold, top_k, facets):
+        whoosh_results = {name: output[0] for name, output in outputs.items()}
+        chroma_results = {name: output[1] for name, output in outputs.items()}
+
+        vector_hits, lexical_hits = [], []
+        for name, output in outputs.items():
+            results, chroma = output[2], output[1]
+            # RAGApplication.search lists its vector matches first: each distinct document
+            # within the threshold once, in ascending distance order
+            matches = {}
+            if query and chroma.get("distances"):
+                for doc_id, document, distance in zip(chroma["ids"][0], chroma["documents"][0],
+                                                      chroma["distances"][0]):
+                    if distance <= vector_match_threshold and document not in matches:
+                        matches[document] = (distance, doc_id)
+            vector_hits.extend((distance, doc_id, result)
+                               for (distance, doc_id), result in zip(matches.values(), results))
+            lexical_hits.append(results[len(matches):])
+
+        vector_hits.sort(key=lambda hit: hit[:2])
+        if top_k:
+            vector_hits = vector_hits[:top_k]
+        lexical = [hit for hit in chain.from_iterable(zip_longest(*lexical_hits)) if hit is not None]
+        results = list(dict.fromkeys([hit for _, _, hit in vector_hits] + lexical))
+
+        if facets:
+            facet_counts = {}
+            for output in outputs.values():
+                for facet, counts in output[3].items():
+                    facet_counts.setdefault(facet, Counter()).update(counts)
+            return whoosh_results, chroma_results, results, {facet: dict(counts)
+                                                            for facet, counts in facet_counts.items()}
+        return whoosh_results, chroma_results, results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self.near_duplicates is not None:
+            for app in self._apps.values():
+                app.near_duplicates.close()
+        self.rollup.close()
+
+
+if __name__ == "__main__":
+    from datetime import datetime
+
+    from rag import MyEmbeddingFunction
+
+    rag = PartitionedRAGApplication(embeddings_model=MyEmbeddingFunction(),
+                                    partitions={"stores": "retail", "online": "retail"})
+    rag.add_document(["1", "2", "3"],
+                     ["Serial: 1 Category: Payment issue Issue: Card payments fail at checkout.",
+                      "Serial: 2 Category: Data issue Issue: Supplier feed is missing records.",
+                      "Serial: 3 Category: Access issue Issue: Store staff can't log in."],
+                     [datetime(2024, 1, 5).timestamp(), datetime(2024, 2, 1).timestamp(),
+                      datetime(2024, 2, 9).timestamp()],
+                     project=["online", "supply", "stores"])
+
+    # Only the "retail" partition is searched, filtered to "stores"
+    _, _, scoped = rag.search("log in", projects=["stores"], top_k=5)
+    # Every partition is searched and the results merged
+    _, _, everywhere = rag.search("payments", top_k=5)
+    print(scoped, everywhere, sep="\n")
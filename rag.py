@@ -1,11 +1,17 @@
+import logging
 import os
 import shutil
-from typing import List, Optional
+import tempfile
+import time
+from typing import List, Optional, Union
 from datetime import datetime
+import numpy as np
+from Levenshtein import distance as levenshtein_distance
 from whoosh import index
-from whoosh.fields import Schema, TEXT, ID, DATETIME
+from whoosh.fields import Schema, TEXT, ID, DATETIME, STORED, KEYWORD
+from whoosh import sorting
 from whoosh.qparser import QueryParser
-from whoosh.query import DateRange, Every
+from whoosh.query import DateRange, Every, Or, Term
 import chromadb
 from chromadb.config import Settings, DEFAULT_TENANT, DEFAULT_DATABASE
 from sentence_transformers import SentenceTransformer
@@ -13,44 +19,326 @@ from gensim.models import KeyedVectors
 import nltk
 from nltk.corpus import wordnet
 from nltk.tokenize import word_tokenize
+from tracing import tracer
+from hnsw_index import hnsw_metadata_for
+from data_processing import DataProcessing
+from rollup import RollupStore
+from ingest_log import STORES, IngestLog
+from sparse_bm25 import SparseBM25Index, plain_terms
+from metadata_filter import term_text, where_to_whoosh
+from search_results import SOURCE_CLUSTER, SOURCE_LEXICAL, SOURCE_VECTOR, SearchResults
+from near_duplicates import NearDuplicateIndex
+from embedding_compression import CompressedEmbeddingFunction, EmbeddingProjection
+from sample_new import TicketRecord, parse_ticket
+from snapshot import (PROJECTION, SnapshotError, check_compatibility, export_collection, load_collection,
+                      read_snapshot, remove_path, restore_files, schema_signature, swap_in, verify_counts,
+                      write_snapshot)
 
 nltk.download('punkt')
 nltk.download('wordnet')
 
+logger = logging.getLogger(__name__)
+
 class MyEmbeddingFunction(chromadb.EmbeddingFunction):
-    _MODEL = SentenceTransformer('all-MiniLM-L6-v2', device='mps', trust_remote_code=True)
+    MODEL_NAME = 'all-MiniLM-L6-v2'
+    _MODEL = None
+
+    @classmethod
+    def _model(cls):
+        # Loaded on first use so importing this module doesn't pull the model onto the device
+        if cls._MODEL is None:
+            cls._MODEL = SentenceTransformer(cls.MODEL_NAME, device='mps', trust_remote_code=True)
+        return cls._MODEL
 
     def __call__(self, input: chromadb.Documents) -> chromadb.Embeddings:
-        embeddings = self._MODEL.encode(input)
-        embeddings_as_list = [embedding.tolist() for embedding in embeddings]
+        with tracer.span("embed", texts=len(input)):
+            embeddings = self._model().encode(input)
+            embeddings_as_list = [embedding.tolist() for embedding in embeddings]
         return embeddings_as_list
 
+    def name(self):
+        # Recorded in snapshots so vectors are only restored next to the model that produced them
+        return f"sentence-transformers/{self.MODEL_NAME}"
+
 
 class RAGApplication(DataProcessing):
+    FACETS = {
+        "month": sorting.FieldFacet("month", maptype=sorting.Count),
+        "category": sorting.FieldFacet("category", maptype=sorting.Count),
+        "project": sorting.FieldFacet("project", maptype=sorting.Count),
+        "groupID": sorting.FieldFacet("groupID", allow_overlap=True, maptype=sorting.Count),
+        "tag": sorting.FieldFacet("tag", allow_overlap=True, maptype=sorting.Count),
+        "escalated": sorting.FieldFacet("escalated", maptype=sorting.Count),
+        "resolved": sorting.FieldFacet("resolved", maptype=sorting.Count),
+    }
+    # Errors the stores raise for data they will never accept; retrying such a batch can't help
+    PERMANENT_INGEST_ERRORS = (ValueError, TypeError)
 
     def __init__(self, index_dir: str = "whoosh_index",
                  chroma_persist_directory: str = "chroma_db",
-                 embeddings_model=None):
+                 embeddings_model=None,
+                 rollup_path: str = "rollup.db",
+                 collection_name: str = "coles",
+                 rollup: Optional[RollupStore] = None,
+                 hnsw_space: str = "cosine",
+                 hnsw_m: int = 16,
+                 hnsw_construction_ef: int = 100,
+                 hnsw_search_ef: int = 10,
+                 hnsw_num_threads: Optional[int] = None,
+                 ingest_log: Optional[str] = None,
+                 lexical_backend: str = "whoosh",
+                 sparse_index_dir: Optional[str] = None,
+                 near_duplicates: Optional[NearDuplicateIndex] = None,
+                 embedding_projection: Optional[EmbeddingProjection] = None):
+        """``hnsw_*`` configure Chroma's vector index: distance space ("cosine", "l2" or "ip"),
+        graph degree M, construction ef, search ef and build threads. Space, M and
+        construction ef are fixed when the collection is created; see ``hnsw_tuning.py``
+        for picking them on our data.
+
+        ``collection_name`` and a shared ``rollup`` store let several applications
+        live side by side as partitions of ``PartitionedRAGApplication``.
+
+        With an ``ingest_log`` path every ``add_document`` batch is journaled
+        before it is written, and batches left unfinished by a crash are
+        replayed here, into the stores that missed them. A batch whose writes
+        raise is retried on the spot; one the stores reject outright
+        (``PERMANENT_INGEST_ERRORS``), or that keeps failing, is moved to the
+        log's dead letters and its error raised.
+
+        ``lexical_backend="sparse"`` answers plain-term queries from an
+        in-memory ``SparseBM25Index`` kept next to the Whoosh index in
+        ``sparse_index_dir``; Whoosh still holds the documents and serves
+        facets and query syntax the sparse index can't.
+
+        With a ``near_duplicates`` index, tickets that are near copies of an
+        earlier one are kept as members of its cluster: only the cluster's
+        representative is embedded and indexed, while every ticket still
+        counts in the rollups. See ``search(clusters=...)``.
+
+        An ``embedding_projection`` (see ``embedding_compression.py``) wraps
+        ``embeddings_model`` so documents and queries alike are projected to
+        fewer dimensions and rounded to its storage precision before they
+        reach Chroma. The collection must be empty or built with the same
+        projection; snapshots store the vectors in that precision.
+        """
         self.index_dir = index_dir
         self.chroma_persist_directory = chroma_persist_directory
-        self.schema = Schema(
-            id=ID(stored=True),
-            content=TEXT(stored=True),
-            timestamp=DATETIME(stored=True)
-        )
+        self.embedding_projection = embedding_projection
+        if embedding_projection is not None and embeddings_model is not None:
+            embeddings_model = CompressedEmbeddingFunction(embeddings_model, embedding_projection)
+        self.embeddings_model = embeddings_model
+        self.schema = self.build_schema()
 
         self.whoosh_index = self._create_or_load_whoosh_index()
 
+        if lexical_backend not in ("whoosh", "sparse"):
+            raise ValueError(f"Unknown lexical backend {lexical_backend!r}")
+        self.sparse_index_dir = sparse_index_dir or f"{index_dir}_sparse"
+        self.sparse_index = self._load_sparse_index() if lexical_backend == "sparse" else None
+
         self.chroma_client = chromadb.PersistentClient(
             path=chroma_persist_directory,
             settings=Settings(),
             tenant=DEFAULT_TENANT,
             database=DEFAULT_DATABASE)
 
+        self.hnsw_metadata = self.hnsw_metadata_for(hnsw_space, hnsw_m, hnsw_construction_ef, hnsw_search_ef,
+                                                    hnsw_num_threads)
         self.chroma_collection = self.chroma_client.get_or_create_collection(
-            "coles",
+            collection_name,
             embedding_function=embeddings_model,
-            metadata={"hnsx:space": "cosine"})
+            metadata=self.hnsw_metadata)
+        self._check_hnsw_metadata()
+
+        self.rollup = rollup if rollup is not None else RollupStore(rollup_path)
+        self.near_duplicates = near_duplicates
+
+        self.ingest_log = IngestLog(ingest_log) if ingest_log else None
+        if self.ingest_log is not None:
+            self.replay_ingest_log()
+
+    @staticmethod
+    def build_schema():
+        return Schema(
+            id=ID(stored=True),
+            content=TEXT(stored=True),
+            timestamp=DATETIME(stored=True),
+            # TicketRecord parsed at ingest, as JSON
+            record=STORED,
+            # Metadata columns for facet counts: single values in sortable columns, and the
+            # comma separated lists with term vectors, which overlapping facets read per document
+            month=ID(sortable=True),
+            category=ID(sortable=True),
+            project=ID(sortable=True),
+            groupID=KEYWORD(commas=True, vector=True),
+            tag=KEYWORD(commas=True, vector=True),
+            escalated=ID(sortable=True),
+            resolved=ID(sortable=True)
+        )
+
+    hnsw_metadata_for = staticmethod(hnsw_metadata_for)
+
+    def _check_hnsw_metadata(self):
+        # get_or_create_collection keeps the metadata of an existing collection, so
+        # collections created before the "hnsw:space" fix are still on the default l2 space
+        existing = dict(self.chroma_collection.metadata or {})
+        configuration = getattr(self.chroma_collection, "configuration", None)
+        hnsw = configuration.get("hnsw") if isinstance(configuration, dict) else None
+        if hnsw and hnsw.get("ef_search") is not None:
+            # chromadb >= 1.0 keeps the live settings in the configuration; metadata only records creation
+            existing["hnsw:search_ef"] = hnsw["ef_search"]
+
+        # search_ef, unlike space, M and construction ef, can change on an existing index
+        search_ef = self.hnsw_metadata["hnsw:search_ef"]
+        if existing.get("hnsw:search_ef") != search_ef:
+            if hnsw:
+                self.chroma_collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+            else:
+                self.chroma_collection.modify(metadata={**(self.chroma_collection.metadata or {}),
+                                                        "hnsw:search_ef": search_ef})
+            logger.info(f"Set hnsw:search_ef of Chroma collection '{self.chroma_collection.name}' "
+                        f"from {existing.get('hnsw:search_ef')} to {search_ef}")
+            existing["hnsw:search_ef"] = search_ef
+
+        mismatched = {key: existing.get(key) for key, value in self.hnsw_metadata.items()
+                      if existing.get(key) != value}
+        if mismatched:
+            logger.warning(f"Chroma collection '{self.chroma_collection.name}' was created with {mismatched}, "
+                           f"not the configured {self.hnsw_metadata}; re-create it to apply the new index settings")
+
+    def snapshot(self, path: str) -> dict:
+        """Write both indexes, the raw embedding vectors, the rollups and any near-duplicate
+        database to one versioned tar file."""
+        with tracer.span("snapshot"):
+            return write_snapshot(self, path)
+
+    @classmethod
+    def restore(cls, path: str,
+                index_dir: str = "whoosh_index",
+                chroma_persist_directory: str = "chroma_db",
+                embeddings_model=None,
+                rollup_path: str = "rollup.db",
+                near_duplicates_path: str = "near_duplicates.db",
+                overwrite: bool = False,
+                **params_override) -> "RAGApplication":
+        """Build an application from a snapshot without running the embedding model.
+
+        Checksums, the snapshot format, the Whoosh schema and the embedding
+        model are checked before anything is written. The stores are built
+        next to the target paths and document counts checked there; only then
+        do they replace the targets, so a failed restore leaves them as they were. The vector index is created with
+        the snapshot's collection name and HNSW settings unless overrides are given,
+        and with the snapshot's embedding projection, if it has one. A snapshot of a
+        clustering application restores its near-duplicate database to
+        ``near_duplicates_path`` with the snapshot's clustering settings.
+        """
+        staging = tempfile.mkdtemp(prefix="rag-restore-")
+        try:
+            with tracer.span("restore"):
+                manifest = read_snapshot(path, staging)
+                projection = None
+                if os.path.exists(os.path.join(staging, PROJECTION)):
+                    projection = EmbeddingProjection.load(os.path.join(staging, PROJECTION))
+                    params_override.setdefault("embedding_projection", projection)
+                model = embeddings_model
+                if model is not None and params_override.get("embedding_projection") is not None:
+                    model = CompressedEmbeddingFunction(model, params_override["embedding_projection"])
+                check_compatibility(manifest, cls.build_schema(), model)
+
+                saved = manifest["collection_metadata"] or {}
+                params = dict(collection_name=manifest["collection"],
+                              hnsw_space=saved.get("hnsw:space", "cosine"),
+                              hnsw_m=saved.get("hnsw:M", 16),
+                              hnsw_construction_ef=saved.get("hnsw:construction_ef", 100),
+                              hnsw_search_ef=saved.get("hnsw:search_ef", 10),
+                              hnsw_num_threads=saved.get("hnsw:num_threads"))
+                params.update(params_override)
+                sparse_index_dir = params.pop("sparse_index_dir", None) or f"{index_dir}_sparse"
+                clusters = manifest.get("near_duplicates")
+                if clusters is not None and params.get("near_duplicates") is not None:
+                    raise SnapshotError("The snapshot has its own near-duplicate database; "
+                                        "pass near_duplicates_path instead of a near_duplicates index")
+
+                # A leftover WAL of the old rollup database must not be applied to the restored one
+                targets = (index_dir, chroma_persist_directory, rollup_path, sparse_index_dir,
+                           f"{rollup_path}-wal", f"{rollup_path}-shm")
+                checked = targets[:3]
+                if clusters is not None:
+                    targets += (near_duplicates_path, f"{near_duplicates_path}-wal", f"{near_duplicates_path}-shm")
+                    checked += (near_duplicates_path,)
+                for target in checked:
+                    if os.path.exists(target) and not overwrite:
+                        raise SnapshotError(f"{target} already exists; pass overwrite=True to replace it")
+                # Everything is built and verified next to the live paths, which are only replaced at the end
+                staged = {target: f"{target}.restoring" for target in targets}
+                for path in staged.values():
+                    remove_path(path)
+                try:
+                    restore_files(staging, staged[index_dir], staged[rollup_path],
+                                  staged[near_duplicates_path] if clusters is not None else None)
+                    if clusters is not None:
+                        params["near_duplicates"] = NearDuplicateIndex(staged[near_duplicates_path],
+                                                                       **clusters["settings"])
+                    app = cls(index_dir=staged[index_dir],
+                              chroma_persist_directory=staged[chroma_persist_directory],
+                              embeddings_model=embeddings_model,
+                              rollup_path=staged[rollup_path],
+                              sparse_index_dir=staged[sparse_index_dir],
+                              **params)
+                    try:
+                        load_collection(app.chroma_collection, staging, projection=projection)
+                        verify_counts(manifest, app)
+                    finally:
+                        app.close()
+                        if "rollup" not in params:
+                            app.rollup.close()
+                        if hasattr(app.chroma_client, "close"):
+                            app.chroma_client.close()
+                        if clusters is not None:
+                            app.near_duplicates.close()
+                    swap_in(staged)
+                finally:
+                    for path in staged.values():
+                        remove_path(path)
+
+                if clusters is not None:
+                    params["near_duplicates"] = NearDuplicateIndex(near_duplicates_path, **clusters["settings"])
+                app = cls(index_dir=index_dir,
+                          chroma_persist_directory=chroma_persist_directory,
+                          embeddings_model=embeddings_model,
+                          rollup_path=rollup_path,
+                          sparse_index_dir=sparse_index_dir,
+                          **params)
+            return app
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _load_sparse_index(self):
+        # The saved matrix is only used if it was written for the current Whoosh generation
+        generation = self.whoosh_index.latest_generation()
+        if os.path.exists(os.path.join(self.sparse_index_dir, "meta.json")):
+            try:
+                sparse_index = SparseBM25Index.load(self.sparse_index_dir)
+                if sparse_index.generation == generation:
+                    return sparse_index
+                logger.info(f"Sparse index in {self.sparse_index_dir} is stale "
+                            f"(generation {sparse_index.generation}, Whoosh {generation})")
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not load sparse index from {self.sparse_index_dir}: {e}")
+        with tracer.span("sparse_rebuild"):
+            sparse_index = SparseBM25Index.from_whoosh(self.whoosh_index)
+            sparse_index.save(self.sparse_index_dir, generation)
+        return sparse_index
+
+    def save_sparse_index(self):
+        """Persist the sparse index; without this a restart rebuilds it from Whoosh."""
+        if self.sparse_index is not None:
+            self.sparse_index.save(self.sparse_index_dir, self.whoosh_index.latest_generation())
+
+    def close(self):
+        self.save_sparse_index()
+        if self.ingest_log is not None:
+            self.ingest_log.close()
 
     def _create_or_load_whoosh_index(self):
         if not os.path.exists(self.index_dir):
@@ -58,7 +346,8 @@ class RAGApplication(DataProcessing):
             return index.create_in(self.index_dir, self.schema)
         try:
             idx = index.open_dir(self.index_dir)
-            if idx.schema == self.schema:
+            # Whoosh columns compare by identity, so equal sortable schemas are never ==
+            if schema_signature(idx.schema) == schema_signature(self.schema):
                 return idx
         except:
             pass
@@ -81,62 +370,400 @@ class RAGApplication(DataProcessing):
         # Convert single inputs to lists for batch processing
         is_batch = isinstance(doc_id, list)
         doc_ids = doc_id if is_batch else [doc_id]
-        contents = content if is_batch else [content]
-        timestamps = timestamp if is_batch else [timestamp]
-        categories = category if isinstance(category, list) else [category] * len(doc_ids)
-        escalated_list = escalated if isinstance(escalated, list) else [escalated] * len(doc_ids)
-        resolved_list = resolved if isinstance(resolved, list) else [resolved] * len(doc_ids)
-        projects = project if isinstance(project, list) else [project] * len(doc_ids)
-        groupIDs = groupID if isinstance(groupID, list) else [groupID] * len(doc_ids)
-        metadata_list = custom_metadata if isinstance(custom_metadata, list) else [custom_metadata] * len(doc_ids)
-
-        # Process Whoosh updates
+        batch = dict(
+            doc_ids=doc_ids,
+            contents=content if is_batch else [content],
+            timestamps=timestamp if is_batch else [timestamp],
+            categories=category if isinstance(category, list) else [category] * len(doc_ids),
+            escalated=escalated if isinstance(escalated, list) else [escalated] * len(doc_ids),
+            resolved=resolved if isinstance(resolved, list) else [resolved] * len(doc_ids),
+            projects=project if isinstance(project, list) else [project] * len(doc_ids),
+            groupIDs=groupID if isinstance(groupID, list) else [groupID] * len(doc_ids),
+            custom_metadata=custom_metadata if isinstance(custom_metadata, list) else [custom_metadata] * len(doc_ids)
+        )
+
+        if self.near_duplicates is not None:
+            # Assigned before journaling so a replay indexes the same representatives; nothing
+            # is clustered until _write_clusters records it
+            batch["representatives"] = self.near_duplicates.assign(doc_ids, batch["contents"],
+                                                                   self._cluster_scopes(batch))
+            # Forgotten again if the batch is never written
+            batch["new_cluster_ids"] = [doc_id for doc_id in doc_ids if not self.near_duplicates.contains(doc_id)]
+
+        if self.ingest_log is None:
+            try:
+                self._apply_batch(batch)
+            except Exception:
+                self._discard_clusters(batch)
+                raise
+            return
+        batch_id = self.ingest_log.begin(batch)
+        done, attempt = set(), 0
+        while True:
+            try:
+                self._apply_batch(batch, batch_id, done)
+                return
+            except Exception as error:
+                if self._record_failure(batch_id, error):
+                    raise
+                done, attempt = self.ingest_log.done(batch_id), attempt + 1
+                logger.warning(f"Retrying ingest batch {batch_id} after {error!r}")
+                time.sleep(0.1 * 2 ** attempt)
+
+    def _record_failure(self, batch_id, error):
+        """Count a failed attempt at a journaled batch; True once it has been dead-lettered."""
+        batch = self.ingest_log.batch(batch_id)
+        if not self.ingest_log.fail(batch_id, error, permanent=isinstance(error, self.PERMANENT_INGEST_ERRORS)):
+            return False
+        self._discard_clusters(batch)
+        return True
+
+    def _discard_clusters(self, batch):
+        # A representative that was never indexed mustn't collect later near-duplicates
+        if self.near_duplicates is not None and batch.get("new_cluster_ids"):
+            self.near_duplicates.discard(batch["new_cluster_ids"])
+
+    def _apply_batch(self, batch, batch_id=None, done=()):
+        """Write a batch to every store not in ``done``, checkpointing each one in the ingest log.
+
+        Each store write is idempotent (update by id, upsert, rollup replace),
+        so replaying a batch a store already holds is harmless.
+        """
+        # Parse each ticket once; the record is stored with the document in both indexes
+        records = [parse_ticket(content) for content in batch["contents"]]
+        record_jsons = [record.to_json() for record in records]
+
+        for store, write in (("clusters", self._write_clusters),
+                             ("whoosh", self._write_whoosh),
+                             ("chroma", self._write_chroma),
+                             ("rollup", self._write_rollup)):
+            if store in done:
+                continue
+            write(batch, records, record_jsons)
+            if batch_id is not None:
+                self.ingest_log.checkpoint(batch_id, store)
+
+    @staticmethod
+    def _representatives_only(batch, records, record_jsons):
+        """The part of a batch that gets indexed: every document, or only cluster representatives."""
+        reps = batch.get("representatives")
+        if not reps:
+            return batch, records, record_jsons
+        keep = [i for i, (doc_id, rep_id) in enumerate(zip(batch["doc_ids"], reps)) if doc_id == rep_id]
+        subset = {key: [values[i] for i in keep] if isinstance(values, list) else values
+                  for key, values in batch.items()}
+        return subset, [records[i] for i in keep], [record_jsons[i] for i in keep]
+
+    @staticmethod
+    def _cluster_scopes(batch):
+        # Tickets cluster within the project their metadata is filtered by
+        return [str(custom.get("project", "")) if custom is not None else str(project)
+                for project, custom in zip(batch["projects"], batch["custom_metadata"])]
+
+    def _write_clusters(self, batch, records, record_jsons):
+        if self.near_duplicates is not None and batch.get("representatives"):
+            # Members keep their own metadata, to be indexed under if they are promoted
+            metadatas = [{key: value for key, value in meta.items() if key != "record"}
+                         for meta in self._chroma_metadatas(batch, records, record_jsons)]
+            self.near_duplicates.record(batch["doc_ids"], batch["representatives"], batch["contents"],
+                                        batch["timestamps"], self._cluster_scopes(batch), metadatas)
+
+    def _write_whoosh(self, batch, records, record_jsons):
+        batch, records, record_jsons = self._representatives_only(batch, records, record_jsons)
         writer = self.whoosh_index.writer()
 
+        # The metadata columns hold the values Chroma stores, so filters pushed down by
+        # where_to_whoosh select the same documents on both sides
+        metadatas = self._chroma_metadatas(batch, records, record_jsons)
+        timestamps = [self._metadata_timestamp(meta, ts) for meta, ts in zip(metadatas, batch["timestamps"])]
         with self.whoosh_index.searcher() as searcher:
-            for doc_id, content, ts in zip(doc_ids, contents, timestamps):
+            for doc_id, content, ts, record_json, meta in zip(
+                    batch["doc_ids"], batch["contents"], timestamps, record_jsons, metadatas):
+                fields = dict(
+                    id=doc_id,
+                    content=content,
+                    timestamp=datetime.fromtimestamp(ts),
+                    record=record_json,
+                    month=datetime.fromtimestamp(ts).strftime("%Y-%m"),
+                )
+                for name in ("category", "project", "escalated", "resolved"):
+                    if meta.get(name) is not None:
+                        fields[name] = term_text(meta[name])
+                for name in ("groupID", "tag"):
+                    if meta.get(name) is not None:
+                        fields[name] = self._keywords(meta[name])
                 existing_doc = searcher.document(id=doc_id)
                 if existing_doc:
-                    writer.update_document(
-                        id=doc_id,
-                        content=content,
-                        timestamp=datetime.fromtimestamp(ts)
-                    )
+                    writer.update_document(**fields)
                 else:
-                    writer.add_document(
-                        id=doc_id,
-                        content=content,
-                        timestamp=datetime.fromtimestamp(ts)
-                    )
+                    writer.add_document(**fields)
         writer.commit()
 
-        # Process Chroma updates
-        if not any(custom_metadata):
-            # Create default metadata for each document
-            metadatas = [
-                {
+        if self.sparse_index is not None:
+            self.sparse_index.add(batch["doc_ids"], batch["contents"], timestamps, record_jsons)
+
+    @staticmethod
+    def _metadata_timestamp(meta, ts):
+        # Chroma's date filters read the metadata timestamp, so Whoosh's follows it when custom metadata sets one
+        value = meta.get("timestamp")
+        return value if isinstance(value, (int, float)) and not isinstance(value, bool) else ts
+
+    @staticmethod
+    def _chroma_metadatas(batch, records, record_jsons):
+        """Chroma metadata per document: its custom metadata when given, else the ``add_document``
+        columns and the parsed record's tag."""
+        metadatas = []
+        for d_id, ts, cat, esc, res, proj, grp, custom, record, rec in zip(
+                batch["doc_ids"], batch["timestamps"], batch["categories"], batch["escalated"],
+                batch["resolved"], batch["projects"], batch["groupIDs"], batch["custom_metadata"], records,
+                record_jsons):
+            if custom is None:
+                custom = {
                     "id": d_id,
                     "timestamp": ts,
                     "category": cat,
                     "escalated": esc,
                     "resolved": res,
                     "project": proj,
-                    "groupID": grp
+                    "groupID": grp,
+                    "tag": record.Tag,
                 }
-                for d_id, ts, cat, esc, res, proj, grp in zip(
-                    doc_ids, timestamps, categories, escalated_list,
-                    resolved_list, projects, groupIDs
-                )
-            ]
-        else:
-            metadatas = [meta for meta in metadata_list if meta is not None]
+            metadatas.append({**custom, "record": rec})
+        return metadatas
+
+    def _write_chroma(self, batch, records, record_jsons):
+        # Representatives indexed earlier that gained members in this batch
+        grown = {rep_id for doc_id, rep_id in zip(batch["doc_ids"], batch.get("representatives") or ())
+                 if doc_id != rep_id}
+        batch, records, record_jsons = self._representatives_only(batch, records, record_jsons)
+        grown -= set(batch["doc_ids"])
+
+        metadatas = self._chroma_metadatas(batch, records, record_jsons)
+
+        if self.near_duplicates is not None:
+            clusters = self.near_duplicates.cluster_metadata(batch["doc_ids"])
+            metadatas = [{**meta, **clusters[d_id]} for meta, d_id in zip(metadatas, batch["doc_ids"])]
 
         # Batch upsert to Chroma
-        self.chroma_collection.upsert(
-            documents=contents,
-            metadatas=metadatas,
-            ids=doc_ids
-        )
+        if batch["doc_ids"]:
+            self.chroma_collection.upsert(
+                documents=batch["contents"],
+                metadatas=metadatas,
+                ids=batch["doc_ids"]
+            )
+        self._update_cluster_metadata(grown)
+
+    def _update_cluster_metadata(self, rep_ids):
+        # Metadata update merges keys, so only the cluster fields change
+        rep_ids = [rep_id for rep_id in rep_ids if self.near_duplicates.is_representative(rep_id)]
+        if rep_ids:
+            clusters = self.near_duplicates.cluster_metadata(rep_ids)
+            self.chroma_collection.update(ids=rep_ids, metadatas=[clusters[rep_id] for rep_id in rep_ids])
+
+    def _write_rollup(self, batch, records, record_jsons):
+        # Keep the summary rollups in step with the indexes; cluster members are counted too
+        self.rollup.add(batch["doc_ids"], batch["timestamps"], [record._asdict() for record in records])
+
+    def replay_ingest_log(self) -> int:
+        """Finish every batch the ingest log shows as unfinished; returns the number replayed.
+
+        A batch that fails is logged and left for the next start, until the
+        ingest log dead-letters it; the other batches are still replayed.
+        """
+        replayed = 0
+        for batch_id, batch, done in self.ingest_log.pending():
+            logger.info(f"Replaying ingest batch {batch_id} ({len(batch['doc_ids'])} docs) "
+                        f"into {[store for store in STORES if store not in done]}")
+            try:
+                with tracer.span("replay_batch", batch=batch_id, docs=len(batch["doc_ids"])):
+                    self._apply_batch(batch, batch_id, done)
+            except Exception as error:
+                dead = self._record_failure(batch_id, error)
+                logger.exception(f"Replaying ingest batch {batch_id} failed"
+                                 f"{', moved to the dead letters' if dead else ''}")
+                continue
+            replayed += 1
+        return replayed
+
+    def _whoosh_ids(self):
+        with self.whoosh_index.searcher() as searcher:
+            ids = set(term.decode() if isinstance(term, bytes) else term for term in searcher.lexicon("id"))
+            if searcher.reader().has_deletions():
+                # Terms of deleted documents stay in the lexicon until the segments are merged
+                ids = {doc_id for doc_id in ids if searcher.document_number(id=doc_id) is not None}
+        return ids
+
+    def _chroma_ids(self, page_size=50000):
+        ids = set()
+        for offset in range(0, self.chroma_collection.count(), page_size):
+            ids.update(self.chroma_collection.get(include=[], limit=page_size, offset=offset)["ids"])
+        return ids
+
+    def check_consistency(self, sample: int = 10) -> dict:
+        """Compare the doc-id sets of Whoosh, Chroma and the rollups.
+
+        Only ids are read: the Whoosh id lexicon, Chroma ids without
+        embeddings or documents, and the rollup's id column. Returns counts,
+        the number of ids missing from each store and up to ``sample`` of them.
+        """
+        with tracer.span("check_consistency"):
+            stores = {"whoosh": self._whoosh_ids(), "chroma": self._chroma_ids(), "rollup": self.rollup.doc_ids()}
+            if self.near_duplicates is not None:
+                # Cluster members are only in the rollups by design
+                stores["rollup"] -= self.near_duplicates.member_ids()
+        every_id = set().union(*stores.values())
+        report = {"consistent": all(ids == every_id for ids in stores.values())}
+        for store, ids in stores.items():
+            missing = every_id - ids
+            report[store] = {"count": len(ids), "missing": len(missing), "missing_sample": sorted(missing)[:sample]}
+        if not report["consistent"]:
+            logger.warning(f"Index stores disagree: {report}")
+        return report
+
+    @staticmethod
+    def _keywords(value):
+        # Comma separated values as KEYWORD terms, "A-Team, B" -> "A-Team,B"
+        return ",".join(item.strip() for item in str(value or "").split(",") if item.strip())
+
+    def delete_documents(self, doc_ids: List[str], batch_size: int = 5000) -> int:
+        """Remove documents from the Whoosh index, the Chroma collection and the rollups.
+
+        Returns the number of Whoosh documents deleted. Ids that aren't indexed are ignored.
+        A deleted cluster representative is replaced by its oldest member, which is
+        indexed with its own metadata; the rest of the cluster stays.
+        """
+        doc_ids = list(dict.fromkeys(doc_ids))
+        with tracer.span("delete_documents", ids=len(doc_ids)) as span:
+            removed_members, promoted = (self.near_duplicates.remove(doc_ids) if self.near_duplicates is not None
+                                         else ({}, {}))
+            # Members recorded without metadata inherit their predecessor's, read before its vector goes
+            predecessors = list(dict.fromkeys(predecessor for predecessor, _, _, metadata in promoted.values()
+                                              if metadata is None))
+            inherited = self.chroma_collection.get(ids=predecessors, include=["metadatas"]) if predecessors else None
+            writer = self.whoosh_index.writer()
+            try:
+                deleted = sum(writer.delete_by_term("id", doc_id) for doc_id in doc_ids)
+            except Exception:
+                writer.cancel()
+                raise
+            writer.commit()
+
+            if self.sparse_index is not None:
+                self.sparse_index.delete(doc_ids)
+
+            for i in range(0, len(doc_ids), batch_size):
+                self.chroma_collection.delete(ids=doc_ids[i:i + batch_size])
+            self.rollup.remove(list(dict.fromkeys(doc_ids + list(removed_members))))
+            if promoted:
+                self._index_promoted(promoted, dict(zip(inherited["ids"], inherited["metadatas"])) if inherited
+                                     else {})
+            # Representatives that lost members but are still indexed
+            self._update_cluster_metadata(set(removed_members.values()) - set(doc_ids) - set(promoted))
+            span.set(deleted=deleted, promoted=len(promoted))
+        logger.info(f"Deleted {deleted} of {len(doc_ids)} requested documents, promoted {len(promoted)} "
+                    f"cluster members to representatives")
+        return deleted
+
+    def _index_promoted(self, promoted, predecessor_metadata):
+        """Index members that took over a deleted representative's cluster, under their own metadata.
+
+        Members recorded before their metadata was kept get the predecessor's instead.
+        """
+        doc_ids = list(promoted)
+        custom_metadata = []
+        for doc_id in doc_ids:
+            predecessor, _, ts, metadata = promoted[doc_id]
+            if metadata is not None:
+                custom_metadata.append(metadata)
+                continue
+            meta = {key: value for key, value in (predecessor_metadata.get(predecessor) or {}).items()
+                    if key not in ("record", "cluster_size", "cluster_members")}
+            custom_metadata.append({**meta, "id": doc_id, "timestamp": ts})
+        n = len(doc_ids)
+        batch = dict(doc_ids=doc_ids, contents=[promoted[doc_id][1] for doc_id in doc_ids],
+                     timestamps=[promoted[doc_id][2] for doc_id in doc_ids], categories=["NA"] * n,
+                     escalated=[False] * n, resolved=[False] * n, projects=["NA"] * n, groupIDs=["NA"] * n,
+                     custom_metadata=custom_metadata)
+        records = [parse_ticket(content) for content in batch["contents"]]
+        record_jsons = [record.to_json() for record in records]
+        # Members are already counted in the rollups
+        self._write_whoosh(batch, records, record_jsons)
+        self._write_chroma(batch, records, record_jsons)
+
+    def purge_before(self, timestamp: float) -> int:
+        """Delete every document with a timestamp strictly before ``timestamp`` (epoch seconds)."""
+        with self.whoosh_index.searcher() as searcher:
+            expired = DateRange("timestamp", None, datetime.fromtimestamp(timestamp), endexcl=True)
+            doc_ids = [hit["id"] for hit in searcher.search(expired, limit=None)]
+        # Vectors whose Whoosh document is already gone are purged too
+        doc_ids += self.chroma_collection.get(where={"timestamp": {"$lt": timestamp}}, include=[])["ids"]
+        if self.near_duplicates is not None:
+            doc_ids += self.near_duplicates.members_before(timestamp)
+        return self.delete_documents(doc_ids)
+
+    @staticmethod
+    def _dir_bytes(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+    def _index_stats(self, queries):
+        stats = {
+            "whoosh_bytes": self._dir_bytes(self.index_dir),
+            "whoosh_segments": len(self.whoosh_index._segments()),
+            "chroma_bytes": self._dir_bytes(self.chroma_persist_directory),
+            "documents": self.whoosh_index.doc_count(),
+            "vectors": self.chroma_collection.count(),
+        }
+        if queries:
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                self.search(query)
+                latencies.append(time.perf_counter() - start)
+            stats["search_p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+            stats["search_max_ms"] = float(max(latencies) * 1000)
+        return stats
+
+    def rebuild_vector_index(self):
+        """Re-create the Chroma collection from its stored vectors so deleted HNSW entries are dropped.
+
+        Vectors, documents and metadata are exported to a staging directory
+        first; if reloading fails the staging directory is kept and logged.
+        """
+        staging = tempfile.mkdtemp(prefix="rag-rebuild-")
+        with tracer.span("rebuild_vector_index"):
+            total, _ = export_collection(self.chroma_collection, staging, 5000, self.embedding_projection)
+            name, embedding_function = self.chroma_collection.name, self.embeddings_model
+            self.chroma_client.delete_collection(name)
+            try:
+                self.chroma_collection = self.chroma_client.create_collection(
+                    name, embedding_function=embedding_function, metadata=self.hnsw_metadata)
+                load_collection(self.chroma_collection, staging, projection=self.embedding_projection)
+            except Exception:
+                logger.error(f"Rebuilding collection '{name}' failed; its {total} vectors are kept in {staging}")
+                raise
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def compact(self, queries: Optional[List[str]] = None, rebuild_vectors: bool = True) -> dict:
+        """Merge Whoosh segments (dropping deleted documents) and rebuild the vector index.
+
+        Returns ``{"before": stats, "after": stats}`` with on-disk sizes,
+        segment and document counts and, when ``queries`` are given, search
+        latency measured by running them before and after.
+        """
+        with tracer.span("compact"):
+            before = self._index_stats(queries)
+            self.whoosh_index.optimize()
+            self.save_sparse_index()
+            if rebuild_vectors:
+                self.rebuild_vector_index()
+            after = self._index_stats(queries)
+        logger.info(f"Compaction: {before} -> {after}")
+        return {"before": before, "after": after}
+
+    def summarize(self, start_date=None, end_date=None, categories=None, group_ids=None, tags=None):
+        """Category/GroupID/Tag summary over all ingested tickets, answered from the rollups."""
+        with tracer.span("summary_rollup"):
+            return self.rollup.summary(start_date, end_date, categories, group_ids, tags)
 
     def get_min_max_date(self):
         result = self.chroma_collection.get(where={})
@@ -156,18 +783,21 @@ class RAGApplication(DataProcessing):
             return [record[0] for record in sorted(combined_data, key=lambda x: x[1])]
 
     def match_record(self, keywords, record, counter, month_keys, value):
+        # Records from search(return_records=True) are already parsed; raw text is parsed once here
+        if not isinstance(record, TicketRecord):
+            record = parse_ticket(record)
+        if record.Date is None:
+            # Without a parseable date there is no month to count the record in
+            logger.debug(f"Skipping undated record {record.Serial!r}")
+            return False
+        month = self.get_record_by_month(record.Date)
+        for key in month_keys:
+            if month.lower() in key.lower():
+                month_key = key
+                break
         flag = False
         for keyword in keywords:
-            date = self.parse_record(record)["Date"]
-            try:
-                month = self.get_record_by_month(self.date_to_timestamp(date))
-            except:
-                month = self.get_record_by_month(self.date_to_timestamp(date.split("|")[0].strip()))
-            for key in month_keys:
-                if month.lower() in key.lower():
-                    month_key = key
-                    break
-            target = self.parse_record(record)[value]
+            target = getattr(record, value)
             score = self.levenshtein_similarity(keyword.lower(), target.lower())
             if score > .85:
                 counter[keyword]["total_count"] += 1
@@ -184,6 +814,10 @@ class RAGApplication(DataProcessing):
         return flag
 
     def enhance_results(self, encoder, query, docs, alpha):
+        with tracer.span("rerank", candidates=len(docs)):
+            return self._enhance_results(encoder, query, docs, alpha)
+
+    def _enhance_results(self, encoder, query, docs, alpha):
         # Get the semantic scores
         semantic_scores = encoder.model.predict([(query, doc) for doc in docs])
 
@@ -234,7 +868,192 @@ class RAGApplication(DataProcessing):
                bm_percentile: Optional[float] = .9,
                vector_match_threshold: Optional[float] = .2,
                clause: Optional[dict] = None,
-               top_k: int = None) -> tuple:
+               top_k: int = None,
+               return_records: bool = False,
+               facets: Optional[List[str]] = None,
+               clusters: str = "collapse",
+               lazy: bool = False) -> Union[tuple, SearchResults]:
+        """Hybrid BM25 + vector search.
+
+        With ``return_records`` the merged results are the ``TicketRecord``s
+        stored at ingest instead of content strings.
+
+        With the sparse lexical backend the first element is a list of
+        ``SparseHit`` rather than Whoosh ``Results`` for plain-term queries.
+
+        ``facets`` (names from ``FACETS``, or True for all) adds a fourth
+        element: ``{facet: {value: count}}`` over the returned documents,
+        computed by Whoosh from their indexed metadata columns. Cluster
+        members added by ``clusters="expand"`` aren't counted.
+
+        With near-duplicate clustering each cluster is matched through its
+        representative; ``clusters="expand"`` follows every matched
+        representative with its members' contents (or records).
+
+        With ``lazy`` only a ``SearchResults`` is returned, in the same order:
+        ids, scores, timestamps and sources, with contents (and records)
+        fetched by id in batches when they are read, and facet counts in
+        ``.facets``. The engines' result sets are dropped before it returns.
+        Its rows are merged by id, while the eager results are merged by
+        content, so documents with identical content are one eager result
+        but separate lazy rows.
+        """
+        if clusters not in ("collapse", "expand"):
+            raise ValueError(f"clusters must be 'collapse' or 'expand', not {clusters!r}")
+        if facets is True:
+            facets = list(self.FACETS)
+        with tracer.span("search", query_chars=len(query or ""), date_range=bool(start_date and end_date)):
+            return self._search(query, start_date, end_date, bm_percentile, vector_match_threshold, clause, top_k,
+                                return_records, facets, clusters == "expand" and self.near_duplicates is not None,
+                                lazy)
+
+    @staticmethod
+    def _stored_records(whoosh_results, chroma_results):
+        """Map content -> stored record JSON from both result sets."""
+        stored = {}
+        for hit in whoosh_results:
+            if hit.get('record'):
+                stored[hit['content']] = hit['record']
+        documents, metadatas = chroma_results["documents"], chroma_results["metadatas"]
+        if documents and isinstance(documents[0], list):
+            documents, metadatas = documents[0], metadatas[0]
+        for doc, meta in zip(documents, metadatas or []):
+            if meta and meta.get("record"):
+                stored[doc] = meta["record"]
+        return stored
+
+    @staticmethod
+    def _chroma_ids_by_content(chroma_results):
+        ids, documents = chroma_results["ids"], chroma_results["documents"]
+        if documents and isinstance(documents[0], list):
+            ids, documents = ids[0], documents[0]
+        return dict(zip(documents or [], ids))
+
+    @staticmethod
+    def _returned_ids(chroma_results, vector_match_threshold):
+        """Ids of the vector matches ``filter_chroma_results`` keeps."""
+        if chroma_results["ids"] and isinstance(chroma_results["ids"][0], list):
+            return [doc_id for doc_id, distance in zip(chroma_results["ids"][0], chroma_results["distances"][0])
+                    if distance <= vector_match_threshold]
+        return list(chroma_results["ids"])
+
+    def _facet_counts(self, searcher, doc_ids, facets):
+        """{facet: {value: count}} over the indexed documents among ``doc_ids``."""
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return {name: {} for name in facets}
+        returned = Or([Term("id", doc_id) for doc_id in doc_ids])
+        grouped = searcher.search(returned, limit=None, groupedby={name: self.FACETS[name] for name in facets})
+        return {name: dict(grouped.groups(name)) for name in facets}
+
+    def _expand_clusters(self, results, content_ids):
+        """Insert each representative's members, in ingestion order, right after it."""
+        rep_ids = [content_ids.get(doc) for doc in results]
+        members = self.near_duplicates.members(rep_id for rep_id in rep_ids if rep_id is not None)
+        expanded = []
+        for doc, rep_id in zip(results, rep_ids):
+            expanded.append(doc)
+            expanded.extend(content for _, content, _ in members.get(rep_id, ()))
+        return expanded
+
+    def fetch_contents(self, doc_ids: List[str]) -> dict:
+        """{id: content} for the ids still indexed (cluster members included), in one Chroma read."""
+        fetched = self.chroma_collection.get(ids=doc_ids, include=["documents"])
+        contents = dict(zip(fetched["ids"], fetched["documents"]))
+        missing = [doc_id for doc_id in doc_ids if doc_id not in contents]
+        if missing and self.near_duplicates is not None:
+            contents.update(self.near_duplicates.contents(missing))
+        return contents
+
+    def fetch_records(self, doc_ids: List[str]) -> dict:
+        """{id: TicketRecord} from the records stored at ingest, parsing the content where there is none."""
+        fetched = self.chroma_collection.get(ids=doc_ids, include=["documents", "metadatas"])
+        records = {}
+        for doc_id, doc, meta in zip(fetched["ids"], fetched["documents"], fetched["metadatas"]):
+            stored = (meta or {}).get("record")
+            records[doc_id] = TicketRecord.from_json(stored) if stored else parse_ticket(doc)
+        missing = [doc_id for doc_id in doc_ids if doc_id not in records]
+        if missing and self.near_duplicates is not None:
+            records.update({doc_id: parse_ticket(content)
+                            for doc_id, content in self.near_duplicates.contents(missing).items()})
+        return records
+
+    def _lazy_results(self, query, where_clause, top_k, vector_match_threshold, whoosh_hits, expand_clusters,
+                      page_size=1000):
+        # Only ids, scores and timestamps are read from either engine; contents stay in the stores
+        rows = {}
+
+        def row(doc_id, ts):
+            if doc_id not in rows:
+                rows[doc_id] = [np.nan, np.nan, ts, 0]
+            return rows[doc_id]
+
+        with tracer.span("chroma_query") as span:
+            if query:
+                chroma_results = self.chroma_collection.query(query_texts=[query], where=where_clause or None,
+                                                              n_results=top_k, include=["distances", "metadatas"])
+                for doc_id, distance, meta in zip(chroma_results["ids"][0], chroma_results["distances"][0],
+                                                  chroma_results["metadatas"][0]):
+                    if distance <= vector_match_threshold:
+                        entry = row(doc_id, meta["timestamp"])
+                        entry[0], entry[3] = distance, SOURCE_VECTOR
+                span.set(candidates=len(chroma_results["ids"][0]))
+            else:
+                matches, offset = [], 0
+                while True:
+                    page = self.chroma_collection.get(where=where_clause or None, include=["metadatas"],
+                                                      limit=page_size, offset=offset)
+                    matches.extend((meta["timestamp"], doc_id) for doc_id, meta in zip(page["ids"], page["metadatas"]))
+                    offset += page_size
+                    if len(page["ids"]) < page_size:
+                        break
+                # Oldest first, like filter_chroma_results orders a query-less get
+                for ts, doc_id in sorted(matches):
+                    row(doc_id, ts)[3] = SOURCE_VECTOR
+                span.set(candidates=len(matches))
+
+        for hit in whoosh_hits:
+            entry = row(hit["id"], hit["timestamp"].timestamp())
+            entry[1] = hit.score
+            entry[3] |= SOURCE_LEXICAL
+
+        if expand_clusters:
+            members = self.near_duplicates.members(doc_id for doc_id in rows
+                                                   if self.near_duplicates.is_representative(doc_id))
+            expanded = {}
+            for doc_id, entry in rows.items():
+                expanded[doc_id] = entry
+                for member_id, _, ts in members.get(doc_id, ()):
+                    expanded.setdefault(member_id, [np.nan, np.nan, ts, SOURCE_CLUSTER])
+            rows = expanded
+
+        columns = list(zip(*rows.values())) or [(), (), (), ()]
+        results = SearchResults(list(rows), *columns, fetch_contents=self.fetch_contents,
+                                fetch_records=self.fetch_records)
+        tracer.current_span().set(results=len(results))
+        return results
+
+    @staticmethod
+    def _chroma_where(start_date, end_date, clause):
+        if clause:
+            return clause
+        if start_date and end_date:
+            return {
+                "$and": [
+                    {"timestamp": {"$gte": start_date}},
+                    {"timestamp": {"$lte": end_date}}
+                ]
+            }
+        return {}
+
+    def _search(self, query, start_date, end_date, bm_percentile, vector_match_threshold, clause, top_k,
+                return_records=False, facets=None, expand_clusters=False, lazy=False):
+        if lazy and not query and not facets:
+            # Without a query every BM25 score ties, so no lexical hit clears the percentile cut
+            # and Whoosh (whose searcher alone costs megabytes to open) has nothing to add
+            return self._lazy_results(None, self._chroma_where(start_date, end_date, clause), top_k,
+                                      vector_match_threshold, [], expand_clusters)
+
         with self.whoosh_index.searcher() as searcher:
             if query:
                 query_parser = QueryParser("content", self.whoosh_index.schema)
@@ -250,92 +1069,105 @@ class RAGApplication(DataProcessing):
             else:
                 final_query = content_query
 
-            whoosh_results = searcher.search(final_query, limit=None)
+            # The Chroma clause, translated, so BM25 only scores documents in scope
+            filter_query = where_to_whoosh(clause)
+
+            # Metadata filters and query syntax beyond plain terms stay on Whoosh
+            terms = False
+            if self.sparse_index is not None and filter_query is None:
+                terms = plain_terms(content_query)
+            if terms is not False:
+                with tracer.span("sparse_search") as span:
+                    date_args = (start_date, end_date) if start_date and end_date else (None, None)
+                    whoosh_results = self.sparse_index.search(terms, *date_args) if terms != [] else []
+                    span.set(candidates=len(whoosh_results))
+            else:
+                with tracer.span("whoosh_search") as span:
+                    whoosh_results = searcher.search(final_query, limit=None, filter=filter_query)
+                    span.set(candidates=len(whoosh_results))
             scores = [hit.score for hit in whoosh_results]
             if int(sum(scores)) > len(whoosh_results):
                 threshold = np.percentile(scores, bm_percentile * 100)
-                whoosh_content = [hit['content'] for hit in whoosh_results if hit.score > threshold]
+                whoosh_hits = [hit for hit in whoosh_results if hit.score > threshold]
             else:
-                whoosh_content = []
-
-
-            if not clause:
-                where_clause = {}
-                if start_date and end_date:
-                    where_clause = {
-                        "$and": [
-                            {"timestamp": {"$gte": start_date}},
-                            {"timestamp": {"$lte": end_date}}
-                        ]
-                    }
-            else:
-                where_clause = clause
+                whoosh_hits = []
+            whoosh_content = [hit['content'] for hit in whoosh_hits]
 
-            if query:
-                chroma_results = self.chroma_collection.query(
-                    query_texts=[query],
-                    where=where_clause if where_clause else None,
-                    n_results=top_k
-                )
-            else:
-                chroma_results = self.chroma_collection.get(
-                    where=where_clause if where_clause else None
-                )
+
+            where_clause = self._chroma_where(start_date, end_date, clause)
+
+            if lazy:
+                results = self._lazy_results(query, where_clause, top_k, vector_match_threshold, whoosh_hits,
+                                             expand_clusters)
+                if facets:
+                    results.facets = self._facet_counts(searcher, results.ids, facets)
+                return results
+
+            with tracer.span("chroma_query") as span:
+                if query:
+                    chroma_results = self.chroma_collection.query(
+                        query_texts=[query],
+                        where=where_clause if where_clause else None,
+                        n_results=top_k
+                    )
+                else:
+                    chroma_results = self.chroma_collection.get(
+                        where=where_clause if where_clause else None
+                    )
+                span.set(candidates=len(chroma_results["ids"][0] if query else chroma_results["ids"]))
 
             chroma_content = self.filter_chroma_results(chroma_results, vector_match_threshold)
             results = list(dict.fromkeys(chroma_content + whoosh_content))
+            if expand_clusters:
+                content_ids = {**{hit['content']: hit['id'] for hit in whoosh_hits},
+                               **self._chroma_ids_by_content(chroma_results)}
+                results = self._expand_clusters(results, content_ids)
+            if return_records:
+                stored = self._stored_records(whoosh_results, chroma_results)
+                # Documents ingested before records were stored fall back to a one-off parse
+                results = [TicketRecord.from_json(stored[doc]) if doc in stored else parse_ticket(doc)
+                           for doc in results]
+            tracer.current_span().set(results=len(results))
 
+            if facets:
+                returned_ids = self._returned_ids(chroma_results, vector_match_threshold) + \
+                    [hit['id'] for hit in whoosh_hits]
+                facet_counts = self._facet_counts(searcher, returned_ids, facets)
+                return whoosh_results, chroma_results, results, facet_counts
             return whoosh_results, chroma_results, results
 
 
 
 # Example usage
 if __name__ == "__main__":
-    rag = RAGApplication(index_dir="/rag/db", 
-                         word2vec_model_path="path_to_word2vec_model.bin")
+    rag = RAGApplication(index_dir="whoosh_index",
+                         chroma_persist_directory="chroma_db",
+                         embeddings_model=MyEmbeddingFunction())
 
     # Add some sample documents with timestamps
-    rag.add_document("1", "Python is a high-level programming language.", datetime(2023, 1, 1))
-    rag.add_document("2", "Machine learning is a subset of artificial intelligence.", datetime(2023, 4, 15))
-    rag.add_document("3",
-                     "Natural language processing deals with the interaction between computers and humans using natural language.",
-                     datetime(2023, 3, 1))
+    rag.add_document(["1", "2", "3"],
+                     ["Python is a high-level programming language.",
+                      "Machine learning is a subset of artificial intelligence.",
+                      "Natural language processing deals with the interaction between computers and humans using natural language."],
+                     [datetime(2023, 1, 1).timestamp(), datetime(2023, 4, 15).timestamp(), datetime(2023, 3, 1).timestamp()])
 
     # Perform a search with date range
-    start_date = datetime(2023, 1, 1)
-    end_date = datetime(2023, 3, 1)
-
-    # Perform a search with query enhancement
-    results = rag.search("programming languages", 
-                         start_date=start_date, 
-                         end_date=end_date, 
-                         top_k=5, 
-                         bm25_threshold=0.5, 
-                         chroma_threshold=0.7)
-
-    print("Search results with query enhancement:")
-    for result in results:
-        print(f"ID: {result['id']}")
-        print(f"Content: {result['content']}")
-        print(f"Timestamp: {result['timestamp']}")
-        print(f"Source: {result['source']}")
-        print("---")
+    start_date = datetime(2023, 1, 1).timestamp()
+    end_date = datetime(2023, 3, 1).timestamp()
+    whoosh_results, chroma_results, results_with_date = rag.search("programming languages",
+                                                                   start_date=start_date,
+                                                                   end_date=end_date,
+                                                                   top_k=5)
 
     print("Search results with date range:")
     for result in results_with_date:
-        print(f"ID: {result['id']}")
-        print(f"Content: {result['content']}")
-        print(f"Timestamp: {result['timestamp']}")
-        print(f"Source: {result['source']}")
+        print(result)
         print("---")
 
     # Perform a search without date range
-    results_without_date = rag.search("programming languages")
+    whoosh_results, chroma_results, results_without_date = rag.search("programming languages", top_k=5)
 
     print("\nSearch results without date range:")
     for result in results_without_date:
-        print(f"ID: {result['id']}")
-        print(f"Content: {result['content']}")
-        print(f"Timestamp: {result['timestamp']}")
-        print(f"Source: {result['source']}")
+        print(result)
         print("---")
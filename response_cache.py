@@ -0,0 +1,217 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def context_fingerprint(items: Iterable[str]) -> str:
+    """Order-independent hash of the retrieved context (doc ids or contents).
+
+    New tickets landing in the result set change the fingerprint, so cached
+    answers built on the old context are no longer served.
+    """
+    digest = hashlib.sha256()
+    for item in sorted(set(items)):
+        digest.update(item.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Exact + near-duplicate cache for chat completions, persisted in SQLite.
+
+    Entries are scoped to a context fingerprint. Exact matches are found by
+    hashing the normalized prompt; near-duplicates by cosine similarity of
+    prompt embeddings within the same fingerprint.
+    """
+
+    def __init__(self,
+                 db_path: str = "response_cache.db",
+                 embedding_function: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                 similarity_threshold: float = 0.95,
+                 ttl_seconds: int = 24 * 60 * 60,
+                 max_entries: int = 10000):
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS ResponseCache(
+            key text PRIMARY KEY,
+            fingerprint text,
+            prompt text,
+            embedding blob,
+            response text,
+            created real,
+            last_access real)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_fingerprint ON ResponseCache(fingerprint)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON ResponseCache(last_access)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON ResponseCache(created)")
+        self._conn.commit()
+        (self._count,) = self._conn.execute("SELECT COUNT(*) FROM ResponseCache").fetchone()
+        # fingerprint -> (keys, unit-normalized embedding matrix), rebuilt lazily
+        self._vectors: Dict[str, Tuple[List[str], np.ndarray]] = {}
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(prompt: str, fingerprint: str) -> str:
+        return hashlib.sha256(f"{fingerprint}\0{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def _embed(self, prompt: str) -> Optional[np.ndarray]:
+        if self.embedding_function is None:
+            return None
+        vector = np.asarray(self.embedding_function([prompt])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _load_vectors(self, fingerprint: str) -> Tuple[List[str], np.ndarray]:
+        if fingerprint not in self._vectors:
+            rows = self._conn.execute(
+                "SELECT key, embedding FROM ResponseCache WHERE fingerprint=? AND embedding IS NOT NULL",
+                (fingerprint,)).fetchall()
+            keys = [key for key, _ in rows]
+            matrix = (np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+                      if rows else np.empty((0, 0), dtype=np.float32))
+            self._vectors[fingerprint] = (keys, matrix)
+        return self._vectors[fingerprint]
+
+    def _touch(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT response, created FROM ResponseCache WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        response, created = row
+        now = time.time()
+        if now - created > self.ttl_seconds:
+            self._delete([key])
+            return None
+        self._conn.execute("UPDATE ResponseCache SET last_access=? WHERE key=?", (now, key))
+        self._conn.commit()
+        return response
+
+    def get(self, prompt: str, fingerprint: str = "", semantic: bool = True) -> Optional[str]:
+        return self.lookup(prompt, fingerprint, semantic)[0]
+
+    def lookup(self, prompt: str, fingerprint: str = "",
+               semantic: bool = True) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """(cached response or None, prompt embedding or None).
+
+        On a miss, pass the embedding to ``put`` so the prompt isn't embedded twice.
+        """
+        key = self._key(prompt, fingerprint)
+        with self._lock:
+            response = self._touch(key)
+            if response is not None:
+                self.hits += 1
+                return response, None
+
+        embedding = self._embed(prompt) if semantic else None
+        if embedding is None:
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        with self._lock:
+            keys, matrix = self._load_vectors(fingerprint)
+            if keys and matrix.shape[1] == embedding.shape[0]:
+                scores = matrix @ embedding
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    response = self._touch(keys[best])
+                    if response is not None:
+                        self.semantic_hits += 1
+                        logger.debug(f"Semantic cache hit with similarity {scores[best]:.3f}")
+                        return response, embedding
+            self.misses += 1
+        return None, embedding
+
+    def put(self, prompt: str, response: str, fingerprint: str = "", semantic: bool = True,
+            embedding: Optional[np.ndarray] = None):
+        """Store ``response``; ``embedding`` is the one ``lookup`` returned for this prompt, if any."""
+        key = self._key(prompt, fingerprint)
+        if embedding is None and semantic:
+            embedding = self._embed(prompt)
+        elif not semantic:
+            embedding = None
+        blob = embedding.tobytes() if embedding is not None else None
+        now = time.time()
+        with self._lock:
+            replaced = self._conn.execute("SELECT 1 FROM ResponseCache WHERE key=?", (key,)).fetchone() is not None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ResponseCache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, fingerprint, normalize_prompt(prompt), blob, response, now, now))
+            self._conn.commit()
+            if not replaced:
+                self._count += 1
+            self._add_vector(fingerprint, key, embedding)
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _add_vector(self, fingerprint: str, key: str, embedding: Optional[np.ndarray]):
+        # Keep a loaded matrix in step with the new row rather than reading the fingerprint back
+        if fingerprint not in self._vectors:
+            return
+        keys, matrix = self._vectors[fingerprint]
+        if key in keys or (embedding is not None and keys and matrix.shape[1] != embedding.shape[0]):
+            self._vectors.pop(fingerprint)
+        elif embedding is not None:
+            self._vectors[fingerprint] = (keys + [key], np.vstack([matrix, embedding]) if keys
+                                          else embedding.reshape(1, -1).astype(np.float32))
+
+    def _delete(self, keys: List[str]):
+        if not keys:
+            return
+        fingerprints = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            fingerprints.update(fingerprint for (fingerprint,) in self._conn.execute(
+                f"SELECT DISTINCT fingerprint FROM ResponseCache WHERE key IN ({','.join('?' * len(chunk))})", chunk))
+        cursor = self._conn.executemany("DELETE FROM ResponseCache WHERE key=?", [(key,) for key in keys])
+        self._conn.commit()
+        self._count -= cursor.rowcount
+        # Only the fingerprints that lost entries need their vectors reloaded
+        for fingerprint in fingerprints:
+            self._vectors.pop(fingerprint, None)
+
+    def _evict(self):
+        # Only runs once the count is over max_entries; expired entries are refused on read until then
+        expired = [key for (key,) in self._conn.execute(
+            "SELECT key FROM ResponseCache WHERE created < ?", (time.time() - self.ttl_seconds,))]
+        self._delete(expired)
+
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM ResponseCache").fetchone()
+        if count > self.max_entries:
+            lru = [key for (key,) in self._conn.execute(
+                "SELECT key FROM ResponseCache ORDER BY last_access ASC LIMIT ?", (count - self.max_entries,))]
+            self._delete(lru)
+            logger.info(f"Evicted {len(lru)} least recently used cache entries")
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM ResponseCache")
+            self._conn.commit()
+            self._vectors.clear()
+            self._count = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM ResponseCache").fetchone()
+        return {"entries": count, "hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
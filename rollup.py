@@ -0,0 +1,218 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from typing import Iterable, List, Optional
+
+from table_new import _format_summary, _get_date_range_key, _new_counts, _parse_date
+
+logger = logging.getLogger(__name__)
+
+
+def _split_and_strip(value):
+    return [item.strip() for item in value.split(',')] if value else []
+
+
+def _month_code(day: date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def _month_end(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+class RollupStore:
+    """Incrementally maintained counts for summary requests, persisted in SQLite.
+
+    ``RollupCounts`` holds the per-item counts (Category, GroupID, Tag) and
+    the pair counts (Category-Tag, Category-GroupID, GroupID-Tag) that
+    ``generate_summary_with_date_range`` reports, per month and per day.
+    Its size grows with the number of distinct values and days, not with
+    the number of tickets: whole months of a summary come from the month
+    rows, a partial first or last month from that month's day rows.
+    ``RollupDocs`` keeps each document's day and fields so re-ingesting a
+    document moves its counts instead of doubling them.
+    """
+
+    # Grains of RollupCounts.period: month codes (year * 12 + month - 1) and day ordinals
+    MONTH, DAY = 0, 1
+
+    def __init__(self, db_path: str = "rollup.db"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS RollupCounts(
+            grain integer,
+            period integer,
+            kind text,
+            item text,
+            item2 text,
+            count integer,
+            PRIMARY KEY (grain, period, kind, item, item2))""")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS RollupDocs(
+            id text PRIMARY KEY,
+            day integer,
+            category text,
+            groupids text,
+            tags text)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_rollup_docs_day ON RollupDocs(day)")
+        self._migrate()
+        self._conn.commit()
+
+    def _migrate(self):
+        # Stores from before RollupCounts kept one cube cell per Category x GroupIDs x Tags combination
+        if self._conn.execute("SELECT name FROM sqlite_master WHERE name='RollupCube'").fetchone() is None:
+            return
+        docs = self._conn.execute("SELECT day, category, groupids, tags FROM RollupDocs ORDER BY rowid").fetchall()
+        for day, category, groupids, tags in docs:
+            self._bump(day, category, groupids, tags, 1)
+        self._conn.execute("DROP TABLE RollupCube")
+        logger.info(f"Rebuilt rollup counts from {len(docs)} documents")
+
+    @staticmethod
+    def _contributions(category, groupids, tags):
+        """(kind, item, item2) for every count one ticket adds, as _aggregate_rows counts them."""
+        items = [("category", category, "")] if category else []
+        items += [("groupid", groupid, "") for groupid in groupids]
+        items += [("tag", tag, "") for tag in tags]
+        if category:
+            items += [("category_tag", category, tag) for tag in tags]
+            items += [("category_groupid", category, groupid) for groupid in groupids]
+        items += [("groupid_tag", groupid, tag) for groupid in groupids for tag in tags]
+        return items
+
+    def _bump(self, day, category, groupids, tags, delta):
+        """Add ``delta`` to every month and day count of one ticket (fields as stored in RollupDocs)."""
+        month = _month_code(date.fromordinal(day))
+        rows = [(grain, period, kind, item, item2, delta)
+                for kind, item, item2 in self._contributions(category, json.loads(groupids), json.loads(tags))
+                for grain, period in ((self.MONTH, month), (self.DAY, day))]
+        self._conn.executemany(
+            """INSERT INTO RollupCounts VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (grain, period, kind, item, item2) DO UPDATE SET count = count + excluded.count""", rows)
+
+    def add(self, doc_ids: List[str], timestamps: List[float], records: List[dict]):
+        """Record documents, replacing the previous contribution of any id already seen.
+
+        ``records`` carry the parsed Category, GroupID and Tag of each ticket.
+        """
+        with self._lock:
+            for doc_id, ts, record in zip(doc_ids, timestamps, records):
+                day = datetime.fromtimestamp(ts).date().toordinal()
+                category = record.get("Category") or ""
+                groupids = json.dumps(_split_and_strip(record.get("GroupID", "")))
+                tags = json.dumps(_split_and_strip(record.get("Tag", "")))
+
+                previous = self._conn.execute(
+                    "SELECT day, category, groupids, tags FROM RollupDocs WHERE id=?", (doc_id,)).fetchone()
+                if previous is not None:
+                    self._bump(*previous, -1)
+                self._bump(day, category, groupids, tags, 1)
+                self._conn.execute("INSERT OR REPLACE INTO RollupDocs VALUES (?, ?, ?, ?, ?)",
+                                   (doc_id, day, category, groupids, tags))
+            self._conn.commit()
+
+    def remove(self, doc_ids: Iterable[str]):
+        with self._lock:
+            for doc_id in doc_ids:
+                previous = self._conn.execute(
+                    "SELECT day, category, groupids, tags FROM RollupDocs WHERE id=?", (doc_id,)).fetchone()
+                if previous is None:
+                    continue
+                self._bump(*previous, -1)
+                self._conn.execute("DELETE FROM RollupDocs WHERE id=?", (doc_id,))
+            self._conn.execute("DELETE FROM RollupCounts WHERE count <= 0")
+            self._conn.commit()
+
+    def doc_ids(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT id FROM RollupDocs")}
+
+    def date_bounds(self):
+        with self._lock:
+            low, high = self._conn.execute("SELECT MIN(day), MAX(day) FROM RollupDocs").fetchone()
+        if low is None:
+            return None
+        return (datetime.combine(date.fromordinal(low), datetime.min.time()),
+                datetime.combine(date.fromordinal(high), datetime.min.time()))
+
+    def _counts(self, start: Optional[date], end: Optional[date]):
+        """Return (month, kind, item, item2, count) rows covering [start, end], by month.
+
+        Whole months come from the month rows; a first or last month that is
+        only partly inside the range is summed from its day rows.
+        """
+        first_full = None if start is None else _month_code(start) + (start.day != 1)
+        last_full = None if end is None else _month_code(end) - (end != _month_end(end))
+
+        partial = []
+        if start is not None and start.day != 1:
+            partial.append((start, min(end, _month_end(start)) if end else _month_end(start)))
+        if end is not None and end != _month_end(end) and not (
+                start is not None and start.day != 1 and _month_code(start) == _month_code(end)):
+            partial.append((max(start, end.replace(day=1)) if start else end.replace(day=1), end))
+
+        query = "SELECT period, kind, item, item2, count FROM RollupCounts WHERE grain = ? AND count > 0"
+        params = [self.MONTH]
+        if first_full is not None:
+            query += " AND period >= ?"
+            params.append(first_full)
+        if last_full is not None:
+            query += " AND period <= ?"
+            params.append(last_full)
+
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY rowid", params).fetchall()
+            for low, high in partial:
+                rows.extend(
+                    (_month_code(low), *row) for row in self._conn.execute(
+                        """SELECT kind, item, item2, SUM(count) FROM RollupCounts
+                        WHERE grain = ? AND period BETWEEN ? AND ? AND count > 0
+                        GROUP BY kind, item, item2 ORDER BY MIN(rowid)""",
+                        (self.DAY, low.toordinal(), high.toordinal())))
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    def summary(self, start_date=None, end_date=None, categories=None, group_ids=None, tags=None):
+        """Same text as ``generate_summary_with_date_range`` over all ingested tickets, from the rollups.
+
+        Items are listed in order of first appearance by month and ingestion
+        rather than in result order.
+        """
+        start = _parse_date(start_date) if start_date else None
+        end = _parse_date(end_date) if end_date else None
+
+        counts = _new_counts()
+        fields_present = set()
+        filters = {"category": categories, "groupid": group_ids, "tag": tags}
+        fields = {"category": "Category", "groupid": "GroupID", "tag": "Tag"}
+        for month, kind, item, item2, n in self._counts(start and start.date(), end and end.date()):
+            key = _get_date_range_key(datetime(month // 12, month % 12 + 1, 1), start, end)
+            if kind in fields:
+                fields_present.add(fields[kind])
+                if filters[kind] and item not in filters[kind]:
+                    continue
+                info = counts[kind][item]
+            else:
+                info = counts[kind][item][item2]
+            info["total"] += n
+            info["date_ranges"][key] += n
+
+        date_bounds = self.date_bounds() if not start and not end else None
+        return _format_summary(counts, fields_present, start, end, date_bounds, categories, group_ids, tags)
+
+    def backup(self, path: str):
+        """Consistent copy of the rollup database at ``path``."""
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self._conn.backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,36 +1,78 @@
+import json
 import re
+from datetime import datetime
+from typing import NamedTuple, Optional
 
 
-def parse_record(text):
-    # Define the features we're looking for
-    features = [
-        "Serial:", "Date:", "Category:", "Issue:", "Resolution:",
-        "Context:", "GroupID:", "Tag:"
-    ]
+FEATURES = ["Serial", "Date", "Category", "Issue", "Resolution", "Context", "GroupID", "Tag"]
 
-    # Create a regular expression pattern
-    pattern = "|".join(map(re.escape, features))
+# One pattern for every "Feature:" label, compiled once
+FEATURE_PATTERN = re.compile("(" + "|".join(map(re.escape, FEATURES)) + "):")
 
-    # Split the text, keeping the delimiters
-    parts = re.split(f'({pattern})', text)
+DATE_PATTERNS = [
+    (re.compile(r'(\d{2}/\d{2}/\d{4})'), "%d/%m/%Y"),
+    (re.compile(r'(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})'), "%Y-%m-%d %H:%M:%S"),
+    (re.compile(r'(\d{4}-\d{2}-\d{2})'), "%Y-%m-%d"),
+]
 
-    # Remove any empty strings and leading/trailing whitespace
-    parts = [part.strip() for part in parts if part.strip()]
 
-    # Pair up the features with their values
+def parse_record(text):
+    # Walk the feature labels once, each value runs up to the next label
     result = {}
-    for i in range(0, len(parts), 2):
-        if i + 1 < len(parts):
-            key = parts[i].rstrip(':')
-            value = parts[i + 1]
-            result[key] = value
-
+    matches = list(FEATURE_PATTERN.finditer(text))
+    for match, following in zip(matches, matches[1:] + [None]):
+        value = text[match.end():following.start() if following else len(text)].strip()
+        result[match.group(1)] = value
     return result
 
 
-# Example usage:
-text_block = ""
+def parse_date(value: str) -> Optional[float]:
+    """Epoch seconds of the first date in ``value`` ("15/10/2023 | ..." etc.), or None."""
+    for pattern, fmt in DATE_PATTERNS:
+        match = pattern.search(value)
+        if match:
+            try:
+                return datetime.strptime(match.group(1), fmt).timestamp()
+            except ValueError:
+                continue
+    return None
+
+
+class TicketRecord(NamedTuple):
+    """A ticket parsed once at ingest; Date is epoch seconds."""
+    Serial: str = ""
+    Date: Optional[float] = None
+    Category: str = ""
+    Issue: str = ""
+    Resolution: str = ""
+    Context: str = ""
+    GroupID: str = ""
+    Tag: str = ""
+
+    def as_row(self) -> dict:
+        """Dict in the shape used by create_markdown_table and generate_summary_with_date_range."""
+        row = self._asdict()
+        row["Date"] = datetime.fromtimestamp(self.Date).strftime("%d/%m/%Y") if self.Date is not None else ""
+        return row
+
+    def to_json(self) -> str:
+        return json.dumps(self, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, value: str) -> "TicketRecord":
+        return cls(*json.loads(value))
+
+
+def parse_ticket(text: str) -> TicketRecord:
+    fields = parse_record(text)
+    date = fields.pop("Date", "")
+    return TicketRecord(Date=parse_date(date) if date else None, **fields)
+
+
+if __name__ == "__main__":
+    # Example usage:
+    text_block = ""
 
-parsed_record = parse_record(text_block)
-for key, value in parsed_record.items():
-    print(f"{key} = {value}")
+    parsed_record = parse_record(text_block)
+    for key, value in parsed_record.items():
+        print(f"{key} = {value}")
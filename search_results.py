@@ -0,0 +1,140 @@
+import logging
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bit flags for where a result came from; a document found by both engines has both bits
+SOURCE_VECTOR = 1
+SOURCE_LEXICAL = 2
+SOURCE_CLUSTER = 4
+
+
+class SearchHit:
+    """One row of ``SearchResults``; content and record are fetched on first access."""
+    __slots__ = ("_results", "_row")
+
+    def __init__(self, results, row):
+        self._results = results
+        self._row = row
+
+    @property
+    def id(self) -> str:
+        return self._results.ids[self._row]
+
+    @property
+    def distance(self) -> float:
+        return float(self._results.distances[self._row])
+
+    @property
+    def bm25_score(self) -> float:
+        return float(self._results.bm25_scores[self._row])
+
+    @property
+    def timestamp(self) -> float:
+        return float(self._results.timestamps[self._row])
+
+    @property
+    def source(self) -> int:
+        return int(self._results.sources[self._row])
+
+    @property
+    def content(self) -> str:
+        return self._results.content(self._row)
+
+    @property
+    def record(self):
+        return self._results.record(self._row)
+
+    def __repr__(self):
+        return f"SearchHit(id={self.id!r}, source={self.source}, distance={self.distance}, bm25={self.bm25_score})"
+
+
+class SearchResults:
+    """Merged results of one search held as parallel arrays: id, vector distance, BM25 score, timestamp, source.
+
+    Missing scores are NaN. Nothing from the engines' result objects is kept;
+    contents and records are fetched by id through the loaders, ``batch_size``
+    rows at a time around the row asked for, and cached until ``release``.
+    """
+    __slots__ = ("ids", "distances", "bm25_scores", "timestamps", "sources", "facets", "batch_size",
+                 "_fetch_contents", "_fetch_records", "_contents", "_records")
+
+    def __init__(self, ids: List[str], distances, bm25_scores, timestamps, sources,
+                 fetch_contents: Callable[[List[str]], Dict[str, str]],
+                 fetch_records: Optional[Callable[[List[str]], Dict[str, object]]] = None,
+                 facets: Optional[dict] = None,
+                 batch_size: int = 256):
+        self.ids = ids
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.bm25_scores = np.asarray(bm25_scores, dtype=np.float32)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.sources = np.asarray(sources, dtype=np.uint8)
+        self.facets = facets
+        self.batch_size = batch_size
+        self._fetch_contents = fetch_contents
+        self._fetch_records = fetch_records
+        self._contents = {}
+        self._records = {}
+
+    @classmethod
+    def empty(cls, fetch_contents, fetch_records=None, facets=None) -> "SearchResults":
+        return cls([], [], [], [], [], fetch_contents, fetch_records, facets)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row: int) -> SearchHit:
+        if row < 0:
+            row += len(self.ids)
+        if not 0 <= row < len(self.ids):
+            raise IndexError(row)
+        return SearchHit(self, row)
+
+    def __iter__(self):
+        return (SearchHit(self, row) for row in range(len(self.ids)))
+
+    def _load(self, cache, fetch, rows: Iterable[int]):
+        missing = [self.ids[row] for row in rows if self.ids[row] not in cache]
+        for i in range(0, len(missing), self.batch_size):
+            chunk = missing[i:i + self.batch_size]
+            loaded = fetch(chunk)
+            # Ids deleted since the search stay None rather than being asked for again
+            cache.update({doc_id: loaded.get(doc_id) for doc_id in chunk})
+
+    def _window(self, row):
+        start = row - row % self.batch_size
+        return range(start, min(start + self.batch_size, len(self.ids)))
+
+    def content(self, row: int) -> Optional[str]:
+        doc_id = self.ids[row]
+        if doc_id not in self._contents:
+            self._load(self._contents, self._fetch_contents, self._window(row))
+        return self._contents[doc_id]
+
+    def contents(self, start: int = 0, stop: Optional[int] = None) -> List[Optional[str]]:
+        rows = range(start, len(self.ids) if stop is None else min(stop, len(self.ids)))
+        self._load(self._contents, self._fetch_contents, rows)
+        return [self._contents[self.ids[row]] for row in rows]
+
+    def record(self, row: int):
+        if self._fetch_records is None:
+            raise ValueError("These results have no record loader")
+        doc_id = self.ids[row]
+        if doc_id not in self._records:
+            self._load(self._records, self._fetch_records, self._window(row))
+        return self._records[doc_id]
+
+    def records(self, start: int = 0, stop: Optional[int] = None) -> list:
+        if self._fetch_records is None:
+            raise ValueError("These results have no record loader")
+        rows = range(start, len(self.ids) if stop is None else min(stop, len(self.ids)))
+        self._load(self._records, self._fetch_records, rows)
+        return [self._records[self.ids[row]] for row in rows]
+
+    def release(self):
+        """Drop fetched contents and records; they are fetched again if needed."""
+        self._contents.clear()
+        self._records.clear()
+
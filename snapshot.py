@@ -0,0 +1,260 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 3
+# Format 2 added the optional embedding projection and non-float32 vector storage,
+# format 3 the optional near-duplicate database
+READABLE_FORMATS = (1, 2, 3)
+
+MANIFEST = "manifest.json"
+EMBEDDINGS = "chroma/embeddings.npy"
+PROJECTION = "chroma/projection.npz"
+RECORDS = "chroma/records.jsonl"
+ROLLUP = "rollup.db"
+NEAR_DUPLICATES = "near_duplicates.db"
+WHOOSH = "whoosh/"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def schema_signature(schema):
+    """Field names, types, columns and vectors of a Whoosh schema, comparable across processes."""
+    return [[name, type(field).__name__, type(field.column_type).__name__ if field.column_type else None,
+             bool(field.vector)] for name, field in sorted(schema.items())]
+
+
+def embedding_model_id(embedding_function):
+    if embedding_function is None:
+        return None
+    name = getattr(embedding_function, "name", None)
+    if callable(name):
+        try:
+            return name()
+        except TypeError:
+            pass
+    return type(embedding_function).__name__
+
+
+def _sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_collection(collection, staging, page_size, projection=None):
+    """Write embeddings as one .npy and ids/documents/metadatas as JSON lines, page by page.
+
+    Vectors are float32 unless ``projection`` (an ``EmbeddingProjection``)
+    stores them in a smaller dtype; the projection is then saved alongside.
+    """
+    total = collection.count()
+    os.makedirs(os.path.join(staging, "chroma"), exist_ok=True)
+    if projection is not None:
+        projection.save(os.path.join(staging, PROJECTION))
+    vectors = None
+    with open(os.path.join(staging, RECORDS), "w") as records:
+        for offset in range(0, total, page_size):
+            page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+            if projection is not None:
+                embeddings = projection.quantize(embeddings)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(staging, EMBEDDINGS), mode="w+",
+                                                    dtype=embeddings.dtype, shape=(total, embeddings.shape[1]))
+            vectors[offset:offset + len(embeddings)] = embeddings
+            for doc_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                records.write(json.dumps([doc_id, document, metadata]) + "\n")
+    if vectors is None:
+        np.save(os.path.join(staging, EMBEDDINGS), np.zeros((0, 0), dtype=np.float32))
+        return 0, 0
+    vectors.flush()
+    dim = vectors.shape[1]
+    del vectors
+    return total, dim
+
+
+def write_snapshot(app, path, page_size=5000):
+    """Write the Whoosh index, Chroma collection (with raw vectors), rollups and, with
+    clustering, the near-duplicate database of ``app`` to one tar file.
+
+    The Whoosh writer lock is held until the other stores are exported too,
+    so no batch lands in Whoosh half way through the copy or between the
+    copy and the other stores' export.
+    """
+    staging = tempfile.mkdtemp(prefix="rag-snapshot-")
+    try:
+        projection = app.embedding_projection
+        writer = app.whoosh_index.writer()
+        try:
+            shutil.copytree(app.index_dir, os.path.join(staging, WHOOSH),
+                            ignore=shutil.ignore_patterns("*.lock"))
+            doc_count = app.whoosh_index.doc_count()
+            vectors, dim = export_collection(app.chroma_collection, staging, page_size, projection)
+            app.rollup.backup(os.path.join(staging, ROLLUP))
+            near_duplicates = app.near_duplicates
+            if near_duplicates is not None:
+                near_duplicates.backup(os.path.join(staging, NEAR_DUPLICATES))
+                members = len(near_duplicates.member_ids())
+        finally:
+            writer.cancel()
+
+        files = {}
+        for root, _, names in os.walk(staging):
+            for name in names:
+                full = os.path.join(root, name)
+                files[os.path.relpath(full, staging).replace(os.sep, "/")] = _sha256(full)
+
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "whoosh_schema": schema_signature(app.schema),
+            "whoosh_docs": doc_count,
+            "collection": app.chroma_collection.name,
+            "collection_metadata": app.chroma_collection.metadata,
+            "embedding_model": embedding_model_id(app.embeddings_model),
+            "vectors": vectors,
+            "dim": dim,
+            "embedding_storage": projection.storage if projection is not None else "float32",
+            "near_duplicates": ({"settings": near_duplicates.settings(), "members": members}
+                                if near_duplicates is not None else None),
+            "files": files,
+        }
+
+        tmp_path = path + ".tmp"
+        with tarfile.open(tmp_path, "w") as tar:
+            data = json.dumps(manifest, indent=2).encode()
+            info = tarfile.TarInfo(MANIFEST)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            for name in sorted(files):
+                tar.add(os.path.join(staging, name), arcname=name)
+        os.replace(tmp_path, path)
+        logger.info(f"Wrote snapshot {path}: {doc_count} Whoosh docs, {vectors} vectors of dim {dim}")
+        return manifest
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def read_snapshot(path, staging):
+    """Extract ``path`` into ``staging`` and verify its format and every file checksum."""
+    with tarfile.open(path, "r") as tar:
+        for member in tar.getmembers():
+            if member.name.startswith("/") or ".." in member.name.split("/") or not (member.isfile() or member.isdir()):
+                raise SnapshotError(f"Unexpected member {member.name!r} in snapshot {path}")
+        tar.extractall(staging)
+
+    with open(os.path.join(staging, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") not in READABLE_FORMATS:
+        raise SnapshotError(f"Snapshot format {manifest.get('format')} is not supported "
+                            f"(expected one of {READABLE_FORMATS})")
+
+    for name, checksum in manifest["files"].items():
+        full = os.path.join(staging, name)
+        if not os.path.exists(full):
+            raise SnapshotError(f"Snapshot is missing {name}")
+        if _sha256(full) != checksum:
+            raise SnapshotError(f"Checksum mismatch for {name}")
+    return manifest
+
+
+def check_compatibility(manifest, schema, embedding_function):
+    """Raise SnapshotError if the snapshot was built with another Whoosh schema or embedding model."""
+    if manifest["whoosh_schema"] != schema_signature(schema):
+        raise SnapshotError("Snapshot Whoosh schema does not match this version's schema")
+    model = embedding_model_id(embedding_function)
+    if model is not None and manifest["embedding_model"] != model:
+        raise SnapshotError(f"Snapshot vectors come from {manifest['embedding_model']!r}, "
+                            f"but the configured embedding model is {model!r}")
+
+
+def restore_files(staging, index_dir, rollup_path, near_duplicates_path=None):
+    shutil.copytree(os.path.join(staging, WHOOSH), index_dir)
+    shutil.copyfile(os.path.join(staging, ROLLUP), rollup_path)
+    if near_duplicates_path is not None:
+        shutil.copyfile(os.path.join(staging, NEAR_DUPLICATES), near_duplicates_path)
+
+
+def swap_in(staged):
+    """Move each staged path over its target ({target: staged path}), putting every target back on failure.
+
+    A target with nothing staged is removed, so no stale copy outlives the swap.
+    """
+    moved = []
+    try:
+        for target, path in staged.items():
+            backup = None
+            if os.path.exists(target):
+                backup = f"{target}.replaced"
+                remove_path(backup)
+                os.replace(target, backup)
+            moved.append((target, backup))
+            if os.path.exists(path):
+                os.replace(path, target)
+    except OSError:
+        for target, backup in reversed(moved):
+            remove_path(target)
+            if backup is not None:
+                os.replace(backup, target)
+        raise
+    for _, backup in moved:
+        if backup is not None:
+            remove_path(backup)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def load_collection(collection, staging, batch_size=5000, projection=None):
+    """Add the snapshot's vectors, documents and metadata to ``collection`` without re-embedding.
+
+    ``projection`` must be the one the vectors were exported with, if any.
+    """
+    vectors = np.load(os.path.join(staging, EMBEDDINGS), mmap_mode="r")
+    decode = projection.dequantize if projection is not None else np.asarray
+    with open(os.path.join(staging, RECORDS)) as f:
+        offset = 0
+        while True:
+            batch = [json.loads(line) for _, line in zip(range(batch_size), f)]
+            if not batch:
+                break
+            ids, documents, metadatas = zip(*batch)
+            collection.add(ids=list(ids),
+                           embeddings=decode(vectors[offset:offset + len(batch)]).tolist(),
+                           documents=list(documents),
+                           metadatas=list(metadatas))
+            offset += len(batch)
+    return offset
+
+
+def verify_counts(manifest, app):
+    if app.whoosh_index.doc_count() != manifest["whoosh_docs"]:
+        raise SnapshotError(f"Restored Whoosh index has {app.whoosh_index.doc_count()} documents, "
+                            f"snapshot has {manifest['whoosh_docs']}")
+    if app.chroma_collection.count() != manifest["vectors"]:
+        raise SnapshotError(f"Restored collection has {app.chroma_collection.count()} vectors, "
+                            f"snapshot has {manifest['vectors']}")
+    clusters = manifest.get("near_duplicates")
+    if clusters is not None and len(app.near_duplicates.member_ids()) != clusters["members"]:
+        raise SnapshotError(f"Restored near-duplicate index has {len(app.near_duplicates.member_ids())} members, "
+                            f"snapshot has {clusters['members']}")
+
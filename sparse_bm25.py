@@ -0,0 +1,345 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+from scipy import sparse
+from whoosh.analysis import StandardAnalyzer
+from whoosh.query import And, Every, NullQuery, Term
+
+logger = logging.getLogger(__name__)
+
+SPARSE_FORMAT = 2
+
+
+def plain_terms(query, fieldname="content"):
+    """Terms of a query the sparse index can answer: a term or an AND of terms on ``fieldname``.
+
+    Returns [] for an empty (stopword only) query, None for Every() and
+    False for anything else (phrases, OR, NOT, wildcards, other fields),
+    which should go to Whoosh.
+    """
+    if isinstance(query, Every):
+        return None
+    if query is NullQuery:
+        return []
+    if isinstance(query, Term):
+        return [query.text] if query.fieldname == fieldname else False
+    if isinstance(query, And) and all(isinstance(q, Term) and q.fieldname == fieldname for q in query.subqueries):
+        return [q.text for q in query.subqueries]
+    return False
+
+
+class _StoredColumn:
+    """Strings by row: a UTF-8 blob with offsets (memory mapped once loaded) plus rows added since."""
+
+    def __init__(self, blob=None, offsets=None):
+        self.blob = blob if blob is not None else np.zeros(0, dtype=np.uint8)
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.added = []
+
+    def __len__(self):
+        return len(self.offsets) - 1 + len(self.added)
+
+    def __getitem__(self, row):
+        base = len(self.offsets) - 1
+        if row >= base:
+            return self.added[row - base]
+        return bytes(self.blob[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def append(self, value):
+        self.added.append(value)
+
+    def save(self, path, name, rows):
+        encoded = [self[row].encode("utf-8") for row in rows]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(os.path.join(path, f"{name}_offsets.npy"), offsets)
+        np.save(os.path.join(path, f"{name}.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path, name):
+        return cls(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"),
+                   np.load(os.path.join(path, f"{name}_offsets.npy"), mmap_mode="r"))
+
+
+class SparseHit:
+    """One result, readable like a Whoosh hit: ``hit["content"]``, ``hit.get("record")``, ``hit.score``."""
+    __slots__ = ("_index", "row", "score")
+
+    def __init__(self, index, row, score):
+        self._index = index
+        self.row = row
+        self.score = score
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        if name == "id":
+            return self._index.ids[self.row]
+        if name == "content":
+            return self._index.contents[self.row]
+        if name == "record":
+            return self._index.records[self.row] or default
+        if name == "timestamp":
+            return datetime.fromtimestamp(self._index.timestamps[self.row])
+        return default
+
+
+class SparseBM25Index:
+    """Term-document matrix scored with BM25 at query time, as an in-memory lexical backend.
+
+    Tokens come from Whoosh's StandardAnalyzer and the weights use Whoosh's
+    BM25F formula and idf, so a query hits the same documents as
+    ``searcher.search`` on the content field, but scores are close rather
+    than equal and the top of the ranking can differ: Whoosh stores field
+    lengths rounded to one byte, and keeps deleted documents in its counts
+    and lengths until their segment is merged (after deleting 300 of 3000
+    tickets, "login" scores 4.7758 there against 4.8472 here). A query
+    slices the term columns it needs and weights only those, against exact
+    document frequencies and lengths that adds and deletes keep up to date;
+    the date range is a boolean mask over the timestamp column.
+
+    Added documents wait in a small pending matrix that is folded into the
+    main one once it reaches ``FOLD_ROWS`` or an eighth of the index, so a
+    trickle of adds doesn't copy the whole matrix each time. All reads and
+    writes hold ``_lock``. ``save`` writes plain .npy arrays which ``load``
+    memory maps.
+    """
+    B = 0.75
+    K1 = 1.2
+    FOLD_ROWS = 1024
+
+    def __init__(self):
+        self.analyzer = StandardAnalyzer()
+        self.vocab = {}
+        self.ids = []
+        self.rows = {}
+        self.contents = _StoredColumn()
+        self.records = _StoredColumn()
+        self.timestamps = np.zeros(0, dtype=np.float64)
+        self.lengths = np.zeros(0, dtype=np.float64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.generation = -1
+        # Folded rows, by row for deletes and by column for queries
+        self._tf = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._tf_columns = sparse.csc_matrix((0, 0), dtype=np.float32)
+        # Live document frequency per term and total live length
+        self._df = np.zeros(0, dtype=np.int64)
+        self._total_length = 0.0
+        self._pending = []
+        self._pending_columns = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def tokens(self, text):
+        return [token.text for token in self.analyzer(text)]
+
+    def add(self, doc_ids: List[str], contents: List[str], timestamps: List[float], records: Optional[List[str]] = None):
+        """Index documents; an id that is already indexed is replaced."""
+        with self._lock:
+            self.delete([doc_id for doc_id in doc_ids if doc_id in self.rows])
+            lengths = []
+            for doc_id, content, record in zip(doc_ids, contents, records or [""] * len(doc_ids)):
+                counts = {}
+                for token in self.tokens(content):
+                    column = self.vocab.setdefault(token, len(self.vocab))
+                    counts[column] = counts.get(column, 0) + 1
+                self.rows[doc_id] = len(self.ids)
+                self.ids.append(doc_id)
+                self.contents.append(content)
+                self.records.append(record or "")
+                self._pending.append(counts)
+                lengths.append(sum(counts.values()))
+            if len(self._df) < len(self.vocab):
+                self._df = np.concatenate([self._df, np.zeros(len(self.vocab) - len(self._df), dtype=np.int64)])
+            for counts in self._pending[len(self._pending) - len(lengths):]:
+                self._df[list(counts)] += 1
+            self._total_length += sum(lengths)
+            self.timestamps = np.concatenate([self.timestamps, np.asarray(timestamps[:len(lengths)], dtype=np.float64)])
+            self.lengths = np.concatenate([self.lengths, np.asarray(lengths, dtype=np.float64)])
+            self.alive = np.concatenate([self.alive, np.ones(len(lengths), dtype=bool)])
+            self._pending_columns = None
+
+    def delete(self, doc_ids: List[str]):
+        with self._lock:
+            folded = self._tf.shape[0]
+            for doc_id in doc_ids:
+                row = self.rows.pop(doc_id, None)
+                if row is None:
+                    continue
+                if row < folded:
+                    columns = self._tf.indices[self._tf.indptr[row]:self._tf.indptr[row + 1]]
+                else:
+                    columns = list(self._pending[row - folded])
+                self._df[columns] -= 1
+                self._total_length -= self.lengths[row]
+                self.alive[row] = False
+
+    def _pending_matrix(self, width):
+        indptr = np.zeros(len(self._pending) + 1, dtype=np.int64)
+        np.cumsum([len(counts) for counts in self._pending], out=indptr[1:])
+        indices = np.fromiter((c for counts in self._pending for c in counts), dtype=np.int32, count=indptr[-1])
+        data = np.fromiter((n for counts in self._pending for n in counts.values()), dtype=np.float32,
+                           count=indptr[-1])
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(self._pending), width))
+
+    def _fold_pending(self):
+        if not self._pending:
+            return
+        tf = self._tf
+        if tf.shape[1] < len(self.vocab):
+            tf = sparse.csr_matrix((tf.data, tf.indices, tf.indptr), shape=(tf.shape[0], len(self.vocab)))
+        self._tf = sparse.vstack([tf, self._pending_matrix(len(self.vocab))], format="csr")
+        self._tf_columns = self._tf.tocsc()
+        self._pending = []
+        self._pending_columns = None
+
+    def _score_columns(self, block, first_row, idf, avgdl, scores, matched):
+        """Add the BM25 weights of a column slice (rows from ``first_row``) into ``scores``."""
+        rows = block.indices + first_row
+        tf = block.data.astype(np.float64)
+        norm = self.K1 * ((1 - self.B) + self.B * self.lengths[rows] / avgdl)
+        weights = np.repeat(idf, np.diff(block.indptr)) * (tf * (self.K1 + 1)) / (tf + norm)
+        scores += np.bincount(rows, weights=weights, minlength=len(scores))
+        matched += np.bincount(rows, minlength=len(matched))
+
+    def search(self, terms: Optional[List[str]], start: Optional[float] = None, end: Optional[float] = None):
+        """Hits for an AND of ``terms`` (every document when None) within [start, end], best first.
+
+        As with Whoosh's ``And(query, DateRange)``, a date range adds its
+        constant score of 1.0 to every hit, which keeps the score cut in
+        ``RAGApplication.search`` behaving the same on either backend.
+        """
+        with self._lock:
+            if len(self._pending) >= max(self.FOLD_ROWS, self._tf.shape[0] // 8):
+                self._fold_pending()
+            mask = self.alive.copy()
+            if start is not None:
+                mask &= self.timestamps >= start
+            if end is not None:
+                mask &= self.timestamps <= end
+
+            if terms is None:
+                rows = np.flatnonzero(mask)
+                return [SparseHit(self, row, 1.0) for row in rows.tolist()]
+            columns = [self.vocab.get(term) for term in dict.fromkeys(terms)]
+            if not columns or None in columns:
+                return []
+
+            n_docs = len(self.rows)
+            idf = np.log(n_docs / (self._df[columns] + 1)) + 1
+            avgdl = (self._total_length / n_docs if n_docs else 0.0) or 1.0
+            scores = np.zeros(len(self.ids), dtype=np.float64)
+            matched = np.zeros(len(self.ids), dtype=np.int64)
+            if max(columns) < self._tf_columns.shape[1]:
+                self._score_columns(self._tf_columns[:, columns], 0, idf, avgdl, scores, matched)
+            if self._pending:
+                if self._pending_columns is None:
+                    self._pending_columns = self._pending_matrix(len(self.vocab)).tocsc()
+                self._score_columns(self._pending_columns[:, columns], self._tf.shape[0], idf, avgdl, scores, matched)
+            if start is not None or end is not None:
+                scores += 1.0
+            rows = np.flatnonzero(mask & (matched == len(columns)))
+            order = np.argsort(-scores[rows], kind="stable")
+            return [SparseHit(self, row, float(score)) for row, score in zip(rows[order].tolist(),
+                                                                              scores[rows][order].tolist())]
+
+    def save(self, path: str, generation: Optional[int] = None):
+        """Drop deleted rows and write the index to ``path`` as .npy arrays, replacing what is there.
+
+        ``generation`` is the Whoosh generation the index matches, so a stale
+        copy can be detected on load.
+        """
+        with self._lock:
+            if generation is not None:
+                self.generation = generation
+            self._fold_pending()
+            live_rows = np.flatnonzero(self.alive)
+            tf = self._tf[live_rows]
+            self._tf, self.timestamps, self.lengths = tf, self.timestamps[live_rows], self.lengths[live_rows]
+            self._tf_columns = columns = tf.tocsc()
+            self.ids = [self.ids[row] for row in live_rows.tolist()]
+            self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+            self.alive = np.ones(len(self.ids), dtype=bool)
+
+            tmp = path + ".tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            for name, array in (("tf_data", tf.data), ("tf_indices", tf.indices), ("tf_indptr", tf.indptr),
+                                ("tfc_data", columns.data), ("tfc_indices", columns.indices),
+                                ("tfc_indptr", columns.indptr),
+                                ("timestamps", self.timestamps), ("lengths", self.lengths)):
+                np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(array))
+            self.contents.save(tmp, "contents", live_rows.tolist())
+            self.records.save(tmp, "records", live_rows.tolist())
+            vocab = sorted(self.vocab, key=self.vocab.get)
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"format": SPARSE_FORMAT, "generation": self.generation, "n_terms": len(vocab),
+                           "ids": self.ids, "vocab": vocab}, f)
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp, path)
+            # Stored strings are now served from the saved files
+            self.contents = _StoredColumn.load(path, "contents")
+            self.records = _StoredColumn.load(path, "records")
+
+    @classmethod
+    def load(cls, path: str) -> "SparseBM25Index":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format"] != SPARSE_FORMAT:
+            raise ValueError(f"Sparse index format {meta['format']} is not supported")
+        index = cls()
+        index.generation = meta["generation"]
+        index.vocab = {term: column for column, term in enumerate(meta["vocab"])}
+        index.ids = meta["ids"]
+        index.rows = {doc_id: row for row, doc_id in enumerate(index.ids)}
+
+        def array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        shape = (len(index.ids), meta["n_terms"])
+        index._tf = sparse.csr_matrix((array("tf_data"), array("tf_indices"), array("tf_indptr")),
+                                      shape=shape, copy=False)
+        index._tf_columns = sparse.csc_matrix((array("tfc_data"), array("tfc_indices"), array("tfc_indptr")),
+                                              shape=shape, copy=False)
+        index.timestamps = np.asarray(array("timestamps"))
+        index.lengths = np.array(array("lengths"))
+        index.alive = np.ones(len(index.ids), dtype=bool)
+        # Every saved row is live
+        index._df = np.diff(index._tf_columns.indptr).astype(np.int64)
+        index._total_length = float(index.lengths.sum())
+        index.contents = _StoredColumn.load(path, "contents")
+        index.records = _StoredColumn.load(path, "records")
+        return index
+
+    @classmethod
+    def from_whoosh(cls, whoosh_index, batch_size=10000) -> "SparseBM25Index":
+        """Build from the stored fields of a Whoosh index built with ``RAGApplication.build_schema``."""
+        index = cls()
+        with whoosh_index.searcher() as searcher:
+            batch = []
+            for fields in searcher.all_stored_fields():
+                batch.append(fields)
+                if len(batch) >= batch_size:
+                    index._add_stored(batch)
+                    batch = []
+            index._add_stored(batch)
+        index.generation = whoosh_index.latest_generation()
+        return index
+
+    def _add_stored(self, batch):
+        self.add([fields["id"] for fields in batch],
+                 [fields["content"] for fields in batch],
+                 [fields["timestamp"].timestamp() for fields in batch],
+                 [fields.get("record", "") for fields in batch])
@@ -0,0 +1,154 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Sequence
+
+from azOAI import AzureOpenAIChat
+from context_packer import count_tokens, estimate_row_tokens
+from table_new import create_markdown_table
+
+logger = logging.getLogger(__name__)
+
+MAP_PROMPT = """Analyze the following markdown table of software issues.
+Summarize the issues, resolutions and trends it contains. Refer to entries by Serial number when specific.
+Keep the summary concise; it will be merged with summaries of other parts of the same data.
+
+Question: {question}
+
+{table}"""
+
+REDUCE_PROMPT = """The following are partial summaries of different parts of the same set of software issues.
+Merge them into a single summary that answers the question. Combine counts and trends across parts,
+keep Serial number references, and do not repeat points.
+
+Question: {question}
+
+{summaries}"""
+
+
+def chunk_rows(rows: Sequence[dict], chunk_tokens: int, columns: Optional[List[str]] = None) -> List[List[dict]]:
+    """Greedily split rows, in order, into chunks of at most ``chunk_tokens`` (estimated)."""
+    chunks, current, used = [], [], 0
+    for row in rows:
+        cost = estimate_row_tokens(row, columns)
+        if current and used + cost > chunk_tokens:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(row)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def group_texts(texts: Sequence[str], group_tokens: int) -> List[List[str]]:
+    groups, current, used = [], [], 0
+    for text in texts:
+        cost = count_tokens(text)
+        if current and used + cost > group_tokens:
+            groups.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
+
+
+class MapReduceSummarizer:
+    """Summarize more rows than fit in one prompt.
+
+    Rows are split into token-bounded chunks that are summarized concurrently
+    (at most ``max_workers`` requests in flight), then the partial summaries
+    are merged level by level until one remains. Wall time is roughly the
+    slowest chunk per level rather than the sum over all chunks.
+
+    ``progress`` is called as ``progress(stage, done, total)`` with stage
+    ``"map"`` or ``"reduce:<level>"``. Chunk summaries are cached by the
+    hash of their prompt, in memory or in a ``ResponseCache`` if given.
+    """
+
+    def __init__(self,
+                 llm: Optional[AzureOpenAIChat] = None,
+                 chunk_tokens: int = 6000,
+                 reduce_tokens: int = 6000,
+                 max_workers: int = 8,
+                 columns: Optional[List[str]] = None,
+                 code_columns: Sequence[str] = ("Issue", "Resolution", "Context"),
+                 cache=None,
+                 progress: Optional[Callable[[str, int, int], None]] = None):
+        self.llm = llm if llm is not None else AzureOpenAIChat()
+        self.chunk_tokens = chunk_tokens
+        self.reduce_tokens = reduce_tokens
+        self.max_workers = max_workers
+        self.columns = columns
+        self.code_columns = list(code_columns)
+        self.cache = cache
+        self.progress = progress
+        self._memory_cache = {}
+        self._lock = threading.Lock()
+
+    def _cached_complete(self, prompt: str) -> str:
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if self.cache is not None:
+            cached = self.cache.get(key, "map-reduce", semantic=False)
+        else:
+            with self._lock:
+                cached = self._memory_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # The shared response cache would match near-identical chunk prompts; chunks are cached by exact hash above
+        summary = self.llm.generate_response(prompt, use_cache=False)
+        if self.cache is not None:
+            self.cache.put(key, summary, "map-reduce", semantic=False)
+        else:
+            with self._lock:
+                self._memory_cache[key] = summary
+        return summary
+
+    def _run_all(self, stage: str, prompts: List[str]) -> List[str]:
+        results = [None] * len(prompts)
+        if self.progress:
+            self.progress(stage, 0, len(prompts))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._cached_complete, prompt): i for i, prompt in enumerate(prompts)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                results[futures[future]] = future.result()
+                if self.progress:
+                    self.progress(stage, done, len(prompts))
+        return results
+
+    def summarize(self, rows: Sequence[dict], question: str) -> str:
+        chunks = chunk_rows(rows, self.chunk_tokens, self.columns)
+        if not chunks:
+            return ""
+        logger.info(f"Summarizing {len(rows)} rows in {len(chunks)} chunks")
+
+        prompts = [MAP_PROMPT.format(question=question,
+                                     table=create_markdown_table(chunk, columns=self.columns,
+                                                                 code_columns=self.code_columns))
+                   for chunk in chunks]
+        summaries = self._run_all("map", prompts)
+
+        level = 1
+        while len(summaries) > 1:
+            groups = group_texts(summaries, self.reduce_tokens)
+            if len(groups) == len(summaries):
+                # Every summary is already over budget on its own; merge pairwise so the loop terminates
+                groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+            prompts = [REDUCE_PROMPT.format(question=question, summaries="\n\n---\n\n".join(group))
+                       for group in groups]
+            summaries = self._run_all(f"reduce:{level}", prompts)
+            level += 1
+
+        return summaries[0]
+
+
+if __name__ == "__main__":
+    rows = [{"Serial": str(i), "Date": "01/08/2024", "Category": "Access issue",
+             "Issue": f"User {i} cannot log in", "Resolution": "Password reset", "Tag": "Access"}
+            for i in range(1, 2001)]
+    summarizer = MapReduceSummarizer(progress=lambda stage, done, total: print(f"{stage}: {done}/{total}"))
+    print(summarizer.summarize(rows, "Give me a summary of all the issues in August."))
@@ -1,77 +1,166 @@
 
 
+import csv
+import io
 import textwrap
 import json
 import re
 
+from tracing import tracer, traced
 
-def create_markdown_table(data, columns=None, max_width=50, code_columns=[]):
-    all_headers = ["Serial", "Date", "Category", "Issue", "Resolution", "Context", "Tag"]
 
-    headers = columns if columns else all_headers
-    headers = [h for h in headers if h in all_headers]
+ALL_HEADERS = ["Serial", "Date", "Category", "Issue", "Resolution", "Context", "Tag"]
 
-    def is_json(text):
-        try:
-            json.loads(text)
-            return True
-        except:
-            return False
+# Potential code blocks: indented lines or fenced with backticks
+CODE_PATTERN = re.compile(r'(^( {4,}|\t).*$)|(```[\s\S]*?```)', re.MULTILINE)
 
-    def format_code_or_json(text):
-        if is_json(text):
-            return json.dumps(json.loads(text), indent=2)
-        else:
-            return textwrap.indent(text.strip(), '  ')
+# One-line descriptions to put in the prompt in place of the markdown table wording
+FORMAT_HINTS = {
+    "markdown": "Table uses standard markdown format with | and - as separators.",
+    "tsv": "Table is tab separated with a header row; cells containing tabs, newlines or quotes are "
+           "double-quoted with inner quotes doubled.",
+    "records": "Each record starts with '## Serial <n>' followed by 'Column: value' lines; "
+               "multi-line values start on the line after 'Column:'.",
+}
 
-    def process_mixed_content(text, width):
-        # Regex to find potential code blocks (indented or between backticks)
-        code_pattern = r'(^( {4,}|\t).*$)|(```[\s\S]*?```)'
 
-        parts = re.split(code_pattern, text, flags=re.MULTILINE)
-        formatted_parts = []
+def _format_code_or_json(text):
+    try:
+        return json.dumps(json.loads(text), indent=2)
+    except ValueError:
+        return textwrap.indent(text.strip(), '  ')
 
-        for part in parts:
-            if part:
-                if re.match(code_pattern, part, re.MULTILINE):
-                    # This is a code block, preserve its structure
-                    formatted_parts.append(format_code_or_json(part))
-                else:
-                    # This is regular text, wrap it
-                    formatted_parts.append('\n'.join(textwrap.wrap(part, width)))
 
-        return '\n'.join(formatted_parts)
+def _process_mixed_content(text, width):
+    formatted_parts = []
+    for part in CODE_PATTERN.split(text):
+        if part:
+            if CODE_PATTERN.match(part):
+                # This is a code block, preserve its structure
+                formatted_parts.append(_format_code_or_json(part))
+            else:
+                # This is regular text, wrap it
+                formatted_parts.append('\n'.join(textwrap.wrap(part, width)))
+    return '\n'.join(formatted_parts)
 
-    def wrap_text(text, width, is_code_column):
-        if is_code_column:
-            return process_mixed_content(text, width)
-        else:
-            return '\n'.join(textwrap.wrap(text, width))
 
-    # Determine the maximum width for each column
-    col_widths = {header: max(len(header), min(max_width, max(
-        len(line) for row in data for line in str(row.get(header, '')).split('\n')))) for header in headers}
+def _wrap_text(text, width, is_code_column):
+    if is_code_column:
+        return _process_mixed_content(text, width)
+    return '\n'.join(textwrap.wrap(text, width))
+
 
-    separator_row = "|" + "|".join('-' * (col_widths[header] + 2) for header in headers) + "|"
-    table = f"{separator_row}\n"
-    header_row = "| " + " | ".join(header.ljust(col_widths[header]) for header in headers) + " |"
-    table += f"{header_row}\n{separator_row}\n"
+def rendered_headers(columns=None):
+    """The columns a table of ``columns`` shows: the known ones, in the order given (all by default)."""
+    headers = columns if columns else ALL_HEADERS
+    return [h for h in headers if h in ALL_HEADERS]
 
+
+def _column_widths(data, headers, max_width):
+    # One pass over the cells; a column stops being measured once it reaches the cap
+    widths = {header: 0 for header in headers}
+    open_headers = list(headers)
     for row in data:
-        wrapped_row = [wrap_text(str(row.get(header, '')), col_widths[header], header in code_columns).split('\n') for
-                       header in headers]
-        max_lines = max(len(cell) for cell in wrapped_row)
+        if not open_headers:
+            break
+        for header in open_headers:
+            text = str(row.get(header, ''))
+            if len(text) > widths[header]:
+                widths[header] = max(widths[header], max(len(line) for line in text.split('\n')))
+        open_headers = [header for header in open_headers if widths[header] < max_width]
+    return {header: max(len(header), min(max_width, widths[header])) for header in headers}
+
+
+def iter_markdown_table(data, columns=None, max_width=50, code_columns=()):
+    """Yield the markdown table of ``data`` one row block at a time."""
+    headers = rendered_headers(columns)
+    col_widths = _column_widths(data, headers, max_width)
 
+    separator_row = "|" + "|".join('-' * (col_widths[header] + 2) for header in headers) + "|\n"
+    header_row = "| " + " | ".join(header.ljust(col_widths[header]) for header in headers) + " |\n"
+    yield separator_row + header_row + separator_row
+
+    for row in data:
+        wrapped_row = [_wrap_text(str(row.get(header, '')), col_widths[header], header in code_columns).split('\n')
+                       for header in headers]
+        max_lines = max(len(cell) for cell in wrapped_row)
+        lines = []
         for i in range(max_lines):
             line = "| "
-            for j, header in enumerate(headers):
-                cell_lines = wrapped_row[j]
+            for cell_lines, header in zip(wrapped_row, headers):
                 cell_content = cell_lines[i] if i < len(cell_lines) else ''
                 line += cell_content.ljust(col_widths[header]) + " | "
-            table += line + "\n"
-        table += separator_row + "\n"
+            lines.append(line + "\n")
+        lines.append(separator_row)
+        yield "".join(lines)
+
+
+def iter_tsv_table(data, columns=None, **_):
+    """Yield a tab separated table; code and JSON stay verbatim inside quoted cells."""
+    headers = rendered_headers(columns)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter="\t", lineterminator="\n")
+    writer.writerow(headers)
+    for row in data:
+        writer.writerow([str(row.get(header, '')) for header in headers])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_record_table(data, columns=None, **_):
+    """Yield one "Column: value" block per row; code and JSON stay verbatim."""
+    headers = rendered_headers(columns)
+    for row in data:
+        lines = [f"## Serial {row.get('Serial', '')}\n"]
+        for header in headers:
+            if header == "Serial":
+                continue
+            value = str(row.get(header, ''))
+            if not value.strip():
+                continue
+            # Keep leading indentation, it may belong to an indented code block
+            value = value.strip('\n').rstrip()
+            if '\n' in value:
+                lines.append(f"{header}:\n{value}\n")
+            else:
+                lines.append(f"{header}: {value}\n")
+        lines.append("\n")
+        yield "".join(lines)
+
+
+RENDERERS = {
+    "markdown": iter_markdown_table,
+    "tsv": iter_tsv_table,
+    "records": iter_record_table,
+}
+
+
+@traced("render_table")
+def render_table(data, columns=None, fmt="markdown", max_width=50, code_columns=(), out=None):
+    """Render ``data`` in one of ``RENDERERS``; "tsv" and "records" are much cheaper in prompt tokens.
+
+    Rows are written to ``out`` (any object with ``write``) as they are
+    rendered; without ``out`` the table is returned as a string.
+    """
+    if not isinstance(data, (list, tuple)):
+        data = list(data)
+    try:
+        renderer = RENDERERS[fmt]
+    except KeyError:
+        raise ValueError(f"Unknown table format: {fmt}")
+    buffer = out if out is not None else io.StringIO()
+    size = 0
+    for chunk in renderer(data, columns=columns, max_width=max_width, code_columns=code_columns):
+        buffer.write(chunk)
+        size += len(chunk)
+    tracer.current_span().set(rows=len(data), bytes=size, format=fmt)
+    return None if out is not None else buffer.getvalue()
+
 
-    return table
+def create_markdown_table(data, columns=None, max_width=50, code_columns=[]):
+    return render_table(data, columns=columns, fmt="markdown", max_width=max_width, code_columns=code_columns)
 
 
 from collections import defaultdict
@@ -79,40 +168,50 @@ from datetime import datetime
 import calendar
 
 
-def generate_summary_with_date_range(data, start_date=None, end_date=None, categories=None, group_ids=None, tags=None):
-    def parse_date(date_str):
-        return datetime.strptime(date_str, "%d/%m/%Y")
+def _parse_date(date_str):
+    return datetime.strptime(date_str, "%d/%m/%Y")
+
+
+def _get_date_range_key(date, start, end):
+    if start and date.month == start.month and date.year == start.year:
+        return (start, f"{start.strftime('%d-%B-%Y')} to {date.replace(day=calendar.monthrange(date.year, date.month)[1]).strftime('%d-%B-%Y')}")
+    elif end and date.month == end.month and date.year == end.year:
+        return (date.replace(day=1), f"{date.replace(day=1).strftime('%d-%B-%Y')} to {end.strftime('%d-%B-%Y')}")
+    else:
+        return (date.replace(day=1), f"{date.replace(day=1).strftime('%d-%B-%Y')} to {date.replace(day=calendar.monthrange(date.year, date.month)[1]).strftime('%d-%B-%Y')}")
+
+
+def _new_counts():
+    return {
+        "category": defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)}),
+        "groupid": defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)}),
+        "tag": defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)}),
+        "category_tag": defaultdict(lambda: defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)})),
+        "category_groupid": defaultdict(lambda: defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)})),
+        "groupid_tag": defaultdict(lambda: defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)})),
+    }
 
-    def get_date_range_key(date, start, end):
-        if date.month == start.month and date.year == start.year:
-            return (start, f"{start.strftime('%d-%B-%Y')} to {date.replace(day=calendar.monthrange(date.year, date.month)[1]).strftime('%d-%B-%Y')}")
-        elif date.month == end.month and date.year == end.year:
-            return (date.replace(day=1), f"{date.replace(day=1).strftime('%d-%B-%Y')} to {end.strftime('%d-%B-%Y')}")
-        else:
-            return (date.replace(day=1), f"{date.replace(day=1).strftime('%d-%B-%Y')} to {date.replace(day=calendar.monthrange(date.year, date.month)[1]).strftime('%d-%B-%Y')}")
 
+def _aggregate_rows(data, start_date, end_date, categories, group_ids, tags):
     def split_and_strip(value):
         return [item.strip() for item in value.split(',')] if value else []
 
-    start_date = parse_date(start_date) if start_date else None
-    end_date = parse_date(end_date) if end_date else None
+    counts = _new_counts()
+    category_count = counts["category"]
+    groupid_count = counts["groupid"]
+    tag_count = counts["tag"]
+    category_tag_count = counts["category_tag"]
+    category_groupid_count = counts["category_groupid"]
+    groupid_tag_count = counts["groupid_tag"]
 
-    category_count = defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)})
-    groupid_count = defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)})
-    tag_count = defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)})
-    
-    category_tag_count = defaultdict(lambda: defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)}))
-    category_groupid_count = defaultdict(lambda: defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)}))
-    groupid_tag_count = defaultdict(lambda: defaultdict(lambda: {"total": 0, "date_ranges": defaultdict(int)}))
-    
     fields_present = set()
 
     for row in data:
-        date = parse_date(row['Date'])
+        date = _parse_date(row['Date'])
         if (start_date and date < start_date) or (end_date and date > end_date):
             continue
 
-        sort_key, date_range_key = get_date_range_key(date, start_date, end_date)
+        sort_key, date_range_key = _get_date_range_key(date, start_date, end_date)
         
         category = row.get('Category')
         groupids = split_and_strip(row.get('GroupID', ''))
@@ -154,6 +253,15 @@ def generate_summary_with_date_range(data, start_date=None, end_date=None, categ
                     groupid_tag_count[groupid][tag]["total"] += 1
                     groupid_tag_count[groupid][tag]["date_ranges"][(sort_key, date_range_key)] += 1
 
+    date_bounds = None
+    if not start_date and not end_date and len(data):
+        dates = [_parse_date(row['Date']) for row in data]
+        date_bounds = (min(dates), max(dates))
+
+    return counts, fields_present, date_bounds
+
+
+def _format_summary(counts, fields_present, start_date, end_date, date_bounds, categories, group_ids, tags):
     summary = []
     
     def format_date_range_count(counts):
@@ -191,11 +299,11 @@ def generate_summary_with_date_range(data, start_date=None, end_date=None, categ
 
     # Individual summaries
     if 'Category' in fields_present:
-        add_summary_section("Category", category_count, categories)
+        add_summary_section("Category", counts["category"], categories)
     if 'GroupID' in fields_present:
-        add_summary_section("GroupID", groupid_count, group_ids)
+        add_summary_section("GroupID", counts["groupid"], group_ids)
     if 'Tag' in fields_present:
-        add_summary_section("Tag", tag_count, tags)
+        add_summary_section("Tag", counts["tag"], tags)
 
     def add_association_summary(title, count_dict, filter_list1=None, filter_list2=None):
         summary.append(f"\n{title}:")
@@ -223,15 +331,15 @@ def generate_summary_with_date_range(data, start_date=None, end_date=None, categ
 
     # Category-Tag associations
     if 'Category' in fields_present and 'Tag' in fields_present:
-        add_association_summary("Category-Tag", category_tag_count, categories, tags)
+        add_association_summary("Category-Tag", counts["category_tag"], categories, tags)
 
     # Category-GroupID associations
     if 'Category' in fields_present and 'GroupID' in fields_present:
-        add_association_summary("Category-GroupID", category_groupid_count, categories, group_ids)
+        add_association_summary("Category-GroupID", counts["category_groupid"], categories, group_ids)
 
     # GroupID-Tag associations
     if 'GroupID' in fields_present and 'Tag' in fields_present:
-        add_association_summary("GroupID-Tag", groupid_tag_count, group_ids, tags)
+        add_association_summary("GroupID-Tag", counts["groupid_tag"], group_ids, tags)
 
     # Date range info
     date_format = "%d-%B-%Y"
@@ -241,10 +349,9 @@ def generate_summary_with_date_range(data, start_date=None, end_date=None, categ
         summary.append(f"\nDate range: From {start_date.strftime(date_format)}")
     elif end_date:
         summary.append(f"\nDate range: Up to {end_date.strftime(date_format)}")
-    else:
-        dates = [parse_date(row['Date']) for row in data]
-        min_date = min(dates).strftime(date_format)
-        max_date = max(dates).strftime(date_format)
+    elif date_bounds:
+        min_date = date_bounds[0].strftime(date_format)
+        max_date = date_bounds[1].strftime(date_format)
         summary.append(f"\nDate range: {min_date} to {max_date}")
 
     summary.append("All dates are in %d/%m/%Y or %d-%B-%Y format.")
@@ -252,32 +359,57 @@ def generate_summary_with_date_range(data, start_date=None, end_date=None, categ
     return "\n".join(summary)
 
 
-# Example usage
-data = [
-    {"Serial": "1", "Date": "02/06/2024", "Category": "Access issue", "Tag": "Critical", "GroupID": "Access-Team"},
-    {"Serial": "2", "Date": "15/06/2024", "Category": "Payment issue", "Tag": "High-priority", "GroupID": "Payment-Team"},
-    {"Serial": "3", "Date": "30/06/2024", "Category": "Access issue", "Tag": "User impact", "GroupID": "Access-Team"},
-    {"Serial": "4", "Date": "05/07/2024", "Category": "Payment issue", "Tag": "Financial", "GroupID": "Payment-Team"},
-    {"Serial": "5", "Date": "10/07/2024", "Category": "Access issue", "Tag": "Security", "GroupID": "Access-Team"},
-    {"Serial": "6", "Date": "12/07/2024", "Category": "Payment issue", "Tag": "API", "GroupID": "Payment-Team"},
-]
-
-
-# Example usage with all columns, specifying code columns
-print("Table with all columns, preserving embedded code and JSON:")
-all_columns_table = create_markdown_table(data, code_columns=["Issue", "Resolution", "Context"])
-print(all_columns_table)
-#
-# Example usage with selected columns
-print("\nTable with selected columns:")
-selected_columns_table = create_markdown_table(data, columns=["Serial", "Issue", "Resolution"],
-                                               code_columns=["Issue", "Resolution"])
-# print(selected_columns_table)
-
-# Generate summary for the specific date range and filtered categories
-start_date = "02/06/2024"
-end_date = "12/07/2024"
-filtered_categories = ["Access issue"]
-summary = generate_summary_with_date_range(data, start_date=start_date, end_date=end_date,
-                                           categories=filtered_categories)
-print(selected_columns_table + "\n" + summary)
+@traced("summary")
+def generate_summary_with_date_range(data, start_date=None, end_date=None, categories=None, group_ids=None, tags=None,
+                                     backend="python"):
+    """Summarize record counts per Category/GroupID/Tag and their associations by month.
+
+    ``backend="columnar"`` aggregates with vectorized pandas group-bys (see
+    summary_columnar.py); the text is identical to the default row loop.
+    """
+    start_date = _parse_date(start_date) if start_date else None
+    end_date = _parse_date(end_date) if end_date else None
+
+    if backend == "columnar":
+        from summary_columnar import aggregate_columnar
+        counts, fields_present, date_bounds = aggregate_columnar(data, start_date, end_date, categories, group_ids, tags)
+    elif backend == "python":
+        counts, fields_present, date_bounds = _aggregate_rows(data, start_date, end_date, categories, group_ids, tags)
+    else:
+        raise ValueError(f"Unknown summary backend: {backend}")
+
+    summary = _format_summary(counts, fields_present, start_date, end_date, date_bounds, categories, group_ids, tags)
+    tracer.current_span().set(rows=len(data), bytes=len(summary))
+    return summary
+
+
+if __name__ == "__main__":
+    # Example usage
+    data = [
+        {"Serial": "1", "Date": "02/06/2024", "Category": "Access issue", "Tag": "Critical", "GroupID": "Access-Team"},
+        {"Serial": "2", "Date": "15/06/2024", "Category": "Payment issue", "Tag": "High-priority", "GroupID": "Payment-Team"},
+        {"Serial": "3", "Date": "30/06/2024", "Category": "Access issue", "Tag": "User impact", "GroupID": "Access-Team"},
+        {"Serial": "4", "Date": "05/07/2024", "Category": "Payment issue", "Tag": "Financial", "GroupID": "Payment-Team"},
+        {"Serial": "5", "Date": "10/07/2024", "Category": "Access issue", "Tag": "Security", "GroupID": "Access-Team"},
+        {"Serial": "6", "Date": "12/07/2024", "Category": "Payment issue", "Tag": "API", "GroupID": "Payment-Team"},
+    ]
+
+
+    # Example usage with all columns, specifying code columns
+    print("Table with all columns, preserving embedded code and JSON:")
+    all_columns_table = create_markdown_table(data, code_columns=["Issue", "Resolution", "Context"])
+    print(all_columns_table)
+    #
+    # Example usage with selected columns
+    print("\nTable with selected columns:")
+    selected_columns_table = create_markdown_table(data, columns=["Serial", "Issue", "Resolution"],
+                                                   code_columns=["Issue", "Resolution"])
+    # print(selected_columns_table)
+
+    # Generate summary for the specific date range and filtered categories
+    start_date = "02/06/2024"
+    end_date = "12/07/2024"
+    filtered_categories = ["Access issue"]
+    summary = generate_summary_with_date_range(data, start_date=start_date, end_date=end_date,
+                                               categories=filtered_categories)
+    print(selected_columns_table + "\n" + summary)
@@ -0,0 +1,249 @@
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attrs")
+
+    def __init__(self, name, trace_id, parent_id=None, attrs=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = dict(attrs) if attrs else {}
+
+    def set(self, **attrs):
+        """Attach sizes such as candidate counts, tokens or bytes to the span."""
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration_ms": None if self.duration is None else self.duration * 1000,
+            "attrs": self.attrs,
+        }
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonLinesExporter:
+    """Append each finished span as one JSON line, through one file handle kept open until ``close``."""
+
+    def __init__(self, path: str = "traces.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, span: Span):
+        line = json.dumps(span.as_dict(), default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class HistogramExporter:
+    """Keep per-stage duration histograms in memory (log2 buckets in ms).
+
+    Percentiles come from the last ``max_samples`` durations of each stage,
+    so they follow the current latency rather than the first requests'.
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        self._lock = threading.Lock()
+        self.max_samples = max_samples
+        self.buckets: Dict[str, Counter] = defaultdict(Counter)
+        self.durations: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.max_samples))
+
+    def export(self, span: Span):
+        ms = span.duration * 1000
+        bucket = 0 if ms < 1 else 1 << int(ms).bit_length()
+        with self._lock:
+            self.buckets[span.name][bucket] += 1
+            self.durations[span.name].append(ms)
+
+    def percentile(self, name: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.durations.get(name, []))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q / 100 * len(samples)))]
+
+    def summary(self) -> dict:
+        return {name: {"count": sum(self.buckets[name].values()),
+                       "p50_ms": self.percentile(name, 50),
+                       "p99_ms": self.percentile(name, 99),
+                       "buckets_ms": dict(sorted(self.buckets[name].items()))}
+                for name in list(self.buckets)}
+
+
+class SamplingProfiler:
+    """Sample the stack of a thread while a root span is open.
+
+    Samples are only reported when the request turns out slower than
+    ``threshold_seconds``, so fast requests pay for the sampler thread only.
+    """
+
+    def __init__(self, threshold_seconds: float = 2.0, interval: float = 0.01, top: int = 10):
+        self.threshold_seconds = threshold_seconds
+        self.interval = interval
+        self.top = top
+
+    def start(self, thread_id: int):
+        stop = threading.Event()
+        samples = Counter()
+
+        def sample():
+            while not stop.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    stack = traceback.extract_stack(frame)
+                    samples[" <- ".join(f"{f.name}({os.path.basename(f.filename)}:{f.lineno})"
+                                        for f in reversed(stack[-6:]))] += 1
+
+        threading.Thread(target=sample, daemon=True).start()
+        return stop, samples
+
+    def finish(self, handle, span: Span):
+        stop, samples = handle
+        stop.set()
+        if span.duration >= self.threshold_seconds and samples:
+            span.set(profile=samples.most_common(self.top))
+            logger.info(f"Slow request {span.name} took {span.duration:.2f}s, hottest stacks: "
+                        f"{samples.most_common(3)}")
+
+
+class _SpanContext:
+    __slots__ = ("tracer", "span", "profile")
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+        self.profile = None
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if not stack and self.tracer.profiler is not None:
+            self.profile = self.tracer.profiler.start(threading.get_ident())
+        stack.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.end = time.perf_counter()
+        if exc_type is not None:
+            span.set(error=exc_type.__name__)
+        self.tracer._stack().pop()
+        if self.profile is not None:
+            self.tracer.profiler.finish(self.profile, span)
+        for exporter in self.tracer.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                logger.error(f"Error exporting span {span.name}: {e}")
+        return False
+
+
+class Tracer:
+    """Stage tracing for the retrieval -> rerank -> render -> LLM path.
+
+    Disabled by default (or enabled with ``RAG_TRACING=1``); while disabled
+    ``span()`` returns a shared no-op object so instrumented code pays one
+    attribute check per stage.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.exporters = []
+        self.profiler: Optional[SamplingProfiler] = None
+        self._local = threading.local()
+
+    def configure(self, enabled: bool = True, exporters=None, profiler: Optional[SamplingProfiler] = None):
+        self.enabled = enabled
+        if exporters is not None:
+            self.exporters = list(exporters)
+        self.profiler = profiler
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return NOOP_SPAN
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span = Span(name,
+                    trace_id=parent.trace_id if parent else uuid.uuid4().hex,
+                    parent_id=parent.span_id if parent else None,
+                    attrs=attrs)
+        return _SpanContext(self, span)
+
+    def current_span(self):
+        if not self.enabled:
+            return NOOP_SPAN
+        stack = self._stack()
+        return stack[-1] if stack else NOOP_SPAN
+
+
+tracer = Tracer(enabled=os.getenv("RAG_TRACING") == "1")
+if tracer.enabled:
+    tracer.exporters.append(JsonLinesExporter(os.getenv("RAG_TRACING_FILE", "traces.jsonl")))
+
+
+def traced(name: Optional[str] = None):
+    """Decorator that wraps a function call in a span."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator